@@ -0,0 +1,104 @@
+"""
+Concurrent agent sessions per worker: many sessions stream answers of a
+fake LLM with a fixed latency through the real llm_agent node. With async
+nodes, throughput grows with concurrency; a blocking node stays at one.
+
+    python -m benchmarks.agent_sessions --sessions 1 8 32 128 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import functools
+import statistics
+import time
+from typing import List
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langgraph.graph import END, START, MessagesState, StateGraph
+
+from src.core.agents.streaming import stream_agent
+from src.core.agents.utils import llm_agent
+
+ANSWER = "Streaming keeps every session of the worker responsive."
+
+
+class SlowFakeChatModel(FakeListChatModel):
+    """Fake model waiting latency seconds before its first token"""
+
+    latency: float = 0.5
+
+    async def _astream(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        async for chunk in super()._astream(*args, **kwargs):
+            yield chunk
+
+
+def build_agent(latency: float):
+    prompt = ChatPromptTemplate.from_messages(
+        [("system", "You are a benchmark"), MessagesPlaceholder("messages")]
+    )
+    llm = SlowFakeChatModel(responses=[ANSWER], latency=latency)
+    workflow = StateGraph(MessagesState)
+    workflow.add_node(
+        "llm", functools.partial(llm_agent, executable=prompt | llm)
+    )
+    workflow.add_edge(START, "llm")
+    workflow.add_edge("llm", END)
+    return workflow.compile()
+
+
+async def session(agent, first_tokens: List[float]) -> None:
+    started = time.perf_counter()
+    first = None
+    async for frame in stream_agent(
+        agent, {"messages": [("human", "hi")]}, {}, token_interval=0
+    ):
+        if first is None and frame["type"] == "token":
+            first = time.perf_counter() - started
+    first_tokens.append(first or 0)
+
+
+async def run(agent, sessions: int) -> dict:
+    first_tokens: List[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(session(agent, first_tokens) for _ in range(sessions))
+    )
+    elapsed = time.perf_counter() - started
+    return {
+        "sessions": sessions,
+        "elapsed": elapsed,
+        "per_second": sessions / elapsed,
+        "first_p50": statistics.median(first_tokens) * 1000,
+        "first_max": max(first_tokens) * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sessions", type=int, nargs="+", default=[1, 8, 32, 128]
+    )
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    agent = build_agent(args.latency)
+    print(f"Fake LLM latency {args.latency * 1000:.0f} ms")
+    print(
+        f"{'sessions':>8} {'seconds':>8} {'sessions/s':>11} "
+        f"{'speedup':>8} {'1st token p50/max ms':>21}"
+    )
+    baseline = None
+    for sessions in args.sessions:
+        r = await run(agent, sessions)
+        baseline = baseline or r["per_second"]
+        print(
+            f"{r['sessions']:>8} {r['elapsed']:>8.2f} "
+            f"{r['per_second']:>11.1f} {r['per_second'] / baseline:>8.1f} "
+            f"{r['first_p50']:>10.0f}/{r['first_max']:<10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+"""
+Compare checkpoint codecs on threads recorded in MongoDB: stored size,
+encode/decode time, and write/read latency of a scratch collection.
+
+    python -m benchmarks.checkpoint_codecs --threads 20
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+from src.core.agents.AsyncMongoDBSaver import (
+    BLOBS_COLLECTION,
+    CHECKPOINTS_COLLECTION,
+    WRITES_COLLECTION,
+)
+from src.core.agents.codecs import CODECS, decode, encode
+from src.core.settings import settings
+
+SCRATCH_COLLECTION = "codec_benchmark"
+
+# Collection -> field holding the serialized payload
+PAYLOAD_FIELDS = {
+    CHECKPOINTS_COLLECTION: "checkpoint",
+    BLOBS_COLLECTION: "blob",
+    WRITES_COLLECTION: "value",
+}
+
+
+async def recorded_payloads(
+    db: AsyncIOMotorDatabase, thread_ids: Optional[List[str]], threads: int
+) -> List[bytes]:
+    """Raw serialized payloads of the given threads, or the latest ones"""
+    if not thread_ids:
+        thread_ids = [
+            doc["_id"]
+            async for doc in db[CHECKPOINTS_COLLECTION].aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": "$thread_id",
+                            "last": {"$max": "$checkpoint_id"},
+                        }
+                    },
+                    {"$sort": {"last": -1}},
+                    {"$limit": threads},
+                ]
+            )
+        ]
+
+    payloads = []
+    for collection, field in PAYLOAD_FIELDS.items():
+        async for doc in db[collection].find(
+            {"thread_id": {"$in": thread_ids}}
+        ):
+            if doc.get(field):
+                payloads.append(decode(doc.get("codec"), doc[field]))
+    return payloads
+
+
+def percentile(values: List[float], p: float) -> float:
+    return statistics.quantiles(values, n=100)[int(p) - 1] * 1000
+
+
+async def bench_codec(
+    db: AsyncIOMotorDatabase,
+    codec: str,
+    payloads: List[bytes],
+    threshold: int,
+) -> dict:
+    started = time.perf_counter()
+    encoded = [encode(payload, codec, threshold) for payload in payloads]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for tag, data in encoded:
+        decode(tag, data)
+    decode_seconds = time.perf_counter() - started
+
+    collection = db[f"{SCRATCH_COLLECTION}_{codec}"]
+    await collection.drop()
+    writes, reads = [], []
+    try:
+        for i, payload in enumerate(payloads):
+            started = time.perf_counter()
+            tag, data = encode(payload, codec, threshold)
+            await collection.insert_one({"_id": i, "codec": tag, "v": data})
+            writes.append(time.perf_counter() - started)
+
+        for i in range(len(payloads)):
+            started = time.perf_counter()
+            doc = await collection.find_one({"_id": i})
+            decode(doc["codec"], doc["v"])
+            reads.append(time.perf_counter() - started)
+
+        stats = await db.command("collStats", collection.name)
+    finally:
+        await collection.drop()
+
+    return {
+        "codec": codec,
+        "bytes": sum(len(data) for _, data in encoded),
+        "storage": stats.get("storageSize", 0),
+        "encode_ms": encode_seconds * 1000,
+        "decode_ms": decode_seconds * 1000,
+        "write_p50": percentile(writes, 50),
+        "write_p95": percentile(writes, 95),
+        "read_p50": percentile(reads, 50),
+        "read_p95": percentile(reads, 95),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--thread", action="append", dest="thread_ids")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument(
+        "--threshold",
+        type=int,
+        default=settings.CHECKPOINT_COMPRESSION_THRESHOLD,
+    )
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(settings.MONGO_DB_URL)
+    db = client[settings.CHECKPOINT_DB]
+    try:
+        payloads = await recorded_payloads(db, args.thread_ids, args.threads)
+        if len(payloads) < 2:
+            raise SystemExit("Not enough recorded checkpoints to benchmark")
+        raw = sum(len(payload) for payload in payloads)
+        print(f"{len(payloads)} payloads, {raw / 1024:.1f} KiB raw")
+        print(
+            f"{'codec':<6} {'KiB':>9} {'ratio':>6} {'disk KiB':>9} "
+            f"{'enc ms':>8} {'dec ms':>8} {'w p50/p95 ms':>14} "
+            f"{'r p50/p95 ms':>14}"
+        )
+        for codec in CODECS:
+            r = await bench_codec(db, codec, payloads, args.threshold)
+            print(
+                f"{r['codec']:<6} {r['bytes'] / 1024:>9.1f} "
+                f"{raw / r['bytes']:>6.2f} {r['storage'] / 1024:>9.1f} "
+                f"{r['encode_ms']:>8.1f} {r['decode_ms']:>8.1f} "
+                f"{r['write_p50']:>6.2f}/{r['write_p95']:<7.2f} "
+                f"{r['read_p50']:>6.2f}/{r['read_p95']:<7.2f}"
+            )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
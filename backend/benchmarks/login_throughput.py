@@ -0,0 +1,107 @@
+"""
+Logins per second through the hashing pool, per worker process, and how
+many callers get turned away (429) under a burst of concurrent logins.
+
+    python -m benchmarks.login_throughput --logins 200 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+from src.core.pools import shutdown_pools
+from src.core.settings import settings
+from src.security.hashing import (
+    HashingBusyError,
+    hash_with_cost,
+    verify_password,
+)
+
+PASSWORD = "correct horse battery staple"
+
+
+async def login(hashed: str, latencies: List[float]) -> bool:
+    """Whether the login went through, False when it would be a 429"""
+    started = time.perf_counter()
+    try:
+        valid, _ = await verify_password(hashed=hashed, normal=PASSWORD)
+    except HashingBusyError:
+        return False
+    assert valid
+    latencies.append(time.perf_counter() - started)
+    return True
+
+
+async def burst(hashed: str, logins: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def limited() -> bool:
+        async with semaphore:
+            return await login(hashed, latencies)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(limited() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+
+    accepted = sum(results)
+    return {
+        "accepted": accepted,
+        "rejected": logins - accepted,
+        "per_second": accepted / elapsed,
+        "p50": statistics.median(latencies) * 1000 if latencies else 0,
+        "max": max(latencies, default=0) * 1000,
+    }
+
+
+async def loop_lag(stop: asyncio.Event, lags: List[float]) -> None:
+    """Event loop responsiveness while the burst runs"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - started - 0.01)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    hashed = hash_with_cost(PASSWORD)
+    print(
+        f"bcrypt cost {settings.BCRYPT_ROUNDS}, "
+        f"{settings.HASHING_PROCESSES} processes, "
+        f"queue limit {settings.HASHING_QUEUE_LIMIT}"
+    )
+
+    started = time.perf_counter()
+    hash_with_cost(PASSWORD)
+    single = time.perf_counter() - started
+    print(f"Single hash in process: {single * 1000:.1f} ms")
+
+    # Warm the pool up so process start-up isn't measured
+    await verify_password(hashed=hashed, normal=PASSWORD)
+
+    stop, lags = asyncio.Event(), []
+    lag_task = asyncio.create_task(loop_lag(stop, lags))
+    try:
+        r = await burst(hashed, args.logins, args.concurrency)
+    finally:
+        stop.set()
+        await lag_task
+        shutdown_pools()
+
+    print(
+        f"{r['accepted']} logins, {r['rejected']} rejected (429), "
+        f"{r['per_second']:.1f}/s, "
+        f"{r['per_second'] / settings.HASHING_PROCESSES:.1f}/s per process"
+    )
+    print(f"Latency p50 {r['p50']:.1f} ms, max {r['max']:.1f} ms")
+    print(f"Event loop lag max {max(lags, default=0) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+"""
+Agent runs of sessions: one streamed run at a time per session across
+workers, held through a lease of the session bus, its frames published to
+every member through the connection manager. A run is cancelled once the
+session has no member left on any worker.
+"""
+
+import asyncio
+from typing import Any, Dict, Optional
+
+from langgraph.graph.state import CompiledStateGraph
+from loguru import logger
+
+from src.core.agents.AsyncMongoDBSaver import AsyncMongoDBSaver
+from src.core.agents.streaming import stream_agent
+from src.core.settings import settings
+
+from .websocket import connection_manager
+
+# Runs this worker holds the lease of
+runs: Dict[str, asyncio.Task] = {}
+
+
+def is_running(session_id: str) -> bool:
+    task = runs.get(session_id)
+    return task is not None and not task.done()
+
+
+async def _watch(session_id: str, run: asyncio.Task) -> None:
+    """Renew the lease, and stop the run when nobody is left to read it"""
+    bus = connection_manager.bus
+    while True:
+        await asyncio.sleep(settings.WS_RUN_HEARTBEAT)
+        try:
+            if not await bus.renew_run(session_id):
+                logger.warning(f"Lost the run lease of session {session_id}")
+                run.cancel()
+                return
+            if not await bus.members(session_id):
+                run.cancel()
+                return
+        except Exception as e:
+            # The lease outlives a few failed renewals
+            logger.warning(f"Cannot renew run lease of {session_id}: {e}")
+
+
+async def _run(
+    session_id: str,
+    thread_id: str,
+    agent: CompiledStateGraph,
+    input: Dict[str, Any],
+    announce: Optional[Dict[str, Any]],
+) -> None:
+    watcher = asyncio.create_task(_watch(session_id, asyncio.current_task()))
+    # The conversation thread is shared by the members of the session
+    config = {"configurable": {"thread_id": thread_id}}
+    try:
+        if announce is not None:
+            await connection_manager.publish(session_id, announce)
+        async for frame in stream_agent(agent, input, config):
+            await connection_manager.publish(session_id, frame)
+    except asyncio.CancelledError:
+        logger.info(f"Agent run of session {session_id} cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"Agent run of session {session_id} failed: {e}")
+        await connection_manager.publish(
+            session_id, {"type": "error", "detail": "Agent run failed"}
+        )
+    finally:
+        watcher.cancel()
+        if runs.get(session_id) is asyncio.current_task():
+            del runs[session_id]
+        # Checkpoints of the run are written before another one can start
+        if isinstance(agent.checkpointer, AsyncMongoDBSaver):
+            try:
+                await agent.checkpointer.flush(thread_id)
+            except Exception as e:
+                logger.error(f"Checkpoints flush of {session_id} failed: {e}")
+        try:
+            await connection_manager.bus.release_run(session_id)
+        except Exception as e:
+            # Expires after WS_RUN_LEASE
+            logger.warning(f"Cannot release run lease of {session_id}: {e}")
+
+
+async def start_run(
+    session_id: str,
+    thread_id: str,
+    agent: CompiledStateGraph,
+    input: Dict[str, Any],
+    announce: Optional[Dict[str, Any]] = None,
+) -> Optional[asyncio.Task]:
+    """
+    Start a run checkpointed under thread_id (see crud.session_thread_id),
+    publishing announce first, None when the session already has one in
+    flight on any worker
+    """
+    if is_running(session_id):
+        return None
+    if not await connection_manager.bus.claim_run(session_id):
+        return None
+    run = runs[session_id] = asyncio.create_task(
+        _run(session_id, thread_id, agent, input, announce)
+    )
+    # Let the run start: cancelled before its first step, it would never
+    # reach the finally releasing the lease
+    await asyncio.sleep(0)
+    return run
+
+
+async def member_left(session_id: str) -> None:
+    """
+    Cancel the run held by this worker once the session has no member
+    left anywhere, runs held by other workers notice it on their own
+    """
+    try:
+        await connection_manager.sync_members(session_id)
+        if is_running(session_id) and not (
+            await connection_manager.bus.members(session_id)
+        ):
+            cancel_run(session_id)
+    except Exception as e:
+        # The presence refresh and the run watcher catch up
+        logger.warning(f"Cannot check members of {session_id}: {e}")
+
+
+def cancel_run(session_id: str) -> None:
+    task = runs.pop(session_id, None)
+    if task is not None:
+        task.cancel()
+
+
+async def cancel_runs() -> None:
+    tasks = list(runs.values())
+    runs.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,8 +1,8 @@
 from typing import Any, Dict
 
-import boto3
 from bson import ObjectId
 from fastapi import HTTPException
+from langgraph.graph.state import CompiledStateGraph
 from loguru import logger
 from qdrant_client import models
 
@@ -11,6 +11,7 @@ from src.api.models import (
     Agent,
     AgentValidate,
     ChartData,
+    DataNodeFingerprint,
     Graph,
     GraphCreateForm,
     MongoDBModel,
@@ -23,11 +24,27 @@ from src.api.models import (
     UserInfo,
     UserTooltip,
 )
-from src.core.agents.AsyncMongoDBSaver import AsyncMongoDBSaver
+from src.cloud.s3 import s3_key_from_url, s3_service
+from src.core.agents.AsyncMongoDBSaver import (
+    AsyncMongoDBSaver,
+    checkpoints_db,
+)
+from src.core.agents.cache import (
+    agent_fingerprint,
+    compiled_agent_cache,
+    compiled_agent_key,
+    invalidate_compiled_agent,
+)
+from src.core.agents.extraction_cache import extraction_cache
 from src.core.agents.graph import WakilAgent
-from src.core.settings import settings
 from src.db.client import MongoDBClient
 from src.db.qdrant import get_qdrant
+from src.security.entitlements import (
+    ENTITLEMENT_FIELDS,
+    Entitlement,
+    cache_entitlement,
+    get_cached_entitlement,
+)
 
 
 async def get_user_id(email: str) -> PyObjectId:
@@ -40,30 +57,67 @@ async def get_user_id(email: str) -> PyObjectId:
 
 async def user_owns_document(
     collection: MongoDBModel, document_id: PyObjectId, user_id: PyObjectId
-) -> bool:
-    """Check if the user owns the document by comparing the user_id field in the document with the provided user_id."""
-    """Also Checks user's subscription status and if the user has more than 10 documents"""
+) -> dict[str, Any] | None:
+    """
+    Return the document if the user owns it, None otherwise, so the
+    handler can reuse it instead of fetching it again.
+    Also checks the user's subscription (cached, see security.entitlements)
+    and that the user doesn't have 10 documents.
 
+    The document, the user's document count and, on cache miss, the user's
+    entitlement are fetched in one aggregation
+    """
     client = MongoDBClient()
-    result = await client.get(collection, document_id)
-    user = await client.get(User, ObjectId(user_id))
-    # print(result)
-    if user is None:
-        return False
-    # print(user)
-    if (
-        user.get("subscription_plan") is None
-        or user.get("subscription_status") == "canceled"
-    ):
-        return False
-    document_count = await client.count_documents(
-        collection, {"user_id": ObjectId(user_id)}
+    entitlement = get_cached_entitlement(user_id)
+    pipeline = [
+        {"$match": {"_id": document_id}},
+        {
+            "$lookup": {
+                "from": collection.get_collection_name(),
+                "pipeline": [
+                    {"$match": {"user_id": ObjectId(user_id)}},
+                    {"$count": "count"},
+                ],
+                "as": "_user_documents",
+            }
+        },
+    ]
+    if entitlement is None:
+        pipeline.append(
+            {
+                "$lookup": {
+                    "from": User.get_collection_name(),
+                    "pipeline": [
+                        {"$match": {"_id": ObjectId(user_id)}},
+                        {"$project": dict.fromkeys(ENTITLEMENT_FIELDS, 1)},
+                    ],
+                    "as": "_user",
+                }
+            }
+        )
+
+    results = await (
+        client.get_collection(collection).aggregate(pipeline).to_list(1)
     )
-    if document_count == 10:
-        return False
-    if result is None:
-        return False
-    return result.get("user_id") == user_id
+    if not results:
+        return None
+    result = results[0]
+
+    if entitlement is None:
+        if not result["_user"]:
+            return None
+        entitlement = Entitlement.from_user(result["_user"][0])
+        cache_entitlement(user_id, entitlement)
+    if not entitlement.active:
+        return None
+
+    user_documents = result.pop("_user_documents")
+    result.pop("_user", None)
+    if user_documents and user_documents[0]["count"] == 10:
+        return None
+    if result.get("user_id") != user_id:
+        return None
+    return result | {"id": result.pop("_id")}
 
 
 async def start_new_session(
@@ -125,14 +179,34 @@ async def get_graph_by_id(id: PyObjectId) -> Agent | None:
     return result
 
 
-async def get_graphs_user_id(user_id: str) -> list[Agent]:
+async def get_graphs_user_id(
+    user_id: str, include_graph: bool = True, **page: Any
+) -> list[Agent]:
     client = MongoDBClient()
-    result = await client.get_many_user_id(Agent, user_id)  # type: ignore[arg-type]
-    # print(result)
-    if result is None:
-        return []
+    projection = None
+    if not include_graph:
+        # Node arrays are by far the heaviest part of an agent
+        projection = [
+            field
+            for field in Agent.model_fields
+            if field not in ("id", "graph", "fingerprints")
+        ]
+    return await client.get_many_user_id(
+        Agent,
+        user_id,  # type: ignore[arg-type]
+        projection=projection,
+        **page,
+    )
 
-    return result
+
+async def get_graph_titles(user_id: PyObjectId) -> list[str]:
+    client = MongoDBClient()
+    return [
+        agent["title"]
+        async for agent in client.iter_many(
+            Agent, {"user_id": user_id}, projection=["title"]
+        )
+    ]
 
 
 async def list_sessions_from_db() -> list[Session] | None:
@@ -164,6 +238,24 @@ async def update_session(
     return await get_session_by_id(session_id)
 
 
+async def delete_nodes_files(nodes: list[dict[str, Any]]) -> list[str]:
+    """Delete the files uploaded to S3 by file nodes, in batches"""
+    data_nodes = list(S3Nodes.__args__)
+    file_names = [
+        # EXTRACT FILE KEY NAME FROM PRESIGNED URL
+        s3_key_from_url(node["data"]["metadata"]["url"])
+        for node in nodes
+        if node["data"]["title"] in data_nodes
+        and node["data"]["metadata"].get("url")
+    ]
+    if not file_names:
+        return []
+    deleted = await s3_service.delete_objects(file_names)
+    await extraction_cache.invalidate(file_names)
+    logger.info(f"Deleted Data from S3 Bucket {deleted}")
+    return deleted
+
+
 async def delete_graph_by_id(graph_id: PyObjectId):
     """delete vectors from vector db with given graph_id"""
     client = MongoDBClient()
@@ -176,51 +268,14 @@ async def delete_graph_by_id(graph_id: PyObjectId):
             "message": "Vector database is not available.",
         }
 
-    # WIP: Delete S3 Blobs
+    # Delete S3 Blobs
     try:
-        data_nodes = list(S3Nodes.__args__)
-        # First check if any file upload exist
         client = MongoDBClient()
         agent = await client.get(Agent, graph_id)
         # print(agent)
         # If a graph is constructed
         if agent["graph"] is not None:
-            nodes = agent["graph"]["nodes"]
-            nodes_files = [
-                node
-                for node in list(nodes)
-                if node["data"]["title"] in data_nodes
-            ]
-            logger.info("file nodes", nodes_files)
-            s3_exists = any(nodes_files)
-            if s3_exists:
-                try:
-                    s3_client = boto3.client(
-                        "s3",
-                        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                        region_name=settings.AWS_REGION_NAME,
-                    )
-                    for node in nodes_files:
-                        logger.info(node)
-                        # See if the node has metadata
-                        if node["data"]["metadata"]:
-                            # EXTRACT FILE KEY NAME FROM PRESIGNED URL
-                            filename = node["data"]["metadata"]["file"]["url"]
-                            file_name = filename.rsplit("/", 1)[-1].split(
-                                "?", 1
-                            )[0]
-                            response = s3_client.delete_object(
-                                Bucket=settings.S3_BUCKET_NAME,
-                                Key=file_name,
-                            )
-                            logger.info(
-                                f"Deleted Data from S3 Bucket {response}"
-                            )
-
-                except Exception as e:
-                    logger.warning(f"Error while deleting blobs from S3: {e}")
-                    return []
+            await delete_nodes_files(agent["graph"]["nodes"])
 
     except Exception as e:
         logger.warning(f"Error while deleting blobs from S3: {e}")
@@ -248,9 +303,17 @@ async def delete_graph_by_id(graph_id: PyObjectId):
     # Delete Agent checkpoints documents from mongodb
     try:
         # Connect to MongoDB, access checkpoints documents and delete based on id
-        deleted_count = await AsyncMongoDBSaver().aremove_checkpoints(graph_id)
+        deleted_count = await AsyncMongoDBSaver(
+            checkpoints_db()
+        ).aremove_checkpoints(graph_id)
         logger.info(f"Deleted {deleted_count} checkpoints")
 
+        # Conversations of the sessions using this agent
+        async for session in client.iter_many(
+            Session, {"agent.id": graph_id}, projection=["_id"]
+        ):
+            await delete_session_checkpoints(session["id"])
+
     except Exception as e:
         logger.error(f"Error Deleting agents checkpoints if hey exist: {e}")
 
@@ -259,6 +322,7 @@ async def delete_graph_by_id(graph_id: PyObjectId):
     except Exception as e:
         logger.error(f"Error while deleting graph from MongoDB: {e}")
         return []
+    invalidate_compiled_agent(graph_id)
 
     return {
         "status": "success",
@@ -266,11 +330,11 @@ async def delete_graph_by_id(graph_id: PyObjectId):
     }
 
 
-async def get_sessions_by_id(user_id: PyObjectId):
+async def get_sessions_by_id(user_id: PyObjectId, **page: Any):
     client = MongoDBClient()
     if user_id is None:
         return None
-    result = await client.get_many_user_id(Session, user_id)  # type: ignore[arg-type]
+    result = await client.get_many_user_id(Session, user_id, **page)  # type: ignore[arg-type]
     result = [
         {**card, "finished_at": card.get("finished_at", "not yet finished")}
         for card in result
@@ -279,9 +343,31 @@ async def get_sessions_by_id(user_id: PyObjectId):
     return result
 
 
+def session_thread_id(session_id: PyObjectId, agent: Agent) -> str:
+    """
+    Checkpoint thread of a session's conversation with one version of its
+    agent, a republished graph starts a new thread rather than resuming
+    state written by another one
+    """
+    return f"{session_id}:{agent_fingerprint(agent)}"
+
+
+async def delete_session_checkpoints(session_id: PyObjectId) -> int:
+    """Remove the threads of the session with every version of its agent"""
+    return await AsyncMongoDBSaver(checkpoints_db()).aremove_thread_prefix(
+        f"{session_id}:"
+    )
+
+
 async def delete_session_by_id(session_id: PyObjectId):
     client = MongoDBClient()
     await client.delete_one(Session, session_id)
+    try:
+        deleted_count = await delete_session_checkpoints(session_id)
+        logger.info(f"Deleted {deleted_count} checkpoints of {session_id}")
+    except Exception as e:
+        # The session is gone, its checkpoints are only storage
+        logger.error(f"Error deleting checkpoints of {session_id}: {e}")
 
 
 async def get_user_data(id: PyObjectId):
@@ -322,12 +408,7 @@ async def get_user_tooltip(user_email: str) -> UserTooltip:
 
 async def get_graph_by_name_user_id(user_id: PyObjectId, name: str):
     client = MongoDBClient()
-    result = await client.get_many_user_id(Agent, user_id)  # type: ignore[arg-type]
-    for agent in result:
-        # print(agent)
-        if agent["title"] == name:
-            return agent
-    return None
+    return await client.get_by_name_user_id(Agent, name, user_id)  # type: ignore[arg-type]
 
 
 async def retrieve_agent(graph_id: PyObjectId) -> Agent:
@@ -358,43 +439,11 @@ async def save_graph_to_db(graph: Graph, graph_id: PyObjectId):
             ]
             logger.info(deleted_nodes)
             if len(deleted_nodes) > 0:
-                # First check if any file upload exist
-                data_nodes = list(S3Nodes.__args__)
-                nodes_files = [
-                    node
-                    for node in deleted_nodes
-                    if node["data"]["title"] in data_nodes
-                ]
-                logger.info("file nodes", nodes_files)
-                s3_exists = any(nodes_files)
-                if s3_exists:
-                    try:
-                        s3_client = boto3.client(
-                            "s3",
-                            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                            region_name=settings.AWS_REGION_NAME,
-                        )
-                        for node in nodes_files:
-                            logger.info(node)
-                            # See if the node has metadata
-                            if node["data"]["metadata"]:
-                                # EXTRACT FILE KEY NAME FROM PRESIGNED URL
-                                filename = node["data"]["metadata"]["file"]["url"]
-                                file_name = filename.rsplit("/", 1)[-1].split(
-                                    "?", 1
-                                )[0]
-                                response = s3_client.delete_object(
-                                    Bucket=settings.S3_BUCKET_NAME,
-                                    Key=file_name,
-                                )
-                                logger.info(
-                                    f"Deleted Data from S3 Bucket {response}"
-                                )
-
-                    except Exception as e:
-                        logger.warning(f"Error while deleting blobs from S3: {e}")
-                        return []
+                try:
+                    await delete_nodes_files(deleted_nodes)
+                except Exception as e:
+                    logger.warning(f"Error while deleting blobs from S3: {e}")
+                    return []
             # Check if any vector db node exist
             vector_db_nodes = [
                 node for node in deleted_nodes if node["type"] == "Qdrant"
@@ -432,9 +481,14 @@ async def save_graph_to_db(graph: Graph, graph_id: PyObjectId):
                         f"Error while deleting vectors from Qdrant: {e}"
                     )
                     return []
-        result = await client.update_one(
-            Agent, graph_id, {"graph": graph, "publish.published": False}
-        )
+        update = {"graph": graph, "publish.published": False}
+        if agent["graph"] and vector_db_exists:
+            # Every vector of the graph is gone, so must be the fingerprints
+            update |= {"fingerprints": {}}
+        result = await client.update_one(Agent, graph_id, update)
+        if agent["graph"] and vector_db_exists:
+            # Compiled versions query the vectors just deleted
+            invalidate_compiled_agent(graph_id)
     except Exception as e:
         logger.error(f"failed saving error: {e}")
     if result is None:
@@ -456,6 +510,58 @@ async def save_agent_to_db(agent: Agent, graph_id: PyObjectId):
     return result
 
 
+async def compile_agent(agent: Agent) -> CompiledStateGraph:
+    """
+    Build and compile an agent, unless the exact same agent was already
+    compiled, in which case the cached graph is served and the whole
+    pipeline (validation, data loading, embedding, prompt...) is skipped
+    """
+    key = compiled_agent_key(agent)
+    compiled_agent = compiled_agent_cache.get(key)
+    if compiled_agent is not None:
+        logger.info(
+            f"Serving compiled agent {agent.id} from cache: "
+            f"{compiled_agent_cache.stats()}"
+        )
+        return compiled_agent
+
+    wakil_agent = WakilAgent()
+    await wakil_agent.intialize(agent)
+    # The checkpointer lives as long as the compiled agent does
+    compiled_agent = await wakil_agent.build_agent(
+        checkpointer=AsyncMongoDBSaver(checkpoints_db())
+    )
+    _ = await wakil_agent.draw_agent()
+    await save_agent_fingerprints(agent.id, wakil_agent.fingerprints)
+
+    compiled_agent_cache.set(key, compiled_agent)
+    logger.info(
+        f"Compiled agent {agent.id} cached: {compiled_agent_cache.stats()}"
+    )
+    return compiled_agent
+
+
+async def save_agent_fingerprints(
+    graph_id: PyObjectId,
+    fingerprints: Dict[str, Dict[str, DataNodeFingerprint]],
+):
+    """Remember what was ingested, so next publish only ingests changes"""
+    client = MongoDBClient()
+    return await client.update_one(
+        Agent,
+        graph_id,
+        {
+            "fingerprints": {
+                node_id: {
+                    data_node_id: fingerprint.model_dump()
+                    for data_node_id, fingerprint in data_nodes.items()
+                }
+                for node_id, data_nodes in fingerprints.items()
+            }
+        },
+    )
+
+
 async def publish_graph_away(graph: Graph, graph_id: PyObjectId):
     # client = MongoDBClient()
     result = WakilAgent(graph)
@@ -464,10 +570,10 @@ async def publish_graph_away(graph: Graph, graph_id: PyObjectId):
 
 async def retrieve_user_statistics(user_id: PyObjectId) -> Dict[str, Any]:
     client = MongoDBClient()
-    nb_agents = await client.get_many_user_id(Agent, user_id)
-    nb_sessions = await client.get_many_user_id(Session, user_id)
+    nb_agents = await client.count_documents(Agent, {"user_id": user_id})
+    nb_sessions = await client.count_documents(Session, {"user_id": user_id})
 
-    return {"nb_sessions": len(nb_agents), "nb_agents": len(nb_sessions)}
+    return {"nb_sessions": nb_sessions, "nb_agents": nb_agents}
 
 
 async def fetch_chart_data_from_db(user_id: PyObjectId) -> UserDataResponse:
@@ -478,8 +584,12 @@ async def fetch_chart_data_from_db(user_id: PyObjectId) -> UserDataResponse:
     """
     try:
         client = MongoDBClient()
-        agents = await client.get_many_user_id(Agent, user_id)
-        sessions = await client.get_many_user_id(Session, user_id)
+        agents = await client.get_many_user_id(
+            Agent, user_id, projection=["created_at"]
+        )
+        sessions = await client.get_many_user_id(
+            Session, user_id, projection=["created_at"]
+        )
 
         # Create a dictionary to store the chart data
         chart_data_dict = {}
@@ -7,6 +7,7 @@ from pydantic import (
     Field,
     field_validator,
 )
+from pymongo import ASCENDING, IndexModel
 
 from .fields import PyObjectId
 
@@ -14,6 +15,8 @@ from .fields import PyObjectId
 class MongoDBModel(BaseModel):
     class Meta:
         collection_name: str
+        # Created at startup, see src.db.indexes
+        indexes: list[IndexModel] = []
 
     id: PyObjectId
     created_at: datetime
@@ -23,6 +26,10 @@ class MongoDBModel(BaseModel):
     def get_collection_name(cls) -> str:
         return cls.Meta.collection_name
 
+    @classmethod
+    def get_indexes(cls) -> list[IndexModel]:
+        return getattr(cls.Meta, "indexes", [])
+
 
 class UpdateImageModel(BaseModel):
     image_uri: str
@@ -34,6 +41,7 @@ class UpdateImageModel(BaseModel):
 class User(MongoDBModel):
     class Meta:
         collection_name = "users"
+        indexes = [IndexModel([("email", ASCENDING)], unique=True)]
 
     firstname: str
     lastname: str
@@ -110,6 +118,17 @@ class SessionAgent(BaseModel):
 class Session(MongoDBModel):
     class Meta:
         collection_name = "sessions"
+        indexes = [
+            # Listing pages, keyset on _id or created_at, and counts
+            IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("created_at", ASCENDING),
+                    ("_id", ASCENDING),
+                ]
+            ),
+        ]
 
     title: str
     max_session_users: int = 3
@@ -152,7 +171,7 @@ DataNodes = Literal[
     "Google Drive",
 ]
 
-S3Nodes = Literal["File Uplaod"]
+S3Nodes = Literal["File Upload"]
 
 VectorDatabaseNodes = Literal[
     "Pinecone",
@@ -217,9 +236,32 @@ class Publish(BaseModel):
     publish_count: int = 0
 
 
+class DataNodeFingerprint(BaseModel):
+    """
+    Fingerprint of a data node ingested in a vector db node,
+    used to only re-ingest data nodes whose content changed
+    """
+
+    source: str  # Hash of the URL, query or S3 key
+    content: str  # Hash of the extracted text
+
+
 class Agent(MongoDBModel):
     class Meta:
         collection_name = "agents"
+        indexes = [
+            # Listing pages, keyset on _id or created_at, and counts
+            IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("created_at", ASCENDING),
+                    ("_id", ASCENDING),
+                ]
+            ),
+            # Agent lookup by title when starting a session
+            IndexModel([("user_id", ASCENDING), ("title", ASCENDING)]),
+        ]
 
     title: str
     description: str
@@ -227,6 +269,8 @@ class Agent(MongoDBModel):
     graph: Optional[Graph] = None
     user_id: PyObjectId
     publish: Publish = Publish()
+    # vector db node id -> data node id -> fingerprint
+    fingerprints: dict[str, dict[str, DataNodeFingerprint]] = {}
 
 
 class AgentValidate(BaseModel):
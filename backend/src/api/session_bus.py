@@ -0,0 +1,349 @@
+"""
+Pub/sub of session broadcasts between workers. Every frame is published
+on the bus and each worker delivers it to its own websocket clients, so
+users of a session can be connected to different processes or pods.
+
+Frames carry a per-session sequence number, clients seeing a gap
+(eviction, reconnection, a frame lost by the bus) should reload the session.
+
+The bus also tells how many members a session has across workers, and
+hands out the lease of a session's agent run to one worker at a time.
+
+Backends (WS_BUS_BACKEND):
+- memory: in-process, for a single worker
+- mongo: a capped collection tailed by every worker, no extra infrastructure.
+  Frames of a session are batched over WS_BUS_BATCH_INTERVAL, each batch
+  costs one sequence increment and one insert whatever its size. Frames
+  are delivered in seq order only among those published by one worker,
+  see MongoCappedBus
+"""
+
+import asyncio
+import os
+import socket
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.cursor import CursorType
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
+
+from src.core.cache import LRUCache
+from src.core.settings import settings
+
+# Called with the session id and the encoded frame
+Deliver = Callable[[str, str], None]
+
+SEQUENCES_COLLECTION = "session_bus_sequences"
+# Member count of each session per worker
+PRESENCE_COLLECTION = "session_presence"
+# Lease of the agent run of each session
+RUNS_COLLECTION = "session_runs"
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def encode_frame(session_id: str, seq: int, payload: str) -> str:
+    """Wrap an already encoded JSON payload, without decoding it again"""
+    return f'{{"session_id":"{session_id}","seq":{seq},"data":{payload}}}'
+
+
+class SessionBus(ABC):
+    def __init__(self) -> None:
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        self.deliver = deliver
+
+    @abstractmethod
+    async def publish(self, session_id: str, payload: str) -> None:
+        """Send an encoded JSON payload to every member of the session"""
+        pass
+
+    @abstractmethod
+    async def set_members(self, counts: Dict[str, int]) -> None:
+        """Members of sessions connected to this worker"""
+        pass
+
+    @abstractmethod
+    async def members(self, session_id: str) -> int:
+        """Members of the session, on every worker"""
+        pass
+
+    @abstractmethod
+    async def claim_run(self, session_id: str) -> bool:
+        """Take the run lease of the session, False if another holds it"""
+        pass
+
+    @abstractmethod
+    async def renew_run(self, session_id: str) -> bool:
+        """Extend the lease, False if this worker lost it"""
+        pass
+
+    @abstractmethod
+    async def release_run(self, session_id: str) -> None:
+        pass
+
+    async def close(self) -> None:
+        self.deliver = None
+
+
+class InProcessBus(SessionBus):
+    def __init__(self) -> None:
+        super().__init__()
+        self.sequences = LRUCache(maxsize=100_000)
+        self.counts: Dict[str, int] = {}
+        self.running: set[str] = set()
+
+    async def publish(self, session_id: str, payload: str) -> None:
+        seq = self.sequences.get(session_id, 0) + 1
+        self.sequences.set(session_id, seq)
+        if self.deliver is not None:
+            self.deliver(session_id, encode_frame(session_id, seq, payload))
+
+    async def set_members(self, counts: Dict[str, int]) -> None:
+        for session_id, count in counts.items():
+            if count:
+                self.counts[session_id] = count
+            else:
+                self.counts.pop(session_id, None)
+
+    async def members(self, session_id: str) -> int:
+        return self.counts.get(session_id, 0)
+
+    async def claim_run(self, session_id: str) -> bool:
+        if session_id in self.running:
+            return False
+        self.running.add(session_id)
+        return True
+
+    async def renew_run(self, session_id: str) -> bool:
+        return session_id in self.running
+
+    async def release_run(self, session_id: str) -> None:
+        self.running.discard(session_id)
+
+
+class MongoCappedBus(SessionBus):
+    """
+    Frames are inserted in a capped collection that every worker follows
+    with a tailable cursor, the publishing worker included so all members
+    see frames in the same order. Sequence numbers come from an atomic
+    counter per session, incremented once per batch. Counters of sessions
+    idle for WS_BUS_SEQUENCE_TTL are dropped by a TTL index.
+
+    The increment and the insert are two operations, so when two workers
+    publish to a session at once the batch with the higher seq can be
+    inserted first. Collection order, hence delivery order, follows seq
+    only for the frames of one worker; across workers seq is the order,
+    and clients seeing a frame older than the last one should sort by it.
+
+    Member counts and run leases expire (WS_PRESENCE_TTL, WS_RUN_LEASE)
+    unless refreshed, so a crashed worker doesn't hold them forever.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        super().__init__()
+        self.db = db
+        self.collection = db[settings.WS_BUS_COLLECTION]
+        self.sequences = db[SEQUENCES_COLLECTION]
+        self.presence = db[PRESENCE_COLLECTION]
+        self.runs = db[RUNS_COLLECTION]
+        self.tail_task: Optional[asyncio.Task] = None
+        # Frames waiting for the next batch, and the task writing them
+        self.pending: Dict[str, List[str]] = {}
+        self.flushers: Dict[str, asyncio.Task] = {}
+
+    async def setup(self) -> None:
+        try:
+            await self.db.create_collection(
+                settings.WS_BUS_COLLECTION,
+                capped=True,
+                size=settings.WS_BUS_CAPPED_SIZE,
+            )
+            # A tailable cursor on an empty capped collection dies at once
+            await self.collection.insert_one({"session_id": None})
+        except CollectionInvalid:
+            pass
+        await self.sequences.create_index(
+            "updated_at", expireAfterSeconds=settings.WS_BUS_SEQUENCE_TTL
+        )
+        await self.presence.create_index("session_id")
+        for collection in (self.presence, self.runs):
+            await collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def start(self, deliver: Deliver) -> None:
+        await self.setup()
+        await super().start(deliver)
+        newest = await self.collection.find_one(sort=[("$natural", -1)])
+        self.tail_task = asyncio.create_task(
+            self._tail(newest["_id"] if newest else None)
+        )
+
+    async def publish(self, session_id: str, payload: str) -> None:
+        """Queue the frame for the next batch of the session"""
+        self.pending.setdefault(session_id, []).append(payload)
+        if session_id not in self.flushers:
+            self.flushers[session_id] = asyncio.create_task(
+                self._flush_later(session_id)
+            )
+
+    async def _flush_later(self, session_id: str) -> None:
+        try:
+            await asyncio.sleep(settings.WS_BUS_BATCH_INTERVAL)
+            # Frames published while a batch is written make the next one
+            while payloads := self.pending.pop(session_id, None):
+                await self._write_batch(session_id, payloads)
+        except Exception as e:
+            # Clients see the lost frames as a gap in seq
+            logger.error(f"Session bus publish of {session_id} failed: {e}")
+        finally:
+            self.flushers.pop(session_id, None)
+
+    async def _write_batch(self, session_id: str, payloads: List[str]) -> None:
+        # Another worker can increment and insert between these two
+        counter = await self.sequences.find_one_and_update(
+            {"_id": session_id},
+            {
+                "$inc": {"seq": len(payloads)},
+                "$currentDate": {"updated_at": True},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        first = counter["seq"] - len(payloads) + 1
+        await self.collection.insert_one(
+            {
+                "session_id": session_id,
+                "frames": [
+                    encode_frame(session_id, seq, payload)
+                    for seq, payload in enumerate(payloads, first)
+                ],
+                "created_at": datetime.now(timezone.utc),
+            }
+        )
+
+    async def set_members(self, counts: Dict[str, int]) -> None:
+        expires_at = datetime.now(timezone.utc) + timedelta(
+            seconds=settings.WS_PRESENCE_TTL
+        )
+        operations = [
+            UpdateOne(
+                {"_id": f"{session_id}:{WORKER_ID}"},
+                {
+                    "$set": {
+                        "session_id": session_id,
+                        "count": count,
+                        "expires_at": expires_at,
+                    }
+                },
+                upsert=True,
+            )
+            if count
+            else DeleteOne({"_id": f"{session_id}:{WORKER_ID}"})
+            for session_id, count in counts.items()
+        ]
+        if operations:
+            await self.presence.bulk_write(operations, ordered=False)
+
+    async def members(self, session_id: str) -> int:
+        # The TTL monitor only runs every minute, expired counts are skipped
+        async for doc in self.presence.aggregate(
+            [
+                {
+                    "$match": {
+                        "session_id": session_id,
+                        "expires_at": {"$gt": datetime.now(timezone.utc)},
+                    }
+                },
+                {"$group": {"_id": None, "count": {"$sum": "$count"}}},
+            ]
+        ):
+            return doc["count"]
+        return 0
+
+    def _lease(self) -> dict:
+        return {
+            "worker": WORKER_ID,
+            "expires_at": datetime.now(timezone.utc)
+            + timedelta(seconds=settings.WS_RUN_LEASE),
+        }
+
+    async def claim_run(self, session_id: str) -> bool:
+        # Take over an expired lease, or create the first one
+        result = await self.runs.update_one(
+            {
+                "_id": session_id,
+                "expires_at": {"$lte": datetime.now(timezone.utc)},
+            },
+            {"$set": self._lease()},
+        )
+        if result.modified_count:
+            return True
+        try:
+            await self.runs.insert_one({"_id": session_id, **self._lease()})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def renew_run(self, session_id: str) -> bool:
+        result = await self.runs.update_one(
+            {"_id": session_id, "worker": WORKER_ID},
+            {"$set": self._lease()},
+        )
+        return result.matched_count == 1
+
+    async def release_run(self, session_id: str) -> None:
+        await self.runs.delete_one({"_id": session_id, "worker": WORKER_ID})
+
+    async def _tail(self, last_id) -> None:
+        while True:
+            # Resuming after the last frame seen, frames another worker
+            # inserted with an older ObjectId during the same second can be
+            # skipped, clients notice it through seq
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            cursor = self.collection.find(
+                query, cursor_type=CursorType.TAILABLE_AWAIT
+            )
+            try:
+                async for doc in cursor:
+                    last_id = doc["_id"]
+                    if doc.get("session_id") and self.deliver is not None:
+                        for frame in doc["frames"]:
+                            self.deliver(doc["session_id"], frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Session bus cursor lost: {e}")
+            finally:
+                await cursor.close()
+            await asyncio.sleep(settings.WS_BUS_RETRY_INTERVAL)
+
+    async def close(self) -> None:
+        # Write what is still batched before leaving
+        await asyncio.gather(
+            *list(self.flushers.values()), return_exceptions=True
+        )
+        if self.tail_task is not None:
+            self.tail_task.cancel()
+            try:
+                await self.tail_task
+            except asyncio.CancelledError:
+                pass
+            self.tail_task = None
+        await super().close()
+
+
+def create_session_bus(db: AsyncIOMotorDatabase) -> SessionBus:
+    if settings.WS_BUS_BACKEND == "mongo":
+        return MongoCappedBus(db)
+    if settings.WS_BUS_BACKEND != "memory":
+        raise ValueError(
+            f"Unknown session bus {settings.WS_BUS_BACKEND}, "
+            "available ones are memory and mongo"
+        )
+    return InProcessBus()
@@ -13,6 +13,7 @@ from src.api.stripe.crud import get_user_from_id
 from src.api.stripe.models import StripePlan, UserBilling
 from src.core.settings import settings
 from src.db.client import MongoDBClient
+from src.security.entitlements import invalidate_entitlement
 from src.security.oauth import get_current_user
 from src.services.email_constants import (
     onboarding_html_content,
@@ -101,6 +102,7 @@ async def cancel_subscription(
             await user_collection.update_one(
                 {"_id": ObjectId(user_id)}, {"$set": profile.model_dump()}
             )
+            invalidate_entitlement(user_id)
 
             logger.info(
                 f"Subscription canceled successfully for user with ID {user_id}"
@@ -215,6 +217,7 @@ async def stripe_webhook(request: Request):
                 await user_collection.update_one(
                     {"email": customer_email}, {"$set": profile}
                 )
+                invalidate_entitlement(profile["_id"])
 
                 # Send onboardingemail to user
                 user_name = profile["firstname"] + " " + profile["lastname"]
@@ -1,11 +1,12 @@
 from datetime import datetime
-from typing import Any, Dict, List, Literal
+from typing import Any, Dict, List, Literal, Optional
 
 from bson import ObjectId
 from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
+    Query,
     WebSocket,
     WebSocketDisconnect,
     status,
@@ -14,34 +15,35 @@ from loguru import logger
 from pydantic import ValidationError
 
 from src.api.fields import PyObjectId
-from src.core.agents.AsyncMongoDBSaver import AsyncMongoDBSaver
 from src.core.agents.chat_expert import chat_expert
 from src.core.agents.connections import (
     DBConnectionError,
     DBError,
     DBQueryError,
 )
-from src.core.agents.graph import WakilAgent
 from src.core.agents.nodes import LLMUnSupportedError
 from src.core.agents.utils import GraphValidationError
 from src.security.oauth import get_current_user
 
+from .agent_runs import member_left, start_run
 from .crud import (
+    compile_agent,
     create_new_graph,
     delete_graph_by_id,
     delete_session_by_id,
     fetch_chart_data_from_db,
     get_graph_by_id,
     get_graph_by_name_user_id,
+    get_graph_titles,
     get_graphs_user_id,
     get_session_by_id,
     get_sessions_by_id,
     get_user_data,
     get_user_tooltip,
     join_new_session,
-    retrieve_agent,
     retrieve_user_statistics,
     save_graph_to_db,
+    session_thread_id,
     start_new_session,
     update_session,
     update_user_data,
@@ -66,6 +68,21 @@ from .websocket import connection_manager
 router = APIRouter(prefix="/sessions", tags=["Sessions"])
 
 
+def page_params(
+    after: Optional[PyObjectId] = Query(
+        None, description="Id of the last item of the previous page"
+    ),
+    limit: Optional[int] = Query(None, ge=1, le=100),
+    order_by: Literal["id", "created_at"] = "id",
+) -> dict[str, Any]:
+    """Keyset pagination of list endpoints, no limit returns everything"""
+    return {
+        "after": after,
+        "limit": limit,
+        "order_by": "_id" if order_by == "id" else order_by,
+    }
+
+
 @router.post(
     "/",
     description="Initiate session based on data crafted, and of course user_id",
@@ -109,8 +126,9 @@ async def list_sessions() -> list[Session] | None:
 )
 async def list_sessions_of_user(
     user_id: PyObjectId = Depends(get_current_user),
+    page: dict[str, Any] = Depends(page_params),
 ) -> list[Session]:
-    return await get_sessions_by_id(user_id)
+    return await get_sessions_by_id(user_id, **page)
 
 
 @router.get(
@@ -120,17 +138,11 @@ async def list_sessions_of_user(
 async def get_session(
     session_id: PyObjectId, user_id: PyObjectId = Depends(get_current_user)
 ) -> Session | None:
-    ownership_bool = await user_owns_document(
+    session = await user_owns_document(
         Session, document_id=session_id, user_id=user_id
     )
-    if ownership_bool:
-        session = await get_session_by_id(session_id)
-        if session is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Session not found",
-            )
-        return session
+    if session:
+        return Session(**session)
 
     # Raise a 403 Forbidden error if the user does not own the document
     raise HTTPException(
@@ -210,6 +222,26 @@ async def websocket_session_endpoint(
             )
             return"""
 
+        # Load the agent before accepting, the message loop never compiles
+        agent = session.agent and await get_graph_by_id(session.agent.id)
+        if not agent:
+            await websocket.close(
+                code=status.WS_1008_POLICY_VIOLATION,
+                reason="Session has no agent",
+            )
+            return
+        try:
+            compiled_agent = await compile_agent(agent)
+        except Exception as e:
+            logger.error(f"Cannot compile agent of session {session_id}: {e}")
+            await websocket.close(
+                code=status.WS_1011_INTERNAL_ERROR,
+                reason="Agent cannot be loaded",
+            )
+            return
+
+        thread_id = session_thread_id(session_id, agent)
+
         # Connect to session
         await connection_manager.connect(websocket, session_id)
 
@@ -217,18 +249,40 @@ async def websocket_session_endpoint(
             # Receive data from client
             try:
                 data = await websocket.receive_json()
-            except ValidationError:
-                await websocket.send_json({"error": "Invalid data format"})
+            except (ValidationError, ValueError):
+                connection_manager.reply(
+                    websocket,
+                    session_id,
+                    {"type": "error", "detail": "Invalid data format"},
+                )
                 continue
 
-            # Process data based on session type
-            updated_state = session.agent.invoke(data.state)
+            message = data.get("message") if isinstance(data, dict) else None
+            if not isinstance(message, str) or not message:
+                connection_manager.reply(
+                    websocket,
+                    session_id,
+                    {"type": "error", "detail": "Expected a message"},
+                )
+                continue
 
-            # Broadcast updated state to all users
-            await connection_manager.broadcast_session(updated_state)
+            # Answer is streamed to every member as tokens and tool frames
+            run = await start_run(
+                str(session_id),
+                thread_id,
+                compiled_agent,
+                {"messages": [("human", message)]},
+                announce={"type": "human", "content": message},
+            )
+            if run is None:
+                connection_manager.reply(
+                    websocket,
+                    session_id,
+                    {"type": "error", "detail": "Agent is already answering"},
+                )
 
     except WebSocketDisconnect:
-        connection_manager.disconnect(websocket, session_id)
+        pass
 
     except Exception as e:
         await websocket.close(
@@ -237,6 +291,19 @@ async def websocket_session_endpoint(
         # Log the exception
         print(f"Error occurred: {e}")
 
+    finally:
+        connection_manager.disconnect(websocket, session_id)
+        # Nobody left to read the answer, on any worker
+        await member_left(str(session_id))
+
+
+@router.get(
+    "/ws/stats",
+    description="Connections and broadcast latencies of live sessions",
+)
+async def get_websocket_stats(_: PyObjectId = Depends(get_current_user)):
+    return connection_manager.get_stats()
+
 
 @router.delete(
     "/graph/{graph_id}",
@@ -261,8 +328,12 @@ async def delete_graph(
 @router.get("/get_graphs", description="Listing Agents based on user_id")
 async def get_graphs(
     user_id: PyObjectId = Depends(get_current_user),
+    page: dict[str, Any] = Depends(page_params),
+    include_graph: bool = Query(
+        True, description="Set to false to leave out nodes and edges"
+    ),
 ) -> list[Agent]:
-    return await get_graphs_user_id(user_id)
+    return await get_graphs_user_id(user_id, include_graph, **page)
 
 
 @router.get(
@@ -271,8 +342,7 @@ async def get_graphs(
 async def get_graph_names(
     user_id: PyObjectId = Depends(get_current_user),
 ) -> list[str]:
-    graphs = await get_graphs_user_id(user_id)
-    return [graph["title"] for graph in graphs]
+    return await get_graph_titles(user_id)
 
 
 @router.delete(
@@ -401,13 +471,10 @@ async def get_graph_through_name_and_user_id(
 async def get_agent(
     graph_id: PyObjectId, user_id: PyObjectId = Depends(get_current_user)
 ) -> Agent:
-    ownership_bool = await user_owns_document(
+    agent = await user_owns_document(
         Agent, document_id=graph_id, user_id=user_id
     )
-    if ownership_bool:
-        agent = await retrieve_agent(graph_id)
-        if agent is None:
-            return []
+    if agent:
         if "graph" not in agent or agent["graph"] is None:
             agent |= {"graph": {"nodes": [], "edges": []}}
         return Agent(**agent)
@@ -464,11 +531,10 @@ async def publish_graph(
     """
     # print(user_id)
 
-    ownership_bool = await user_owns_document(
+    agent = await user_owns_document(
         Agent, document_id=graph_id, user_id=user_id
     )
-    if ownership_bool:
-        agent = await retrieve_agent(graph_id)
+    if agent:
         if agent["graph"] == graph and agent["publish"]["published"]:
             raise HTTPException(
                 status_code=400,
@@ -492,22 +558,14 @@ async def publish_graph(
             detail="You do not have permission to modify this graph",
         )
     # Do something with result
-    # Retrieve Agent
-    agent = await retrieve_agent(graph_id)
-    agent_compiled = WakilAgent()  # FIX Coroutine and not awaiting error²
     # logger.info(graph)
     try:
-        await agent_compiled.intialize(Agent(**agent))
-        async with AsyncMongoDBSaver.from_conn_info() as checkpointer:
-            compiled_agent = await agent_compiled.build_agent(
-                checkpointer=checkpointer
-            )
-            _ = await agent_compiled.draw_agent()
+        _ = await compile_agent(Agent(**agent))
 
-            # Send blob to S3 - Doesn't work
-            # await send_agent_to_cloud(
-            #    compiled_agent, user_id=user_id, graph_id=graph_id
-            # )
+        # Send blob to S3 - Doesn't work
+        # await send_agent_to_cloud(
+        #    compiled_agent, user_id=user_id, graph_id=graph_id
+        # )
     except GraphValidationError as e:
         logger.error(e)
         raise HTTPException(status_code=400, detail=e.detail)
@@ -548,11 +606,11 @@ async def chat_with_expert(
     messages: ChatHistory,
     user_id: PyObjectId = Depends(get_current_user),
 ) -> ChatResponse:
-    ownership_bool = await user_owns_document(
+    agent = await user_owns_document(
         Agent, document_id=graph_id, user_id=user_id
     )
-    if ownership_bool:
-        graph = await get_graph_by_id(graph_id)
+    if agent:
+        graph = Agent(**agent)
         result = await chat_expert(
             graph=graph.graph,
             prompt=messages.messages[-1],
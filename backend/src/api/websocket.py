@@ -1,33 +1,276 @@
-from collections import defaultdict
-from typing import Any
+"""
+Session broadcasts to WebSocket clients. Frames are encoded once per
+broadcast and queued on each connection, whose own sender task writes
+them, so a slow client only delays itself. A client whose queue is full
+is disconnected instead of buffering without bound.
 
-from fastapi import WebSocket
+Broadcasts go through the session bus, which delivers them to the
+members connected to every worker. Member counts of this worker are
+reported to the bus on connection, and refreshed in the background.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+from collections import deque
+from typing import Any, Optional
+
+from fastapi import WebSocket, status
+from loguru import logger
+
+from src.core.settings import settings
 
 from .fields import PyObjectId
 from .models import Session
+from .session_bus import InProcessBus, SessionBus
+
+
+class FanoutStats:
+    """Delivery counters and latencies (broadcast to socket write) of a session"""
+
+    def __init__(self, samples: int = 1000) -> None:
+        self.broadcasts = 0
+        self.delivered = 0
+        self.evicted = 0
+        self.failed = 0
+        self.latencies: deque[float] = deque(maxlen=samples)
+
+    def record(self, latency: float) -> None:
+        self.delivered += 1
+        self.latencies.append(latency)
+
+    def as_dict(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        percentiles = {}
+        if len(latencies) >= 2:
+            cuts = statistics.quantiles(latencies, n=100)
+            percentiles = {
+                "latency_p50_ms": cuts[49] * 1000,
+                "latency_p95_ms": cuts[94] * 1000,
+            }
+        return {
+            "broadcasts": self.broadcasts,
+            "delivered": self.delivered,
+            "evicted": self.evicted,
+            "failed": self.failed,
+            "latency_max_ms": latencies[-1] * 1000 if latencies else None,
+        } | percentiles
+
+
+class Connection:
+    """A client socket with its bounded outbound queue and sender task"""
+
+    def __init__(
+        self,
+        manager: "ConnectionManager",
+        websocket: WebSocket,
+        session_id: str,
+    ) -> None:
+        self.manager = manager
+        self.websocket = websocket
+        self.session_id = session_id
+        self.queue: asyncio.Queue[tuple[str, float]] = asyncio.Queue(
+            maxsize=settings.WS_SEND_QUEUE_SIZE
+        )
+        self.sender: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.sender = asyncio.create_task(self._send_loop())
+
+    def offer(self, text: str, queued_at: float) -> bool:
+        """Queue a frame, False when the client is not keeping up"""
+        try:
+            self.queue.put_nowait((text, queued_at))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _send_loop(self) -> None:
+        stats = self.manager.session_stats(self.session_id)
+        while True:
+            text, queued_at = await self.queue.get()
+            try:
+                await asyncio.wait_for(
+                    self.websocket.send_text(text),
+                    timeout=settings.WS_SEND_TIMEOUT,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Dead or stuck socket, the receive loop of the endpoint
+                # notices the disconnection on its side
+                logger.info(f"Dropping websocket of {self.session_id}: {e}")
+                stats.failed += 1
+                self.manager.disconnect(self.websocket, self.session_id)
+                return
+            stats.record(time.perf_counter() - queued_at)
+
+    def stop(self) -> None:
+        if (
+            self.sender is not None
+            and self.sender is not asyncio.current_task()
+        ):
+            self.sender.cancel()
 
 
 class ConnectionManager:
-    def __init__(self) -> None:
-        self.sessions: dict[PyObjectId, Any] = defaultdict(
-            lambda: defaultdict(list)
+    """Session ids are kept as strings, as carried by the bus"""
+
+    def __init__(self, bus: Optional[SessionBus] = None) -> None:
+        self.sessions: dict[str, dict[WebSocket, Connection]] = {}
+        self.stats: dict[str, FanoutStats] = {}
+        self.bus = bus or InProcessBus()
+        # Sessions whose member count changed since the last report
+        self.presence_dirty: set[str] = set()
+        self.presence_changed = asyncio.Event()
+        self.presence_task: Optional[asyncio.Task] = None
+
+    async def start(self, bus: Optional[SessionBus] = None) -> None:
+        if bus is not None:
+            self.bus = bus
+        await self.bus.start(self.broadcast)
+        self.presence_task = asyncio.create_task(self._report_presence())
+
+    async def sync_members(self, session_id: PyObjectId) -> None:
+        """Report the members of the session on this worker right away"""
+        session_id = str(session_id)
+        await self.bus.set_members(
+            {session_id: len(self.sessions.get(session_id, {}))}
         )
 
+    async def _report_presence(self) -> None:
+        """
+        Reports changed counts, and every WS_PRESENCE_INTERVAL all of them
+        so they don't expire while the worker is alive
+        """
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.presence_changed.wait(),
+                    timeout=settings.WS_PRESENCE_INTERVAL,
+                )
+            except asyncio.TimeoutError:
+                self.presence_dirty |= set(self.sessions)
+            self.presence_changed.clear()
+            dirty, self.presence_dirty = self.presence_dirty, set()
+            try:
+                await self.bus.set_members(
+                    {
+                        session_id: len(self.sessions.get(session_id, {}))
+                        for session_id in dirty
+                    }
+                )
+            except Exception as e:
+                logger.warning(f"Cannot report session members: {e}")
+                self.presence_dirty |= dirty
+
+    def session_stats(self, session_id: str) -> FanoutStats:
+        return self.stats.setdefault(session_id, FanoutStats())
+
     async def connect(
         self, websocket: WebSocket, session_id: PyObjectId
     ) -> None:
         await websocket.accept()
-        self.sessions[session_id]["users"].append(websocket)
+        connection = Connection(self, websocket, str(session_id))
+        self.sessions.setdefault(str(session_id), {})[websocket] = connection
+        connection.start()
+        await self.sync_members(session_id)
 
     def disconnect(self, websocket: WebSocket, session_id: PyObjectId) -> None:
-        players = self.sessions[session_id]["users"]  # safe due to defaultdict
-        if websocket in players:
-            players.remove(websocket)
+        """Safe to call several times, and from the sender task itself"""
+        session_id = str(session_id)
+        members = self.sessions.get(session_id, {})
+        connection = members.pop(websocket, None)
+        if connection is not None:
+            connection.stop()
+            self.presence_dirty.add(session_id)
+            self.presence_changed.set()
+        if not members:
+            self.sessions.pop(session_id, None)
+            self.stats.pop(session_id, None)
+
+    def _evict(self, connection: Connection) -> None:
+        self.session_stats(connection.session_id).evicted += 1
+        self.disconnect(connection.websocket, connection.session_id)
+        logger.warning(
+            f"Evicting slow websocket client of {connection.session_id}"
+        )
+        asyncio.create_task(self._close(connection.websocket))
+
+    async def _close(self, websocket: WebSocket) -> None:
+        try:
+            await asyncio.wait_for(
+                websocket.close(
+                    code=status.WS_1013_TRY_AGAIN_LATER,
+                    reason="Client too slow",
+                ),
+                timeout=settings.WS_SEND_TIMEOUT,
+            )
+        except Exception:
+            pass
+
+    def broadcast(self, session_id: str, text: str) -> int:
+        """
+        Queue an encoded frame for every member connected to this worker,
+        returns the recipients. Called by the bus
+        """
+        members = list(self.sessions.get(session_id, {}).values())
+        if not members:
+            return 0
+        self.session_stats(session_id).broadcasts += 1
+        queued_at = time.perf_counter()
+        recipients = 0
+        for connection in members:
+            if connection.offer(text, queued_at):
+                recipients += 1
+            else:
+                self._evict(connection)
+        return recipients
 
     async def broadcast_session(self, session: Session) -> None:
-        json_data = session.model_dump_json()
-        for connection in self.sessions[session.id]["users"]:
-            await connection.send_json(json_data)
+        """Publish the session to its members on all workers"""
+        await self.bus.publish(str(session.id), session.model_dump_json())
+
+    async def publish(self, session_id: PyObjectId, payload: Any) -> None:
+        """Publish any JSON serializable payload (agent frames...)"""
+        await self.bus.publish(
+            str(session_id), json.dumps(payload, default=str)
+        )
+
+    def reply(
+        self, websocket: WebSocket, session_id: PyObjectId, payload: Any
+    ) -> None:
+        """
+        Frame for one client only, queued like broadcasts so that it
+        never races with the sender task on the socket
+        """
+        connection = self.sessions.get(str(session_id), {}).get(websocket)
+        if connection is not None and not connection.offer(
+            json.dumps(payload, default=str), time.perf_counter()
+        ):
+            self._evict(connection)
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            session_id: stats.as_dict()
+            | {"connections": len(self.sessions.get(session_id, {}))}
+            for session_id, stats in self.stats.items()
+        }
+
+    async def close(self) -> None:
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+            self.presence_task = None
+        for session_id, members in list(self.sessions.items()):
+            for websocket in list(members):
+                self.disconnect(websocket, session_id)
+        # This worker's members are gone for the other workers too
+        try:
+            await self.bus.set_members(dict.fromkeys(self.presence_dirty, 0))
+        except Exception as e:
+            logger.warning(f"Cannot report session members: {e}")
+        await self.bus.close()
 
 
 connection_manager = ConnectionManager()
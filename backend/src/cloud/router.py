@@ -1,12 +1,20 @@
 import os
 import uuid
 
-import boto3
-from fastapi import APIRouter, Depends, File, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    UploadFile,
+    status,
+)
 from loguru import logger
 
 from src.api.fields import PyObjectId
+from src.cloud.s3 import UploadTooLargeError, s3_key_from_url, s3_service
 from src.cloud.utils import create_presigned_url
+from src.core.agents.extraction_cache import extraction_cache
 from src.core.settings import settings
 from src.security.oauth import get_current_user
 
@@ -21,21 +29,11 @@ async def upload_image(
     user_id: PyObjectId = Depends(get_current_user),
 ):
     try:
-        # Connect to AWS S3
-        s3_client = boto3.client(
-            "s3",
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_REGION_NAME,
-        )
-
-        s3_client.upload_fileobj(
-            file.file, settings.S3_BUCKET_NAME, file.filename
-        )
+        await s3_service.upload_fileobj(file.file, file.filename)
 
         # Generate Presigned URL of the uploaded image
         # image_url = f"https://{settings.S3_BUCKET_NAME}.s3.{settings.AWS_REGION_NAME}.amazonaws.com/{file.filename}"
-        presigned_image_url = create_presigned_url(
+        presigned_image_url = await create_presigned_url(
             bucket_name=settings.S3_BUCKET_NAME, object_name=file.filename
         )
 
@@ -54,25 +52,28 @@ async def upload_file(
     user_id: PyObjectId = Depends(get_current_user),
 ):
     try:
-        s3_client = boto3.client(
-            "s3",
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_REGION_NAME,
-        )
-
         # Generate a new file name with UUID
         name, extension = os.path.splitext(file.filename)
         filename = f"{name}_{uuid.uuid4().hex}{extension}"
 
-        s3_client.upload_fileobj(file.file, settings.S3_BUCKET_NAME, filename)
+        if file.size is not None and file.size > settings.MAX_UPLOAD_SIZE:
+            raise UploadTooLargeError(
+                f"File exceeds the maximum size of {settings.MAX_UPLOAD_SIZE} bytes"
+            )
+        # Streamed part by part, never holding the whole file in memory
+        await s3_service.upload_stream(file.read, filename)
 
-        presigned_file_url = create_presigned_url(
+        presigned_file_url = await create_presigned_url(
             bucket_name=settings.S3_BUCKET_NAME, object_name=filename
         )
 
         return {"url": presigned_file_url}
 
+    except UploadTooLargeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=e.detail,
+        )
     except Exception as e:
         logger.error("Error uploading file to S3")
         return {"error": str(e)}
@@ -83,15 +84,10 @@ async def delete_file(
     filename: str,
     user_id: PyObjectId = Depends(get_current_user),
 ):
-    file_name = filename.rsplit("/", 1)[-1].split("?", 1)[0]
+    file_name = s3_key_from_url(filename)
     try:
-        s3_client = boto3.client(
-            "s3",
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_REGION_NAME,
-        )
-        s3_client.delete_object(Bucket=settings.S3_BUCKET_NAME, Key=file_name)
+        await s3_service.delete_objects([file_name])
+        await extraction_cache.invalidate([file_name])
 
         return {"message": "File deleted successfully"}
 
@@ -0,0 +1,197 @@
+"""
+Async S3 service, sharing one pooled client for the whole app lifetime
+"""
+
+import asyncio
+from contextlib import AsyncExitStack
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional
+
+import aioboto3
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
+from loguru import logger
+
+from src.core.settings import settings
+
+# S3 accepts at most 1000 keys per DeleteObjects request
+DELETE_OBJECTS_BATCH_SIZE = 1000
+
+
+class UploadTooLargeError(Exception):
+    def __init__(self, detail: str):
+        self.detail = detail
+        super().__init__(self.detail)
+
+
+def s3_key_from_url(url: str) -> str:
+    """Extract the object key from an S3 (presigned) URL"""
+    return url.rsplit("/", 1)[-1].split("?", 1)[0]
+
+
+class S3Service:
+    """
+    Thin async wrapper around an aioboto3 S3 client.
+    Point S3_ENDPOINT_URL to a local S3 stand-in (MinIO, moto server...)
+    to run it without AWS.
+    """
+
+    def __init__(self, bucket: Optional[str] = None):
+        self.bucket = bucket or settings.S3_BUCKET_NAME
+        self._session = aioboto3.Session(
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_REGION_NAME,
+        )
+        self._exit_stack: Optional[AsyncExitStack] = None
+        self._client: Any = None
+        self._lock = asyncio.Lock()
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=settings.S3_MAX_CONCURRENCY,
+        )
+
+    async def start(self) -> None:
+        async with self._lock:
+            if self._client is not None:
+                return
+            self._exit_stack = AsyncExitStack()
+            self._client = await self._exit_stack.enter_async_context(
+                self._session.client(
+                    "s3",
+                    endpoint_url=settings.S3_ENDPOINT_URL,
+                    config=AioConfig(
+                        max_pool_connections=settings.S3_MAX_CONNECTIONS
+                    ),
+                )
+            )
+            logger.info("S3 client initialized")
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._exit_stack is not None:
+                await self._exit_stack.aclose()
+            self._exit_stack = None
+            self._client = None
+
+    async def client(self) -> Any:
+        if self._client is None:
+            await self.start()
+        return self._client
+
+    async def upload_fileobj(self, fileobj: IO[bytes], key: str) -> None:
+        """Upload a file object, in parallel parts when it is large"""
+        client = await self.client()
+        await client.upload_fileobj(
+            fileobj, self.bucket, key, Config=self.transfer_config
+        )
+
+    async def upload_stream(
+        self,
+        read: Callable[[int], Awaitable[bytes]],
+        key: str,
+        part_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ) -> int:
+        """
+        Upload whatever read(n) returns until it returns b"", part by part,
+        so that at most one part is held in memory whatever the file size.
+        Aborts the upload and raises UploadTooLargeError past max_size.
+
+        Returns:
+            int: The number of bytes uploaded.
+        """
+        client = await self.client()
+        part_size = part_size or settings.S3_UPLOAD_PART_SIZE
+        max_size = max_size or settings.MAX_UPLOAD_SIZE
+
+        chunk = await read(part_size)
+        if len(chunk) < part_size:
+            # Fits in a single part, no need for a multipart upload
+            if len(chunk) > max_size:
+                raise UploadTooLargeError(
+                    f"File exceeds the maximum size of {max_size} bytes"
+                )
+            await client.put_object(Bucket=self.bucket, Key=key, Body=chunk)
+            return len(chunk)
+
+        upload = await client.create_multipart_upload(
+            Bucket=self.bucket, Key=key
+        )
+        upload_id = upload["UploadId"]
+        parts = []
+        size = 0
+        try:
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLargeError(
+                        f"File exceeds the maximum size of {max_size} bytes"
+                    )
+                part = await client.upload_part(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=chunk,
+                )
+                parts.append(
+                    {"PartNumber": len(parts) + 1, "ETag": part["ETag"]}
+                )
+                chunk = await read(part_size)
+
+            await client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            await client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+            raise
+        return size
+
+    async def etag(self, key: str) -> str:
+        """ETag of an object, changes whenever its content does"""
+        client = await self.client()
+        response = await client.head_object(Bucket=self.bucket, Key=key)
+        return response["ETag"].strip('"')
+
+    async def put_object(self, key: str, body: bytes) -> Dict[str, Any]:
+        client = await self.client()
+        return await client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    async def delete_objects(self, keys: List[str]) -> List[str]:
+        """Delete objects by batches, returns the keys actually deleted"""
+        client = await self.client()
+        deleted = []
+        for start in range(0, len(keys), DELETE_OBJECTS_BATCH_SIZE):
+            batch = keys[start : start + DELETE_OBJECTS_BATCH_SIZE]
+            response = await client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in batch],
+                    "Quiet": False,
+                },
+            )
+            deleted += [obj["Key"] for obj in response.get("Deleted", [])]
+            for error in response.get("Errors", []):
+                logger.warning(
+                    f"Failed to delete {error['Key']} from S3: {error['Message']}"
+                )
+        return deleted
+
+    async def presigned_url(
+        self, key: str, expiration: int = 360000, bucket: Optional[str] = None
+    ) -> str:
+        client = await self.client()
+        return await client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket or self.bucket, "Key": key},
+            ExpiresIn=expiration,
+        )
+
+
+s3_service = S3Service()
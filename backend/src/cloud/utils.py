@@ -1,14 +1,17 @@
-import aiohttp
-import boto3
+from typing import BinaryIO
+
 import dill as pickle
+from botocore.exceptions import ClientError
 from langgraph.graph.state import CompiledStateGraph
 from loguru import logger
 
 from src.api.fields import PyObjectId
+from src.cloud.s3 import s3_service
+from src.core.clients import get_http_session
 from src.core.settings import settings
 
 
-def create_presigned_url(bucket_name, object_name, expiration=360000):
+async def create_presigned_url(bucket_name, object_name, expiration=360000):
     """Generate a presigned URL to share an S3 object
 
     :param bucket_name: string
@@ -16,23 +19,12 @@ def create_presigned_url(bucket_name, object_name, expiration=360000):
     :param expiration: Time in seconds for the presigned URL to remain valid
     :return: Presigned URL as string. If error, returns None.
     """
-
-    # Create an asynchronous S3 client
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_REGION_NAME,
-    )
-
     try:
         # Generate a presigned URL for the S3 object
-        response = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": object_name},
-            ExpiresIn=expiration,
+        response = await s3_service.presigned_url(
+            object_name, expiration=expiration, bucket=bucket_name
         )
-    except boto3.ClientError as e:
+    except ClientError as e:
         logger.error(e)
         return None
 
@@ -46,22 +38,14 @@ async def send_agent_to_cloud(
     """
     Serialize CompiledStateGraph and send it to S3.
     """
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_REGION_NAME,
-    )
-
     try:
         # Serialize the CompiledStateGraph instance
         serialized_agent = pickle.dumps(agent)
 
         # Upload to S3
-        response = s3_client.put_object(
-            Bucket=settings.S3_BUCKET_NAME,
-            Key=f"agent_{graph_id}_user_{user_id}.pkl",
-            Body=serialized_agent,
+        response = await s3_service.put_object(
+            key=f"agent_{graph_id}_user_{user_id}.pkl",
+            body=serialized_agent,
         )
     except Exception as e:
         logger.error(e)
@@ -70,13 +54,29 @@ async def send_agent_to_cloud(
     return response
 
 
-async def fetch_blob_from_s3(url):
-    """Fetch blob data from S3 using the presigned URL asynchronously."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.read()  # Returns the blob data
-            else:
+async def fetch_blob_from_s3(url: str, file: BinaryIO) -> int:
+    """
+    Stream blob data from S3 using the presigned URL asynchronously,
+    chunk by chunk into the given file, which is flushed once done.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    session = get_http_session()
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise Exception(
+                f"Failed to fetch blob: {response.status} {await response.text()}"
+            )
+        size = 0
+        async for chunk in response.content.iter_chunked(
+            settings.DOWNLOAD_CHUNK_SIZE
+        ):
+            size += len(chunk)
+            if size > settings.MAX_UPLOAD_SIZE:
                 raise Exception(
-                    f"Failed to fetch blob: {response.status} {await response.text()}"
+                    f"Blob exceeds the maximum size of {settings.MAX_UPLOAD_SIZE} bytes"
                 )
+            file.write(chunk)
+    file.flush()
+    return size
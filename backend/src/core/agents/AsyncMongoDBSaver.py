@@ -1,5 +1,22 @@
+import asyncio
+import itertools
+import random
+import re
+import weakref
+from collections import defaultdict
 from contextlib import asynccontextmanager
-from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from langchain_core.runnables import RunnableConfig
 from langgraph.checkpoint.base import (
@@ -8,17 +25,218 @@ from langgraph.checkpoint.base import (
     Checkpoint,
     CheckpointMetadata,
     CheckpointTuple,
+    copy_checkpoint,
     get_checkpoint_id,
 )
+from loguru import logger
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo import UpdateOne
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
 
+from src.core.agents.codecs import decode, encode, get_codec
+from src.core.cache import LRUCache
 from src.core.settings import (
     MONGODB_MAXPOOLSIZE,
     MONGODB_MINPOOLSIZE,
     settings,
 )
 
+CHECKPOINTS_COLLECTION = "checkpoints"
+WRITES_COLLECTION = "checkpoint_writes"
+BLOBS_COLLECTION = "checkpoint_blobs"
+
+# Every lookup of the saver goes through one of these
+CHECKPOINT_INDEXES = {
+    CHECKPOINTS_COLLECTION: [
+        IndexModel(
+            [
+                ("thread_id", ASCENDING),
+                ("checkpoint_ns", ASCENDING),
+                ("checkpoint_id", DESCENDING),
+            ],
+            unique=True,
+        )
+    ],
+    WRITES_COLLECTION: [
+        IndexModel(
+            [
+                ("thread_id", ASCENDING),
+                ("checkpoint_ns", ASCENDING),
+                ("checkpoint_id", ASCENDING),
+                ("task_id", ASCENDING),
+                ("idx", ASCENDING),
+            ],
+            unique=True,
+        )
+    ],
+    BLOBS_COLLECTION: [
+        IndexModel(
+            [
+                ("thread_id", ASCENDING),
+                ("checkpoint_ns", ASCENDING),
+                ("key", ASCENDING),
+            ],
+            unique=True,
+        )
+    ],
+}
+
+# Checkpoints stored without their channel values, which are in
+# BLOBS_COLLECTION once per channel version. Older documents have no format
+DELTA_FORMAT = "delta"
+
+
+def blob_key(channel: str, version: Any) -> str:
+    return f"{channel}|{version}"
+
+
+def format_version(number: int, suffix: float = 0.0) -> str:
+    """
+    Channel versions sort as strings, the random suffix tells apart the
+    values written by branches forked from the same checkpoint
+    """
+    return f"{number:032}.{suffix:016}"
+
+
+def version_number(version: Any) -> int:
+    if version is None:
+        return 0
+    if isinstance(version, int):
+        return version
+    return int(str(version).split(".")[0])
+
+
+def normalize_versions(checkpoint: Checkpoint) -> Checkpoint:
+    """
+    Checkpoints saved before versions were strings hold integer versions,
+    which don't compare with the new ones
+    """
+
+    def normalize(versions: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            channel: format_version(version)
+            if isinstance(version, int)
+            else version
+            for channel, version in versions.items()
+        }
+
+    checkpoint["channel_versions"] = normalize(checkpoint["channel_versions"])
+    checkpoint["versions_seen"] = {
+        node: normalize(versions)
+        for node, versions in checkpoint["versions_seen"].items()
+    }
+    return checkpoint
+
+
+# Threads whose latest channel versions all have a blob, per process
+delta_threads = LRUCache(maxsize=10_000)
+
+# Joins the channel values of each checkpoint, on the blob keys it lists
+BLOBS_LOOKUP = {
+    "$lookup": {
+        "from": BLOBS_COLLECTION,
+        "localField": "blob_keys",
+        "foreignField": "key",
+        "let": {
+            "thread_id": "$thread_id",
+            "checkpoint_ns": "$checkpoint_ns",
+        },
+        "pipeline": [
+            {
+                "$match": {
+                    "$expr": {
+                        "$and": [
+                            {"$eq": ["$thread_id", "$$thread_id"]},
+                            {"$eq": ["$checkpoint_ns", "$$checkpoint_ns"]},
+                        ]
+                    }
+                }
+            },
+        ],
+        "as": "blobs",
+    }
+}
+
+
+# Bulk writes of a flush run in this order, so that a checkpoint
+# is never visible before its channel values
+FLUSH_ORDER = (BLOBS_COLLECTION, WRITES_COLLECTION, CHECKPOINTS_COLLECTION)
+
+Operations = Dict[str, List[UpdateOne]]
+
+# Savers in write-behind mode, flushed on shutdown
+write_behind_savers: "weakref.WeakSet[AsyncMongoDBSaver]" = weakref.WeakSet()
+
+
+@dataclass
+class WriteBuffer:
+    """
+    Operations of one thread not written to MongoDB yet, along with the
+    checkpoints and writes they hold so reads can be served from here.
+    Entries are tagged with a sequence number to know which ones a flush
+    wrote, since more can be buffered while it runs.
+    """
+
+    operations: Operations = field(default_factory=lambda: defaultdict(list))
+    # checkpoint_id -> (seq, checkpoint, metadata, parent_checkpoint_id)
+    checkpoints: Dict[str, tuple] = field(default_factory=dict)
+    # checkpoint_id -> (task_id, idx) -> (seq, channel, value)
+    writes: Dict[str, Dict[tuple, tuple]] = field(
+        default_factory=lambda: defaultdict(dict)
+    )
+    sequence: itertools.count = field(default_factory=itertools.count)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    timer: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return sum(len(ops) for ops in self.operations.values())
+
+    @property
+    def empty(self) -> bool:
+        return not (self.size or self.checkpoints or self.writes or self.timer)
+
+    def take_operations(self) -> tuple[Operations, int]:
+        operations, self.operations = self.operations, defaultdict(list)
+        return operations, next(self.sequence)
+
+    def restore_operations(self, operations: Operations) -> None:
+        for collection, ops in operations.items():
+            self.operations[collection][:0] = ops
+
+    def forget(self, flushed: int) -> None:
+        """Drop entries a flush wrote"""
+        self.checkpoints = {
+            checkpoint_id: entry
+            for checkpoint_id, entry in self.checkpoints.items()
+            if entry[0] > flushed
+        }
+        for checkpoint_id, writes in list(self.writes.items()):
+            for key in [key for key, w in writes.items() if w[0] <= flushed]:
+                del writes[key]
+            if not writes:
+                del self.writes[checkpoint_id]
+
+    def pending_writes(self, checkpoint_id: str) -> Dict[tuple, tuple]:
+        """(task_id, idx) -> (task_id, channel, value)"""
+        writes = self.writes.get(checkpoint_id, {})
+        return {
+            key: (key[0], channel, value)
+            for key, (_, channel, value) in writes.items()
+        }
+
+
+def checkpoints_db() -> AsyncIOMotorDatabase:
+    """Checkpoints database, on the app's MongoDB client and its pool"""
+    from src.db.client import MongoDBClient
+
+    return MongoDBClient().mongodb.client[settings.CHECKPOINT_DB]
+
+
+async def flush_checkpointers() -> None:
+    """Flush every saver in write-behind mode, on shutdown"""
+    for saver in list(write_behind_savers):
+        await saver.flush()
+
 
 class AsyncMongoDBSaver(BaseCheckpointSaver):
     """A checkpoint saver that stores checkpoints in a MongoDB database asynchronously."""
@@ -26,27 +244,262 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
     client: AsyncIOMotorClient
     db: AsyncIOMotorDatabase
 
-    def __init__(self, db_name: str = "ai_saas") -> None:
+    def __init__(
+        self,
+        db: Optional[AsyncIOMotorDatabase] = None,
+        *,
+        db_name: Optional[str] = None,
+        write_behind: Optional[bool] = None,
+        codec: Optional[str] = None,
+    ) -> None:
+        """
+        Checkpoints are stored in db, usually from the app's client (see
+        checkpoints_db). Without one the saver opens its own client,
+        released by aclose or when used as an async context manager.
+
+        In write-behind mode, aput and aput_writes only buffer operations,
+        flushed per thread after CHECKPOINT_FLUSH_INTERVAL or once
+        CHECKPOINT_FLUSH_SIZE operations are pending, see flush
+
+        Payloads of CHECKPOINT_COMPRESSION_THRESHOLD bytes or more are
+        compressed with codec, CHECKPOINT_CODEC by default
+        """
         super().__init__()
-        self.client = AsyncIOMotorClient(
-            settings.MONGO_DB_URL,
-            maxPoolSize=MONGODB_MAXPOOLSIZE,
-            minPoolSize=MONGODB_MINPOOLSIZE,
-            uuidRepresentation="standard",
+        self.owns_client = db is None
+        if db is None:
+            self.client = AsyncIOMotorClient(
+                settings.MONGO_DB_URL,
+                maxPoolSize=MONGODB_MAXPOOLSIZE,
+                minPoolSize=MONGODB_MINPOOLSIZE,
+                uuidRepresentation="standard",
+            )
+            db = self.client[db_name or settings.CHECKPOINT_DB]
+        else:
+            self.client = db.client
+        self.db = db
+        self.write_behind = (
+            settings.CHECKPOINT_WRITE_BEHIND
+            if write_behind is None
+            else write_behind
         )
-        self.db = self.client[db_name]
+        self.codec = get_codec(codec or settings.CHECKPOINT_CODEC).name
+        self.compression_threshold = settings.CHECKPOINT_COMPRESSION_THRESHOLD
+        self.buffers: Dict[Tuple[str, str], WriteBuffer] = {}
+        if self.write_behind:
+            write_behind_savers.add(self)
+
+    async def __aenter__(self) -> "AsyncMongoDBSaver":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Write buffered operations, then close the client if owned"""
+        try:
+            await self.flush()
+        finally:
+            write_behind_savers.discard(self)
+            if self.owns_client:
+                self.client.close()
 
     @classmethod
     @asynccontextmanager
     async def from_conn_info(
-        cls, db_name: str = "ai_saas"
+        cls,
+        db: Optional[AsyncIOMotorDatabase] = None,
+        *,
+        db_name: Optional[str] = None,
+        write_behind: Optional[bool] = None,
     ) -> AsyncIterator["AsyncMongoDBSaver"]:
-        client = None
+        async with cls(
+            db, db_name=db_name, write_behind=write_behind
+        ) as saver:
+            yield saver
+
+    async def _bulk_write(self, operations: Operations) -> None:
+        for collection in FLUSH_ORDER:
+            if operations.get(collection):
+                await self.db[collection].bulk_write(operations[collection])
+
+    def _buffer(self, thread_id: str, checkpoint_ns: str) -> WriteBuffer:
+        key = (thread_id, checkpoint_ns)
+        if key not in self.buffers:
+            self.buffers[key] = WriteBuffer()
+        return self.buffers[key]
+
+    async def _schedule_flush(
+        self, thread_id: str, checkpoint_ns: str
+    ) -> None:
+        buffer = self._buffer(thread_id, checkpoint_ns)
+        if buffer.size >= settings.CHECKPOINT_FLUSH_SIZE:
+            await self._flush_thread(thread_id, checkpoint_ns)
+        elif buffer.timer is None:
+            buffer.timer = asyncio.create_task(
+                self._flush_later(thread_id, checkpoint_ns)
+            )
+
+    async def _flush_later(
+        self,
+        thread_id: str,
+        checkpoint_ns: str,
+        delay: Optional[float] = None,
+    ) -> None:
+        delay = delay or settings.CHECKPOINT_FLUSH_INTERVAL
+        await asyncio.sleep(delay)
+        buffer = self.buffers.get((thread_id, checkpoint_ns))
+        if buffer is not None and buffer.timer is asyncio.current_task():
+            # Not sleeping anymore, the flush must not get cancelled
+            buffer.timer = None
         try:
-            yield AsyncMongoDBSaver(db_name)
-        finally:
-            if client:
-                client.close()
+            await self._flush_thread(thread_id, checkpoint_ns)
+        except Exception as e:
+            logger.error(f"Checkpoints flush of {thread_id} failed: {e}")
+            # Operations stay buffered, retry them later even if the
+            # thread gets no other write
+            buffer = self.buffers.get((thread_id, checkpoint_ns))
+            if buffer is not None and buffer.size and buffer.timer is None:
+                buffer.timer = asyncio.create_task(
+                    self._flush_later(
+                        thread_id,
+                        checkpoint_ns,
+                        min(delay * 2, settings.CHECKPOINT_FLUSH_MAX_DELAY),
+                    )
+                )
+
+    async def _flush_thread(self, thread_id: str, checkpoint_ns: str) -> None:
+        buffer = self.buffers.get((thread_id, checkpoint_ns))
+        if buffer is None:
+            return
+        if buffer.timer is not None:
+            buffer.timer.cancel()
+            buffer.timer = None
+
+        # Flushes of a thread run one at a time, in order
+        async with buffer.lock:
+            operations, flushed = buffer.take_operations()
+            try:
+                await self._bulk_write(operations)
+            except Exception:
+                buffer.restore_operations(operations)
+                raise
+            buffer.forget(flushed)
+
+        key = (thread_id, checkpoint_ns)
+        if self.buffers.get(key) is buffer and buffer.empty:
+            if not buffer.lock.locked():
+                del self.buffers[key]
+
+    async def flush(self, thread_id: Optional[str] = None) -> None:
+        """
+        Write every buffered operation, or those of thread_id and its
+        subgraphs, to await at the end of a session
+        """
+        for key in list(self.buffers):
+            if thread_id is None or key[0] == thread_id:
+                await self._flush_thread(*key)
+
+    async def setup(self) -> None:
+        """Move legacy writes out of the checkpoints collection and
+        create the compound indexes every lookup goes through.
+
+        Meant to run once at startup, it is idempotent.
+        """
+        await self._migrate_writes()
+        for collection, indexes in CHECKPOINT_INDEXES.items():
+            await self.db[collection].create_indexes(indexes)
+
+    def _dumps(self, value: Any) -> Tuple[str, str, bytes]:
+        """Serialize then compress a value, see codecs"""
+        type_, data = self.serde.dumps_typed(value)
+        codec, data = encode(data, self.codec, self.compression_threshold)
+        return type_, codec, data
+
+    def _loads(self, type_: str, codec: Optional[str], data: bytes) -> Any:
+        return self.serde.loads_typed((type_, decode(codec, data)))
+
+    def get_next_version(self, current: Optional[Any], channel: Any) -> str:
+        """
+        Blobs are keyed by channel version, which must not repeat when a
+        run forks from an older checkpoint: the default integer versions
+        would give the fork's values the keys of the original branch
+        """
+        return format_version(version_number(current) + 1, random.random())
+
+    def _load_checkpoint(self, doc: Dict[str, Any]) -> Checkpoint:
+        """Deserialize a checkpoint, putting its channel values back"""
+        checkpoint = normalize_versions(
+            self._loads(doc["type"], doc.get("codec"), doc["checkpoint"])
+        )
+        if doc.get("format") == DELTA_FORMAT:
+            checkpoint["channel_values"] = {
+                blob["channel"]: self._loads(
+                    blob["type"], blob.get("codec"), blob["blob"]
+                )
+                for blob in doc["blobs"]
+                if blob["type"] != "empty"
+            }
+        return checkpoint
+
+    async def _missing_blobs(
+        self, thread: Dict[str, Any], checkpoint: Checkpoint
+    ) -> ChannelVersions:
+        """Channel versions of a checkpoint that have no blob stored"""
+        versions = checkpoint["channel_versions"]
+        keys = {
+            blob_key(channel, version): channel
+            for channel, version in versions.items()
+        }
+        async for doc in self.db[BLOBS_COLLECTION].find(
+            {**thread, "key": {"$in": list(keys)}}, {"key": 1}
+        ):
+            keys.pop(doc["key"], None)
+        return {channel: versions[channel] for channel in keys.values()}
+
+    async def _migrate_writes(self, batch_size: int = 1000) -> None:
+        """Writes used to share the checkpoints collection"""
+        legacy = {"task_id": {"$exists": True}}
+        moved = 0
+        while True:
+            docs = (
+                await self.db[CHECKPOINTS_COLLECTION]
+                .find(legacy)
+                .limit(batch_size)
+                .to_list(batch_size)
+            )
+            if not docs:
+                break
+            await self.db[WRITES_COLLECTION].bulk_write(
+                [
+                    UpdateOne(
+                        {
+                            key: doc[key]
+                            for key in (
+                                "thread_id",
+                                "checkpoint_ns",
+                                "checkpoint_id",
+                                "task_id",
+                                "idx",
+                            )
+                        },
+                        {
+                            "$set": {
+                                key: doc[key]
+                                for key in ("channel", "type", "value")
+                            }
+                        },
+                        upsert=True,
+                    )
+                    for doc in docs
+                ],
+                ordered=False,
+            )
+            await self.db[CHECKPOINTS_COLLECTION].delete_many(
+                {"_id": {"$in": [doc["_id"] for doc in docs]}}
+            )
+            moved += len(docs)
+        if moved:
+            logger.info(f"Moved {moved} checkpoint writes out of checkpoints")
 
     async def aget_tuple(
         self, config: RunnableConfig
@@ -78,35 +531,84 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                 "checkpoint_ns": checkpoint_ns,
             }
 
-        result = (
-            self.db["checkpoints"]
-            .find(query)
-            .sort("checkpoint_id", -1)
-            .limit(1)
-        )
-        async for doc in result:
+        buffer = self.buffers.get((thread_id, checkpoint_ns))
+        if buffer is not None and buffer.checkpoints:
+            # Read your writes: buffered checkpoints are the newest ones
+            buffered_id = checkpoint_id or max(buffer.checkpoints)
+            if buffered_id in buffer.checkpoints:
+                _, checkpoint, metadata, parent_checkpoint_id = (
+                    buffer.checkpoints[buffered_id]
+                )
+                return CheckpointTuple(
+                    {
+                        "configurable": {
+                            "thread_id": thread_id,
+                            "checkpoint_ns": checkpoint_ns,
+                            "checkpoint_id": buffered_id,
+                        }
+                    },
+                    copy_checkpoint(checkpoint),
+                    metadata,
+                    (
+                        {
+                            "configurable": {
+                                "thread_id": thread_id,
+                                "checkpoint_ns": checkpoint_ns,
+                                "checkpoint_id": parent_checkpoint_id,
+                            }
+                        }
+                        if parent_checkpoint_id
+                        else None
+                    ),
+                    list(buffer.pending_writes(buffered_id).values()),
+                )
+
+        # Latest checkpoint, its channel values and pending writes in one
+        # round trip, every lookup is served by a compound index
+        pipeline = [
+            {"$match": query},
+            {"$sort": {"checkpoint_id": -1}},
+            {"$limit": 1},
+            BLOBS_LOOKUP,
+            {
+                "$lookup": {
+                    "from": WRITES_COLLECTION,
+                    "localField": "checkpoint_id",
+                    "foreignField": "checkpoint_id",
+                    "pipeline": [
+                        {
+                            "$match": {
+                                "thread_id": thread_id,
+                                "checkpoint_ns": checkpoint_ns,
+                            }
+                        },
+                        {"$sort": {"task_id": 1, "idx": 1}},
+                    ],
+                    "as": "writes",
+                }
+            },
+        ]
+        async for doc in self.db[CHECKPOINTS_COLLECTION].aggregate(pipeline):
             config_values = {
                 "thread_id": thread_id,
                 "checkpoint_ns": checkpoint_ns,
                 "checkpoint_id": doc["checkpoint_id"],
             }
-            print("l7wa", doc)
-            checkpoint = self.serde.loads_typed(
-                (doc["type"], doc["checkpoint"])
-            )
-            serialized_writes = self.db["checkpoints"].find(config_values)
-            pending_writes = []
-            async for write_doc in serialized_writes:
-                if "task_id" in write_doc:
-                    pending_writes.append(
-                        (
-                            write_doc["task_id"],
-                            write_doc["channel"],
-                            self.serde.loads_typed(
-                                (write_doc["type"], write_doc["value"])
-                            ),
-                        )
-                    )
+            checkpoint = self._load_checkpoint(doc)
+            pending_writes = {
+                (write_doc["task_id"], write_doc["idx"]): (
+                    write_doc["task_id"],
+                    write_doc["channel"],
+                    self._loads(
+                        write_doc["type"],
+                        write_doc.get("codec"),
+                        write_doc["value"],
+                    ),
+                )
+                for write_doc in doc["writes"]
+            }
+            if buffer is not None:
+                pending_writes |= buffer.pending_writes(doc["checkpoint_id"])
             return CheckpointTuple(
                 {"configurable": config_values},
                 checkpoint,
@@ -122,7 +624,7 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                     if doc.get("parent_checkpoint_id")
                     else None
                 ),
-                pending_writes,
+                [pending_writes[key] for key in sorted(pending_writes)],
             )
 
     async def alist(
@@ -147,6 +649,14 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         Yields:
             AsyncIterator[CheckpointTuple]: An asynchronous iterator of matching checkpoint tuples.
         """
+        if config is None:
+            await self.flush()
+        else:
+            await self._flush_thread(
+                config["configurable"]["thread_id"],
+                config["configurable"].get("checkpoint_ns", ""),
+            )
+
         query = {}
         if config is not None:
             query = {
@@ -165,14 +675,13 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                 "$lt": before["configurable"]["checkpoint_id"]
             }
 
-        result = self.db["checkpoints"].find(query).sort("checkpoint_id", -1)
-
+        pipeline = [{"$match": query}, {"$sort": {"checkpoint_id": -1}}]
         if limit is not None:
-            result = result.limit(limit)
-        async for doc in result:
-            checkpoint = self.serde.loads_typed(
-                (doc["type"], doc["checkpoint"])
-            )
+            pipeline.append({"$limit": limit})
+        pipeline.append(BLOBS_LOOKUP)
+
+        async for doc in self.db[CHECKPOINTS_COLLECTION].aggregate(pipeline):
+            checkpoint = self._load_checkpoint(doc)
             yield CheckpointTuple(
                 {
                     "configurable": {
@@ -220,24 +729,80 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         thread_id = config["configurable"]["thread_id"]
         checkpoint_ns = config["configurable"]["checkpoint_ns"]
         checkpoint_id = checkpoint["id"]
-        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        thread = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+
+        # Only channels updated since the parent checkpoint get written,
+        # a given channel version never changes
+        channel_values = checkpoint["channel_values"]
+        changed = dict(new_versions)
+        if (thread_id, checkpoint_ns) not in delta_threads:
+            # Parent might be a full snapshot, whose channel values
+            # have no blobs yet
+            changed |= await self._missing_blobs(thread, checkpoint)
+            delta_threads.set((thread_id, checkpoint_ns), True)
+        blobs = []
+        for channel, version in changed.items():
+            if channel in channel_values:
+                type_, codec, blob = self._dumps(channel_values[channel])
+            else:
+                type_, codec, blob = "empty", None, None
+            key = blob_key(channel, version)
+            blobs.append(
+                UpdateOne(
+                    {**thread, "key": key},
+                    {
+                        "$setOnInsert": {
+                            "channel": channel,
+                            "type": type_,
+                            "codec": codec,
+                            "blob": blob,
+                            "created_at": datetime.now(timezone.utc),
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+
+        type_, codec, serialized_checkpoint = self._dumps(
+            {**checkpoint, "channel_values": {}}
+        )
         doc = {
+            "format": DELTA_FORMAT,
+            "blob_keys": [
+                blob_key(channel, version)
+                for channel, version in checkpoint["channel_versions"].items()
+            ],
             "parent_checkpoint_id": config["configurable"].get(
                 "checkpoint_id"
             ),
             "type": type_,
+            "codec": codec,
             "checkpoint": serialized_checkpoint,
             "metadata": self.serde.dumps(metadata),
+            # Used by the retention policy, see checkpoint_retention
+            "created_at": datetime.now(timezone.utc),
         }
-        upsert_query = {
-            "thread_id": thread_id,
-            "checkpoint_ns": checkpoint_ns,
-            "checkpoint_id": checkpoint_id,
+        upsert_query = {**thread, "checkpoint_id": checkpoint_id}
+        operations = {
+            BLOBS_COLLECTION: blobs,
+            CHECKPOINTS_COLLECTION: [
+                UpdateOne(upsert_query, {"$set": doc}, upsert=True)
+            ],
         }
-        # Perform your operations here
-        await self.db["checkpoints"].update_one(
-            upsert_query, {"$set": doc}, upsert=True
-        )
+
+        if self.write_behind:
+            buffer = self._buffer(thread_id, checkpoint_ns)
+            for collection, ops in operations.items():
+                buffer.operations[collection].extend(ops)
+            buffer.checkpoints[checkpoint_id] = (
+                next(buffer.sequence),
+                copy_checkpoint(checkpoint),
+                metadata,
+                doc["parent_checkpoint_id"],
+            )
+            await self._schedule_flush(thread_id, checkpoint_ns)
+        else:
+            await self._bulk_write(operations)
         return {
             "configurable": {
                 "thread_id": thread_id,
@@ -273,7 +838,7 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                 "task_id": task_id,
                 "idx": idx,
             }
-            type_, serialized_value = self.serde.dumps_typed(value)
+            type_, codec, serialized_value = self._dumps(value)
             operations.append(
                 UpdateOne(
                     upsert_query,
@@ -281,13 +846,27 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                         "$set": {
                             "channel": channel,
                             "type": type_,
+                            "codec": codec,
                             "value": serialized_value,
                         }
                     },
                     upsert=True,
                 )
             )
-        await self.db["checkpoints"].bulk_write(operations)
+
+        if self.write_behind:
+            buffer = self._buffer(thread_id, checkpoint_ns)
+            buffer.operations[WRITES_COLLECTION].extend(operations)
+            seq = next(buffer.sequence)
+            for idx, (channel, value) in enumerate(writes):
+                buffer.writes[checkpoint_id][(task_id, idx)] = (
+                    seq,
+                    channel,
+                    value,
+                )
+            await self._schedule_flush(thread_id, checkpoint_ns)
+        else:
+            await self.db[WRITES_COLLECTION].bulk_write(operations)
 
     async def aremove_checkpoints(self, graph_id: str) -> int:
         """Remove all checkpoints associated with a given graph_id.
@@ -301,20 +880,42 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         Returns:
             int: The number of documents deleted.
         """
-        # Remove checkpoints
-        checkpoint_result = await self.db["checkpoints"].delete_many(
-            {"thread_id": graph_id}
+        return await self._remove_threads(
+            {"thread_id": graph_id}, lambda thread_id: thread_id == graph_id
         )
 
-        # Remove associated writes
-        writes_result = await self.db["checkpoints"].delete_many(
-            {"thread_id": graph_id, "task_id": {"$exists": True}}
-        )
+    async def aremove_thread_prefix(self, prefix: str) -> int:
+        """Remove checkpoints of every thread whose id starts with prefix,
+        such as the threads of a session with each version of its agent.
 
-        total_deleted = (
-            checkpoint_result.deleted_count + writes_result.deleted_count
+        Returns:
+            int: The number of documents deleted.
+        """
+        return await self._remove_threads(
+            {"thread_id": {"$regex": f"^{re.escape(prefix)}"}},
+            lambda thread_id: thread_id.startswith(prefix),
         )
 
+    async def _remove_threads(
+        self, query: Dict[str, Any], matches: Callable[[str], bool]
+    ) -> int:
+        # Drop what is still buffered
+        for key in [key for key in self.buffers if matches(key[0])]:
+            buffer = self.buffers.pop(key)
+            if buffer.timer is not None:
+                buffer.timer.cancel()
+
+        total_deleted = 0
+        # Checkpoints, their writes and channel values
+        for collection in (
+            CHECKPOINTS_COLLECTION,
+            WRITES_COLLECTION,
+            BLOBS_COLLECTION,
+        ):
+            result = await self.db[collection].delete_many(query)
+            total_deleted += result.deleted_count
+        delta_threads.invalidate(lambda key: matches(key[0]))
+
         return total_deleted
 
     """
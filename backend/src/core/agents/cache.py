@@ -0,0 +1,57 @@
+"""
+Cache of compiled agents, so that publishing an unchanged graph
+doesn't run the whole WakilAgent pipeline again
+"""
+
+import hashlib
+import json
+
+from src.api.models import Agent
+from src.core.cache import LRUCache
+from src.core.settings import settings
+
+# Node fields that only matter to the editor canvas, they have no effect
+# on the compiled agent so moving a node around shouldn't bust the cache
+CANVAS_ONLY_NODE_FIELDS = {"position", "measured", "selected", "dragging"}
+
+compiled_agent_cache = LRUCache(maxsize=settings.COMPILED_AGENT_CACHE_SIZE)
+
+
+def agent_fingerprint(agent: Agent) -> str:
+    """
+    Canonical hash of everything the compiled agent depends on:
+    graph nodes (with their metadata), edges, title, description and outlines
+    """
+    graph = agent.graph.model_dump(mode="json") if agent.graph else {}
+    nodes = [
+        {
+            key: value
+            for key, value in node.items()
+            if key not in CANVAS_ONLY_NODE_FIELDS
+        }
+        for node in graph.get("nodes", [])
+    ]
+    payload = {
+        "nodes": sorted(nodes, key=lambda node: node["id"]),
+        "edges": sorted(graph.get("edges", []), key=lambda edge: edge["id"]),
+        "title": agent.title,
+        "description": agent.description,
+        "outlines": agent.outlines,
+    }
+    canonical = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def compiled_agent_key(agent: Agent) -> tuple[str, str]:
+    """
+    Cache key of a compiled agent, scoped to the agent's id since vectors
+    ingested in Qdrant are bound to it
+    """
+    return str(agent.id), agent_fingerprint(agent)
+
+
+def invalidate_compiled_agent(graph_id: str) -> int:
+    """Drop every compiled version of an agent"""
+    return compiled_agent_cache.invalidate(lambda key: key[0] == str(graph_id))
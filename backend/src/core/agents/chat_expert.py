@@ -2,12 +2,13 @@ from functools import partial
 from typing import List
 
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langchain_groq import ChatGroq
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import MessagesState
 
 from src.api.models import ChatResponse, EditorCanvasTypes, Graph
-from src.core.agents.utils import pretty_print_graph
+from src.core.agents.utils import invoke_llm, pretty_print_graph
 from src.core.settings import settings
 
 
@@ -53,15 +54,18 @@ def create_graph_expert_agent(prompt: str, graph: Graph, messages: List[str]):
         ]
     )
 
+    # Retried by agent_node, see utils.invoke_llm
     llm = ChatGroq(
-        model="llama-3.1-70b-versatile", api_key=settings.GROQ_API_KEY
+        model="llama-3.1-70b-versatile",
+        api_key=settings.GROQ_API_KEY,
+        max_retries=0,
     )
 
     return prompt_template | llm
 
 
-def agent_node(state, agent):
-    result = agent.invoke(state)
+async def agent_node(state, config: RunnableConfig, agent):
+    result = await invoke_llm(agent, state, config)
 
     return {"messages": result}
 
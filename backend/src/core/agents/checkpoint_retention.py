@@ -0,0 +1,289 @@
+"""
+Retention policy of LangGraph checkpoints, applied by a background
+compaction task so that long-running threads don't grow without bound.
+Every worker runs the task, a lease document elects the one compacting.
+"""
+
+import asyncio
+import os
+import socket
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set
+
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from src.core.agents.AsyncMongoDBSaver import (
+    BLOBS_COLLECTION,
+    CHECKPOINTS_COLLECTION,
+    WRITES_COLLECTION,
+)
+from src.core.settings import settings
+
+compaction_task: Optional[asyncio.Task] = None
+
+# Blobs are written before the checkpoint referencing them,
+# recent ones might belong to a checkpoint being saved
+ORPHAN_BLOBS_GRACE = timedelta(minutes=5)
+
+# Lease of the compaction, held by one worker per interval
+COMPACTION_LEASE_COLLECTION = "checkpoint_compaction"
+COMPACTION_LEASE_ID = "compaction"
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class RetentionPolicy:
+    keep_last: int
+    keep_newer_than: Optional[timedelta] = None
+
+    def __post_init__(self) -> None:
+        # The latest checkpoint is the thread's current state
+        if self.keep_last < 1:
+            raise ValueError(
+                f"keep_last must be at least 1, got {self.keep_last}"
+            )
+
+    @classmethod
+    def from_settings(cls) -> "RetentionPolicy":
+        return cls(
+            keep_last=settings.CHECKPOINT_KEEP_LAST,
+            keep_newer_than=(
+                timedelta(seconds=settings.CHECKPOINT_KEEP_NEWER_THAN)
+                if settings.CHECKPOINT_KEEP_NEWER_THAN
+                else None
+            ),
+        )
+
+    def expired(
+        self, checkpoints: List[Dict[str, Any]], now: datetime
+    ) -> List[str]:
+        """
+        Ids of the checkpoints of one thread this policy doesn't keep,
+        checkpoints being sorted newest first
+        """
+        children = Counter(
+            doc["parent_checkpoint_id"]
+            for doc in checkpoints
+            if doc.get("parent_checkpoint_id")
+        )
+        # Parents of several checkpoints are where a thread was forked
+        branch_points = {id_ for id_, count in children.items() if count > 1}
+        cutoff = now - self.keep_newer_than if self.keep_newer_than else None
+
+        expired = []
+        for doc in checkpoints[self.keep_last :]:
+            # Checkpoints written before retention was introduced are old
+            created_at = doc.get("created_at")
+            if created_at and created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            if cutoff and created_at and created_at >= cutoff:
+                continue
+            if doc["checkpoint_id"] in branch_points:
+                continue
+            expired.append(doc["checkpoint_id"])
+        return expired
+
+
+@dataclass
+class CompactionStats:
+    threads: int = 0
+    checkpoints: int = 0
+    writes: int = 0
+    blobs: int = 0
+    bytes_reclaimed: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.checkpoints} checkpoints, {self.writes} writes "
+            f"and {self.blobs} blobs "
+            f"from {self.threads} threads, "
+            f"{self.bytes_reclaimed / 1024 / 1024:.1f} MiB reclaimed"
+        )
+
+
+async def _delete_batch(
+    db: AsyncIOMotorDatabase,
+    collection: str,
+    query: Dict[str, Any],
+) -> tuple[int, int]:
+    """Delete matching documents, returns their count and total size"""
+    size = 0
+    async for doc in db[collection].aggregate(
+        [
+            {"$match": query},
+            {
+                "$group": {
+                    "_id": None,
+                    "bytes": {"$sum": {"$bsonSize": "$$ROOT"}},
+                }
+            },
+        ]
+    ):
+        size = doc["bytes"]
+    result = await db[collection].delete_many(query)
+    return result.deleted_count, size
+
+
+async def compact_thread(
+    db: AsyncIOMotorDatabase,
+    thread_id: str,
+    checkpoint_ns: str,
+    policy: RetentionPolicy,
+    batch_size: int,
+    stats: CompactionStats,
+) -> None:
+    thread = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+    checkpoints = (
+        await db[CHECKPOINTS_COLLECTION]
+        .find(
+            thread,
+            {
+                "_id": 0,
+                "checkpoint_id": 1,
+                "parent_checkpoint_id": 1,
+                "created_at": 1,
+                "blob_keys": 1,
+            },
+        )
+        .sort("checkpoint_id", -1)
+        .to_list(None)
+    )
+    now = datetime.now(timezone.utc)
+    expired = policy.expired(checkpoints, now)
+
+    for start in range(0, len(expired), batch_size):
+        batch = {
+            **thread,
+            "checkpoint_id": {"$in": expired[start : start + batch_size]},
+        }
+        count, size = await _delete_batch(db, CHECKPOINTS_COLLECTION, batch)
+        stats.checkpoints += count
+        stats.bytes_reclaimed += size
+        count, size = await _delete_batch(db, WRITES_COLLECTION, batch)
+        stats.writes += count
+        stats.bytes_reclaimed += size
+        # Let agent turns through between batches
+        await asyncio.sleep(0)
+
+    if expired:
+        stats.threads += 1
+        # Channel values no remaining checkpoint points to
+        expired_ids = set(expired)
+        referenced = {
+            key
+            for doc in checkpoints
+            if doc["checkpoint_id"] not in expired_ids
+            for key in doc.get("blob_keys", [])
+        }
+        count, size = await _delete_batch(
+            db,
+            BLOBS_COLLECTION,
+            {
+                **thread,
+                "key": {"$nin": list(referenced)},
+                "created_at": {"$lt": now - ORPHAN_BLOBS_GRACE},
+            },
+        )
+        stats.blobs += count
+        stats.bytes_reclaimed += size
+
+
+async def compact_checkpoints(
+    db: AsyncIOMotorDatabase,
+    policy: RetentionPolicy,
+    batch_size: int = 500,
+) -> CompactionStats:
+    """Apply the retention policy to every thread"""
+    stats = CompactionStats()
+    # Threads with at most keep_last checkpoints have nothing to drop
+    threads: Set[tuple[str, str]] = set()
+    async for doc in db[CHECKPOINTS_COLLECTION].aggregate(
+        [
+            {
+                "$group": {
+                    "_id": {
+                        "thread_id": "$thread_id",
+                        "checkpoint_ns": "$checkpoint_ns",
+                    },
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$match": {"count": {"$gt": policy.keep_last}}},
+        ]
+    ):
+        threads.add((doc["_id"]["thread_id"], doc["_id"]["checkpoint_ns"]))
+
+    for thread_id, checkpoint_ns in threads:
+        await compact_thread(
+            db, thread_id, checkpoint_ns, policy, batch_size, stats
+        )
+    return stats
+
+
+async def claim_compaction(
+    db: AsyncIOMotorDatabase, worker: str, duration: timedelta
+) -> bool:
+    """
+    Take or extend the compaction lease for duration, False while
+    another worker holds it
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await db[COMPACTION_LEASE_COLLECTION].update_one(
+            {
+                "_id": COMPACTION_LEASE_ID,
+                "$or": [{"expires_at": {"$lte": now}}, {"worker": worker}],
+            },
+            {"$set": {"worker": worker, "expires_at": now + duration}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The lease exists and is held by another worker
+        return False
+    return True
+
+
+async def run_compaction(db: AsyncIOMotorDatabase, interval: float) -> None:
+    """
+    Compact checkpoints every interval seconds, forever, on the worker
+    holding the lease. A compaction outlasting interval can overlap with
+    the next one, deletes of both are idempotent.
+    """
+    policy = RetentionPolicy.from_settings()
+    lease = timedelta(seconds=interval)
+    while True:
+        try:
+            if await claim_compaction(db, WORKER_ID, lease):
+                stats = await compact_checkpoints(
+                    db, policy, settings.CHECKPOINT_COMPACTION_BATCH_SIZE
+                )
+                logger.info(f"Checkpoints compaction: {stats}")
+                # The next one is an interval after this one ended
+                await claim_compaction(db, WORKER_ID, lease)
+        except Exception as e:
+            logger.error(f"Checkpoints compaction failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def start_compaction(db: AsyncIOMotorDatabase) -> None:
+    global compaction_task
+    if settings.CHECKPOINT_COMPACTION_INTERVAL and compaction_task is None:
+        compaction_task = asyncio.create_task(
+            run_compaction(db, settings.CHECKPOINT_COMPACTION_INTERVAL)
+        )
+
+
+async def stop_compaction() -> None:
+    global compaction_task
+    if compaction_task is not None:
+        compaction_task.cancel()
+        try:
+            await compaction_task
+        except asyncio.CancelledError:
+            pass
+        compaction_task = None
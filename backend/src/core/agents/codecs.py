@@ -0,0 +1,79 @@
+"""
+Compression codecs of checkpoint payloads. Stored documents carry the tag
+of the codec they were encoded with, so any codec can read old entries.
+zstd is only available when the zstandard package is installed.
+"""
+
+import lzma
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+RAW = "raw"
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _zstd() -> Optional[Codec]:
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    compressor = zstandard.ZstdCompressor(level=3)
+    decompressor = zstandard.ZstdDecompressor()
+    return Codec(
+        "zstd",
+        compressor.compress,
+        # Frames written by compress() always carry their content size
+        decompressor.decompress,
+    )
+
+
+CODECS: Dict[str, Codec] = {
+    codec.name: codec
+    for codec in (
+        Codec(RAW, lambda data: data, lambda data: data),
+        Codec("zlib", lambda data: zlib.compress(data, 6), zlib.decompress),
+        Codec(
+            "lzma",
+            lambda data: lzma.compress(data, preset=1),
+            lzma.decompress,
+        ),
+        _zstd(),
+    )
+    if codec is not None
+}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown or unavailable codec {name}, "
+            f"available ones are {', '.join(CODECS)}"
+        )
+    return CODECS[name]
+
+
+def encode(data: bytes, codec: str, threshold: int) -> Tuple[str, bytes]:
+    """
+    Compress data with codec, unless it is smaller than threshold or
+    doesn't shrink, returns the tag of the codec used and the payload
+    """
+    if len(data) < threshold or codec == RAW:
+        return RAW, data
+    compressed = get_codec(codec).compress(data)
+    if len(compressed) >= len(data):
+        return RAW, data
+    return codec, compressed
+
+
+def decode(codec: Optional[str], data: bytes) -> bytes:
+    """Entries written before compression have no codec tag"""
+    if codec is None or codec == RAW:
+        return data
+    return get_codec(codec).decompress(data)
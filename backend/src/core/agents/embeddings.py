@@ -0,0 +1,164 @@
+"""
+Embeddings with a two tier cache: in-memory LRU, then optionally MongoDB
+"""
+
+import hashlib
+import re
+import unicodedata
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from src.core.cache import LRUCache
+from src.core.clients import get_openai
+from src.core.settings import settings
+
+EMBEDDING_CACHE_COLLECTION = "embedding_cache"
+
+
+def normalize_text(text: str) -> str:
+    """Unicode and whitespace normalization, so near-identical texts match"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def embedding_key(model: str, text: str) -> str:
+    normalized = normalize_text(text)
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by model name and normalized text.
+    Memory tier is per process, Mongo tier is shared between workers
+    and expires entries after a TTL.
+
+    Both tiers hold float32 bytes, 6 KiB for 1536 dimensions where a list
+    of Python floats takes about 49 KiB. Lists are only built on return.
+    """
+
+    def __init__(self, maxsize: int, use_mongo: bool = False):
+        self.memory = LRUCache(maxsize=maxsize)
+        self.use_mongo = use_mongo
+        self.mongo_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _collection():
+        from src.db.client import MongoDBClient
+
+        return MongoDBClient().mongodb[EMBEDDING_CACHE_COLLECTION]
+
+    @staticmethod
+    def _pack(vector: List[float]) -> bytes:
+        return array("f", vector).tobytes()
+
+    @staticmethod
+    def _unpack(data: bytes) -> List[float]:
+        vector = array("f")
+        vector.frombytes(data)
+        return vector.tolist()
+
+    async def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        for key in keys:
+            data = self.memory.get(key)
+            if data is not None:
+                found[key] = self._unpack(data)
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.use_mongo:
+            try:
+                async for doc in self._collection().find(
+                    {"_id": {"$in": missing}}
+                ):
+                    found[doc["_id"]] = self._unpack(doc["vector"])
+                    self.memory.set(doc["_id"], doc["vector"])
+                    self.mongo_hits += 1
+            except PyMongoError as e:
+                logger.warning(f"Embedding cache lookup failed: {e}")
+
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set_many(self, vectors: Dict[str, List[float]]) -> None:
+        packed = {key: self._pack(vector) for key, vector in vectors.items()}
+        for key, data in packed.items():
+            self.memory.set(key, data)
+
+        if vectors and self.use_mongo:
+            now = datetime.now(timezone.utc)
+            try:
+                await self._collection().bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": key},
+                            {"$set": {"vector": data, "created_at": now}},
+                            upsert=True,
+                        )
+                        for key, data in packed.items()
+                    ],
+                    ordered=False,
+                )
+            except PyMongoError as e:
+                logger.warning(f"Embedding cache write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        memory_hits = self.memory.hits
+        lookups = memory_hits + self.memory.misses
+        hits = memory_hits + self.mongo_hits
+        return {
+            "memory": self.memory.stats(),
+            "mongo_hits": self.mongo_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else None,
+        }
+
+
+embedding_cache = EmbeddingCache(
+    maxsize=settings.EMBEDDING_CACHE_SIZE,
+    use_mongo=settings.EMBEDDING_CACHE_MONGO,
+)
+
+
+async def init_embedding_cache(db) -> None:
+    """Create the TTL index of the Mongo tier"""
+    if not embedding_cache.use_mongo:
+        return
+    await db[EMBEDDING_CACHE_COLLECTION].create_index(
+        [("created_at", ASCENDING)],
+        expireAfterSeconds=settings.EMBEDDING_CACHE_TTL,
+    )
+
+
+async def embed_texts(
+    texts: List[str], model: Optional[str] = None
+) -> List[List[float]]:
+    """
+    Embed texts, only calling the embeddings API for texts
+    that are not in cache yet
+    """
+    model = model or settings.EMBEDDING_MODEL
+    keys = [embedding_key(model, text) for text in texts]
+    vectors = await embedding_cache.get_many(keys)
+
+    # Same text might show up several times, embed it once
+    missing = {
+        key: text for key, text in zip(keys, texts) if key not in vectors
+    }
+    if missing:
+        response = await get_openai().embeddings.create(
+            input=list(missing.values()), model=model
+        )
+        embedded = {
+            key: embedding.embedding
+            for key, embedding in zip(missing.keys(), response.data)
+        }
+        await embedding_cache.set_many(embedded)
+        vectors |= embedded
+
+    return [vectors[key] for key in keys]
@@ -0,0 +1,57 @@
+"""
+CPU bound text extraction, meant to run in worker processes:
+keep this module free of app imports so workers start fast
+"""
+
+import codecs
+from typing import List, Optional
+
+# Set in worker processes, see pools.extraction_pool
+progress_queue = None
+
+
+def init_extraction_worker(queue) -> None:
+    global progress_queue
+    progress_queue = queue
+
+
+def count_pdf_pages(path: str) -> int:
+    from PyPDF2 import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+def extract_pdf_pages(
+    path: str, start: int, stop: int, job: Optional[str] = None
+) -> List[str]:
+    """
+    Extract text of pages [start, stop) of a PDF, reporting each page
+    to the progress listener of job
+    """
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(path)
+    pages = []
+    for i in range(start, stop):
+        pages.append(reader.pages[i].extract_text() or "")
+        if job is not None and progress_queue is not None:
+            progress_queue.put((job, 1))
+    return pages
+
+
+def extract_docx(path: str) -> str:
+    from docx import Document
+
+    doc = Document(path)
+    return "\n".join(paragraph.text for paragraph in doc.paragraphs)
+
+
+def extract_txt(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Decode a UTF-8 text file chunk by chunk"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = []
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            text.append(decoder.decode(chunk))
+    text.append(decoder.decode(b"", final=True))
+    return "".join(text)
@@ -0,0 +1,165 @@
+"""
+Content-addressed cache of text extracted from uploaded documents,
+on local disk and optionally in MongoDB GridFS
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+from loguru import logger
+from pymongo.errors import PyMongoError
+
+from src.core.pools import run_blocking
+from src.core.settings import settings
+
+GRIDFS_BUCKET_NAME = "extraction_cache"
+
+
+class ExtractionCache:
+    """
+    Extracted text keyed by S3 key and ETag (or content hash),
+    so a changed object never serves stale text.
+    Disk tier is evicted least recently used first past max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, use_gridfs: bool):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.use_gridfs = use_gridfs
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key_prefix(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, etag: str) -> Path:
+        etag = re.sub(r"[^A-Za-z0-9-]", "", etag)
+        return self.directory / f"{self._key_prefix(key)}-{etag}.txt"
+
+    @staticmethod
+    def _gridfs():
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+        from src.db.client import MongoDBClient
+
+        return AsyncIOMotorGridFSBucket(
+            MongoDBClient().mongodb, bucket_name=GRIDFS_BUCKET_NAME
+        )
+
+    # Disk tier, blocking, run in the loader thread pool
+    def _read(self, path: Path) -> Optional[str]:
+        try:
+            text = path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # Mark as recently used
+        return text
+
+    def _write(self, path: Path, text: str) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # A temporary file per writer, workers can cache the same document
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=self.directory,
+            suffix=".tmp",
+            delete=False,
+        ) as file:
+            try:
+                file.write(text)
+            except BaseException:
+                file.close()
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        for path in self.directory.glob("*.txt"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.info(f"Evicted {path.name} from extraction cache")
+
+    def _delete(self, keys: List[str]) -> None:
+        for key in keys:
+            for path in self.directory.glob(f"{self._key_prefix(key)}-*"):
+                path.unlink(missing_ok=True)
+
+    async def get(self, key: str, etag: str) -> Optional[str]:
+        path = self._path(key, etag)
+        text = await run_blocking(self._read, path)
+        if text is None and self.use_gridfs:
+            try:
+                stream = await self._gridfs().open_download_stream_by_name(
+                    f"{key}:{etag}"
+                )
+                text = (await stream.read()).decode("utf-8")
+                await run_blocking(self._write, path, text)
+            except PyMongoError:
+                # NoFile when missing, or tier unavailable
+                text = None
+
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    async def _upload(self, key: str, etag: str, text: str) -> None:
+        gridfs = self._gridfs()
+        name = f"{key}:{etag}"
+        # Same key and ETag, same text: another worker uploaded it already
+        if await gridfs.find({"filename": name}, limit=1).to_list(1):
+            return
+        file_id = await gridfs.upload_from_stream(
+            name, text.encode("utf-8"), metadata={"key": key, "etag": etag}
+        )
+        # Older versions of the object, or revisions of concurrent uploads:
+        # deleting only older ids, one of those uploads is always left
+        async for file in gridfs.find(
+            {"metadata.key": key, "_id": {"$lt": file_id}}
+        ):
+            await gridfs.delete(file._id)
+
+    async def set(self, key: str, etag: str, text: str) -> None:
+        await run_blocking(self._write, self._path(key, etag), text)
+        if self.use_gridfs:
+            try:
+                await self._upload(key, etag, text)
+            except PyMongoError as e:
+                logger.warning(f"Extraction cache write failed: {e}")
+
+    async def invalidate(self, keys: List[str]) -> None:
+        """Forget every version of the given S3 objects"""
+        if not keys:
+            return
+        await run_blocking(self._delete, keys)
+        if self.use_gridfs:
+            gridfs = self._gridfs()
+            try:
+                async for file in gridfs.find({"metadata.key": {"$in": keys}}):
+                    await gridfs.delete(file._id)
+            except PyMongoError as e:
+                logger.warning(f"Extraction cache invalidation failed: {e}")
+
+
+extraction_cache = ExtractionCache(
+    directory=settings.EXTRACTION_CACHE_DIR,
+    max_bytes=settings.EXTRACTION_CACHE_MAX_BYTES,
+    use_gridfs=settings.EXTRACTION_CACHE_GRIDFS,
+)
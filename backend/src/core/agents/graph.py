@@ -1,4 +1,6 @@
+import asyncio
 import functools
+import time
 from typing import Dict, List, Optional, Type, TypedDict
 
 from langgraph.checkpoint.base import BaseCheckpointSaver
@@ -6,9 +8,16 @@ from langgraph.graph import StateGraph
 from langgraph.graph.state import CompiledStateGraph
 from loguru import logger
 
-from src.api.models import Agent, Edge, EditorCanvasTypes, Node
+from src.api.models import (
+    Agent,
+    DataNodeFingerprint,
+    Edge,
+    EditorCanvasTypes,
+    Node,
+)
 from src.core.agents.state import build_agent_prompt
 from src.core.agents.utils import validate_agent_connections
+from src.core.settings import settings
 
 
 class WakilAgent:
@@ -33,7 +42,10 @@ class WakilAgent:
         # Initialize the node clusters
         self.user_id = agent.user_id
         self.graph_id = agent.id
-        self.data_nodes: Dict[str, Node] = {}
+        self.data_nodes: Dict[str, Node] = {}  # Maps node IDs to data nodes
+        # Fingerprints of the data ingested on last publish, and now
+        self.previous_fingerprints = agent.fingerprints
+        self.fingerprints: Dict[str, Dict[str, DataNodeFingerprint]] = {}
         self.tools = {}
         self.prompt = ""
         self.llm_node = None
@@ -146,7 +158,7 @@ class WakilAgent:
 
             try:
                 node = node_class(node_data)
-                self.data_nodes[node_type] = node
+                self.data_nodes[node_data.id] = node
                 self._node_map[node_data.id] = node
             except Exception as e:
                 raise RuntimeError(
@@ -206,29 +218,31 @@ class WakilAgent:
         if not vector_db_nodes:
             raise ValueError("No vector DB nodes found")
 
+        if not self.data_nodes:
+            raise ValueError("No data nodes available for vector DB ingestion")
+
+        # Load every data node that might have changed once, concurrently
+        to_load = [
+            data_node_id
+            for data_node_id, data_node in self.data_nodes.items()
+            if any(
+                not self._is_source_unchanged(node.id, data_node_id, data_node)
+                for node in vector_db_nodes
+            )
+        ]
+        loaded_data = await self._load_data_nodes(to_load)
+
         for node in vector_db_nodes:
             node_type = node.type
             node_class = self._get_node_class(node_type)
 
-            if not self.data_nodes:
-                raise ValueError(
-                    "No data nodes available for vector DB ingestion"
-                )
-
             if not node_class:
                 raise ValueError(f"Node class for type {node_type} not found")
 
             try:
-                node_instance = node_class()
-                data = [
-                    (await self.data_nodes[node_type].load_data()).strip("\n")
-                    for node_type in self.data_nodes.keys()
-                ]
-                await node_instance.ingest_data(
-                    user_id=self.user_id,
-                    graph_id=self.graph_id,
-                    node_id=node.id,
-                    data=data,
+                node_instance = node_class(node_id=node.id)
+                await self._ingest_data_nodes(
+                    node_instance, node.id, loaded_data
                 )
                 self.tools[node_type] = node_instance
                 self._node_map[node.id] = node_instance
@@ -237,6 +251,112 @@ class WakilAgent:
                     f"Failed to initialize vector DB node {node_type}: {e}"
                 )
 
+    def _is_source_unchanged(
+        self, node_id: str, data_node_id: str, data_node
+    ) -> bool:
+        """
+        Whether a data node can be skipped without even loading it,
+        which is the case of immutable sources ingested as is last publish
+        """
+        known = self.previous_fingerprints.get(node_id, {}).get(data_node_id)
+        return (
+            known is not None
+            and data_node.immutable_source
+            and known.source == data_node.source_fingerprint()
+        )
+
+    async def _load_data_nodes(
+        self, data_node_ids: List[str]
+    ) -> Dict[str, str]:
+        """
+        Load data nodes concurrently, bounded by the app-wide loader
+        semaphore and with a timeout per data node
+        """
+        from src.core.pools import loader_semaphore
+
+        async def load(data_node_id: str) -> str:
+            async with loader_semaphore:
+                start = time.perf_counter()
+                try:
+                    data = await asyncio.wait_for(
+                        self.data_nodes[data_node_id].load_data(),
+                        timeout=settings.DATA_LOADER_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    raise RuntimeError(
+                        f"Loading data node {data_node_id} timed out after "
+                        f"{settings.DATA_LOADER_TIMEOUT}s"
+                    )
+                finally:
+                    logger.info(
+                        f"Data node {data_node_id} loaded in "
+                        f"{time.perf_counter() - start:.2f}s"
+                    )
+                return data.strip("\n")
+
+        results = await asyncio.gather(
+            *(load(data_node_id) for data_node_id in data_node_ids),
+            return_exceptions=True,
+        )
+        for data_node_id, result in zip(data_node_ids, results):
+            if isinstance(result, BaseException):
+                raise RuntimeError(
+                    f"Failed to load data node {data_node_id}: {result}"
+                )
+        return dict(zip(data_node_ids, results))
+
+    async def _ingest_data_nodes(
+        self, node_instance, node_id: str, loaded_data: Dict[str, str]
+    ):
+        """
+        Ingest data nodes into a vector DB node, incrementally:
+        only data nodes whose fingerprint changed since last publish are
+        embedded again, and vectors of removed data nodes are deleted
+        """
+        from src.core.agents.nodes import content_hash
+
+        previous = self.previous_fingerprints.get(node_id, {})
+        fingerprints: Dict[str, DataNodeFingerprint] = {}
+
+        for data_node_id, data_node in self.data_nodes.items():
+            known = previous.get(data_node_id)
+            if self._is_source_unchanged(node_id, data_node_id, data_node):
+                logger.info(f"Data node {data_node_id} unchanged, skipping")
+                fingerprints[data_node_id] = known
+                continue
+
+            data = loaded_data[data_node_id]
+            fingerprint = DataNodeFingerprint(
+                source=data_node.source_fingerprint(),
+                content=content_hash(data),
+            )
+            if fingerprint == known:
+                logger.info(f"Data node {data_node_id} unchanged, skipping")
+                fingerprints[data_node_id] = known
+                continue
+
+            ingested = await node_instance.ingest_data(
+                user_id=self.user_id,
+                graph_id=self.graph_id,
+                node_id=node_id,
+                data=[data],
+                source_id=data_node_id,
+            )
+            # Only remember what made it to the vector db,
+            # so failed ingestions are retried on next publish
+            if ingested:
+                fingerprints[data_node_id] = fingerprint
+
+        removed = [
+            data_node_id
+            for data_node_id in previous
+            if data_node_id not in self.data_nodes
+        ]
+        await node_instance.delete_data(
+            graph_id=self.graph_id, node_id=node_id, source_ids=removed
+        )
+        self.fingerprints[node_id] = fingerprints
+
     async def _build_prompt(self, agent: Agent) -> str:
         """
         Build a prompt that represents the goal of the agent
@@ -302,9 +422,10 @@ class WakilAgent:
         # Bind tools to the LLM node, Do this on llm_node,
         # Tools are methods of my Tools' Classes that play role of tools
         # Tools for now are just vector db nodes
-        self.llm_node.bind_tools(tools)
+        # bind_tools returns a new runnable, the LLM node is left as is
+        llm = self.llm_node.bind_tools(tools) if tools else self.llm_node
 
-        self.executable = prompt | self.llm_node
+        self.executable = prompt | llm
 
         # Build LLM node Agent
         agent = functools.partial(llm_agent, executable=self.executable)
@@ -316,8 +437,8 @@ class WakilAgent:
         workflow.add_node("tools", binded_tools)
         workflow.set_entry_point("llm")
 
-        # Add edges to connect LLM and tool nodes
-        workflow.add_edge("llm", "tools")
+        # Add edges to connect LLM and tool nodes, tools only run when
+        # the LLM asks for them
         workflow.add_conditional_edges("llm", route_tools, ["tools", END])
         workflow.add_edge("tools", "llm")
 
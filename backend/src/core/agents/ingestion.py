@@ -0,0 +1,82 @@
+"""
+Building blocks of the vector DB ingestion pipeline:
+token-aware chunking, batching and throughput reporting
+"""
+
+import functools
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class Chunk:
+    text: str
+    tokens: int
+
+
+@dataclass
+class IngestionStats:
+    chunks: int = 0
+    tokens: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        return (
+            f"{self.chunks} chunks / {self.tokens} tokens in {seconds:.2f}s "
+            f"({self.chunks / seconds:.1f} chunks/s, "
+            f"{self.tokens / seconds:.1f} tokens/s)"
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> Any:
+    """Tokenizer of an embedding model"""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def chunk_text(
+    text: str, encoding: Any, chunk_tokens: int, overlap_tokens: int
+) -> List[Chunk]:
+    """
+    Split text into chunks of at most chunk_tokens tokens,
+    each chunk repeating the last overlap_tokens tokens of the previous one
+    """
+    if overlap_tokens >= chunk_tokens:
+        raise ValueError("Chunk overlap must be smaller than chunk size")
+
+    tokens = encoding.encode(text)
+    step = chunk_tokens - overlap_tokens
+    chunks = []
+    for start in range(0, len(tokens), step):
+        window = tokens[start : start + chunk_tokens]
+        chunk = encoding.decode(window).strip()
+        if chunk:
+            chunks.append(Chunk(text=chunk, tokens=len(window)))
+        if start + chunk_tokens >= len(tokens):
+            break
+    return chunks
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Yield lists of at most size items"""
+    batch: List[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
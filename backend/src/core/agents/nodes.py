@@ -1,9 +1,15 @@
+import asyncio
 import functools
+import hashlib
+import itertools
+import uuid
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Dict, List
+from tempfile import NamedTemporaryFile
+from typing import Dict, List, Optional
 
 import openai
+from botocore.exceptions import ClientError
 from langchain.schema import Document
 from langchain.tools import Tool
 from langchain_community.chat_models import ChatAnthropic
@@ -15,7 +21,18 @@ from loguru import logger
 
 from src.api.fields import PyObjectId
 from src.api.models import Node
+from src.cloud.s3 import s3_key_from_url, s3_service
 from src.cloud.utils import fetch_blob_from_s3
+from src.core.agents.embeddings import embed_texts, embedding_cache
+from src.core.agents.extraction_cache import extraction_cache
+from src.core.agents.ingestion import (
+    Chunk,
+    IngestionStats,
+    batched,
+    chunk_text,
+    get_encoding,
+)
+from src.core.pools import run_blocking
 from src.core.settings import settings
 from src.db.qdrant import get_qdrant, models
 
@@ -59,6 +76,8 @@ class LLMNode:
             ChatOpenAI,
             temperature=temperature,
             openai_api_key=settings.OPENAI_API_KEY,
+            # Retried by the agent nodes, see utils.invoke_llm
+            max_retries=0,
         )
         if self.llm_node.type == "GPT-4":
             self.node = partial_openai(model="gpt-4")
@@ -89,6 +108,7 @@ class LLMNode:
             temperature=temperature,
             anthropic_api_key=settings.ANTHROPIC_API_KEY,
             model=model,
+            max_retries=0,
         )
 
     async def llm(self):
@@ -112,9 +132,31 @@ class BaseNode(ABC):
         self.node = node
 
 
+def content_hash(*parts: str) -> str:
+    """Stable hash of one or more strings"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def file_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 of a file's content, read chunk by chunk"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class BaseDataNode(BaseNode):
     """Base class for all data node types"""
 
+    # Whether the content behind a source can never change,
+    # if so an unchanged source fingerprint is enough to skip loading
+    immutable_source: bool = False
+
     def __init__(self, node: Node):
         self.node = node
 
@@ -123,6 +165,14 @@ class BaseDataNode(BaseNode):
         """Abstract method to load data"""
         pass
 
+    @abstractmethod
+    def source_key(self) -> str:
+        """Identify where the data comes from (URL, query, S3 key...)"""
+        pass
+
+    def source_fingerprint(self) -> str:
+        return content_hash(self.node.type, self.source_key())
+
     @staticmethod
     def _format_output(content):
         """Format the output to a standardized string"""
@@ -147,11 +197,14 @@ class URLScraperNode(BaseDataNode):
         if not self.url:
             raise ValueError("No URL found in metadata in URLScraper Node.")
 
+    def source_key(self) -> str:
+        return self.url
+
     async def load_data(self):
         """Load data from URL"""
         try:
             loader = WebBaseLoader(self.url)
-            content = loader.load()
+            content = await run_blocking(loader.load)
             return self._format_output(content)
         except Exception as e:
             logger.error(f"Error loading data from URL: {e}")
@@ -169,11 +222,14 @@ class WikipediaLoader(BaseDataNode):
                 "No query found in metadata in WikipediaLoader Node."
             )
 
+    def source_key(self) -> str:
+        return self.query
+
     async def load_data(self):
         """Load data from Wikipedia"""
         try:
             loader = WikipediaQueryRun(api_wrapper=WikipediaAPIWrapper())
-            content = loader.run(tool_input=self.query)
+            content = await run_blocking(loader.run, tool_input=self.query)
             return self._format_output(content)
         except Exception as e:
             logger.error(f"Error loading data from Wikipedia: {e}")
@@ -185,6 +241,16 @@ class WikipediaLoader(BaseDataNode):
 class FileUploadNode(BaseDataNode):
     """File Upload Node for retrieving blobs from AWS S3"""
 
+    # Uploaded files get a unique key, so same key means same content
+    immutable_source = True
+
+    def source_key(self) -> str:
+        """S3 key of the file, presigned URLs' query strings are dropped"""
+        url = self.node.data.metadata.get("url")
+        if not url:
+            raise ValueError("No URL found in metadata in FileUpload Node.")
+        return s3_key_from_url(url)
+
     async def load_data(self):
         """Retrieve and process data from S3 presigned url"""
         url = self.node.data.metadata.get("url")
@@ -192,28 +258,55 @@ class FileUploadNode(BaseDataNode):
             raise ValueError("No URL found in metadata in FileUpload Node.")
 
         try:
-            data = await fetch_blob_from_s3(url)
-            content = await self._process_file(url, data)
+            key = self.source_key()
+            try:
+                etag = await s3_service.etag(key)
+            except ClientError:
+                # No HEAD access, fall back to hashing the content below
+                etag = None
+
+            # Documents without text are cached as "", a hit as well
+            content = None
+            if etag:
+                content = await extraction_cache.get(key, etag)
+            if content is not None:
+                logger.info(f"Extraction cache hit for {key}")
+                return self._format_output(content)
+
+            # Parsed out of process, so the blob goes to disk, not memory
+            with NamedTemporaryFile() as file:
+                await fetch_blob_from_s3(url, file)
+                if etag is None:
+                    etag = await run_blocking(file_hash, file.name)
+                    content = await extraction_cache.get(key, etag)
+                    if content is not None:
+                        return self._format_output(content)
+                content = await self._process_file(url, file.name)
+            await extraction_cache.set(key, etag, content)
             return self._format_output(content)
         except Exception as e:
             logger.error(f"Error loading data from S3: {e}")
             raise ValueError(f"Error loading data from S3: {url}")
 
     @staticmethod
-    async def _process_file(url: str, data):
-        """Process the file based on its type"""
-        from src.core.agents.utils import process_docx, process_pdf
+    async def _process_file(url: str, path: str):
+        """Process the file based on its type, off the event loop"""
+        from src.core.agents.utils import (
+            process_docx,
+            process_pdf,
+            process_txt,
+        )
 
         # Retrieve file from url
         file_type = url.rsplit("/", 1)[-1].split("?", 1)[0]
 
         logger.info(file_type)
         if file_type.endswith(".pdf"):
-            return await process_pdf(data)
+            return await process_pdf(path)
         elif file_type.endswith(".docx"):
-            return await process_docx(data)
+            return await process_docx(path)
         elif file_type.endswith(".txt"):
-            return data.decode("utf-8")
+            return await process_txt(path)
         else:
             raise ValueError(
                 "Unsupported file type. Only PDF, DOCX, and TXT are allowed."
@@ -227,8 +320,9 @@ class BaseVectorDBNode(ABC):
     Defines the common interface for ingesting data and querying the database.
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, node_id: Optional[str] = None, **kwargs):
         super().__init__(**kwargs)
+        self.node_id = node_id  # ID of the vector db node in the graph
 
     @abstractmethod
     async def ingest_data(
@@ -237,6 +331,7 @@ class BaseVectorDBNode(ABC):
         user_id: PyObjectId,
         graph_id: PyObjectId,
         node_id: PyObjectId,
+        source_id: Optional[str] = None,
     ) -> List[int]:
         """
         Ingests data into the vector database by computing vector representations.
@@ -246,12 +341,30 @@ class BaseVectorDBNode(ABC):
             user_id (PyObjectId): The ID of the user ingesting the data.
             graph_id (PyObjectId): The ID of the graph to which the data belongs.
             node_id (PyObjectId): The ID of the node in the graph.
+            source_id (Optional[str]): The ID of the data node the data comes from.
 
         Returns:
             List[int]: A list of blob IDs that were successfully ingested.
         """
         pass
 
+    @abstractmethod
+    async def delete_data(
+        self,
+        graph_id: PyObjectId,
+        node_id: PyObjectId,
+        source_ids: List[str],
+    ) -> None:
+        """
+        Deletes the vectors ingested from the given data nodes.
+
+        Args:
+            graph_id (PyObjectId): The ID of the graph to which the data belongs.
+            node_id (PyObjectId): The ID of the vector db node in the graph.
+            source_ids (List[str]): The IDs of the data nodes to forget.
+        """
+        pass
+
     @abstractmethod
     async def query_db(self, query: str) -> List[Dict]:
         """
@@ -288,27 +401,69 @@ class BaseVectorDBNode(ABC):
 
             return "\n\n".join(formatted_results)
 
+        # Async only, called by ToolNode through ainvoke
         return Tool(
             name=f"{self.__class__.__name__}RAGTool",
-            func=rag_tool,
+            func=None,
+            coroutine=rag_tool,
             description=f"A tool to retrieve relevant information from the {self.__class__.__name__} vector database based on a given query.",
         )
 
 
 class QdrantNode(BaseVectorDBNode):
+    @staticmethod
+    def _point_id(
+        graph_id: PyObjectId,
+        node_id: PyObjectId,
+        source_id: Optional[str],
+        index: int,
+    ) -> str:
+        """Deterministic point id, so re-ingesting a source overwrites it"""
+        return str(
+            uuid.uuid5(
+                uuid.NAMESPACE_URL,
+                f"{graph_id}/{node_id}/{source_id}/{index}",
+            )
+        )
+
+    @staticmethod
+    def _sources_filter(
+        graph_id: PyObjectId, node_id: PyObjectId, source_ids: List[str]
+    ) -> models.Filter:
+        return models.Filter(
+            must=[
+                models.FieldCondition(
+                    key="graph_id",
+                    match=models.MatchValue(value=str(graph_id)),
+                ),
+                models.FieldCondition(
+                    key="node_id",
+                    match=models.MatchValue(value=str(node_id)),
+                ),
+                models.FieldCondition(
+                    key="source_id",
+                    match=models.MatchAny(any=source_ids),
+                ),
+            ]
+        )
+
     async def ingest_data(
         self,
         data: List[Dict[str, str]],  # List of different data sources
         user_id: PyObjectId,
         graph_id: PyObjectId,
         node_id: PyObjectId,
+        source_id: Optional[str] = None,
     ):
         """
         Ingest data into Qdrant database by computing vector representations.
         A blob is a datum that is either URL Scraped, file upload, etc
+        Blobs are split into overlapping token chunks, embedded by batches
+        (a few batches in flight at once) and upserted by batches too.
 
         Args:
             data (Dict[str, str]): A dictionary where keys are identifiers and values are the text to be vectorized.
+            source_id (Optional[str]): Data node the data comes from, its previous vectors are replaced.
 
         Returns:
             List[int]: A list of user blob IDs that were successfully ingested.
@@ -318,44 +473,100 @@ class QdrantNode(BaseVectorDBNode):
         if qdrant_db is None:
             return []
 
-        openai_client = openai.AsyncClient(api_key=settings.OPENAI_API_KEY)
+        stats = IngestionStats()
+        encoding = get_encoding(settings.EMBEDDING_MODEL)
+        chunks: List[Chunk] = []
+        for datum in data:
+            chunks += await run_blocking(
+                chunk_text,
+                datum,
+                encoding,
+                settings.EMBEDDING_CHUNK_TOKENS,
+                settings.EMBEDDING_CHUNK_OVERLAP,
+            )
+        if not chunks:
+            logger.warning(f"No content to ingest for {node_id}")
+            return []
+
+        semaphore = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+
+        async def embed(batch: List[Chunk]) -> List[List[float]]:
+            async with semaphore:
+                vectors = await embed_texts([chunk.text for chunk in batch])
+                stats.chunks += len(batch)
+                stats.tokens += sum(chunk.tokens for chunk in batch)
+                return vectors
+
         try:
-            embeddings = await openai_client.embeddings.create(
-                input=list(datum for datum in data),
-                model="text-embedding-3-small",
+            batches = await asyncio.gather(
+                *(
+                    embed(batch)
+                    for batch in batched(chunks, settings.EMBEDDING_BATCH_SIZE)
+                )
             )
-            # logger.info(embeddings)
-            embeddings = embeddings.data
         except openai.APIError as e:
             logger.warning(f"Error while embedding the blob: {e}")
             return []
 
+        created_at = datetime.now().isoformat()
+        points = [
+            models.PointStruct(
+                id=self._point_id(graph_id, node_id, source_id, index),
+                vector=vector,
+                payload={
+                    "user_id": str(user_id),
+                    "graph_id": str(graph_id),
+                    "node_id": str(node_id),
+                    "source_id": source_id,
+                    "chunk_index": index,
+                    "content": chunk.text,
+                    "created_at": created_at,
+                    # "metadata": self.metadata,
+                },
+            )
+            for index, (chunk, vector) in enumerate(
+                zip(chunks, itertools.chain.from_iterable(batches))
+            )
+        ]
         try:
             # logger.info(data)
-            await qdrant_db.upsert(
-                collection_name="user_data",
-                points=[
-                    models.PointStruct(
-                        id=str(node_id),
-                        vector=embedding.embedding,
-                        payload={
-                            "user_id": str(user_id),
-                            "graph_id": str(graph_id),
-                            "node_id": node_id,
-                            "created_at": datetime.now().isoformat(),
-                            # "metadata": self.metadata,
-                        },
-                    )
-                    # Fix error:'list' object has no attribute 'keys'
-                    for key, embedding in zip(
-                        [datum for datum in data], embeddings
-                    )
-                ],
-            )
+            if source_id is not None:
+                # Source might now yield fewer chunks than previously
+                await self.delete_data(graph_id, node_id, [source_id])
+            for batch in batched(points, settings.QDRANT_UPSERT_BATCH_SIZE):
+                await qdrant_db.upsert(
+                    collection_name="user_data", points=batch
+                )
         except Exception as e:
             logger.warning(f"Error while adding the user data to Qdrant: {e}")
             return []
 
+        logger.info(f"Ingested {node_id}'s data: {stats}")
+        return [point.id for point in points]
+
+    async def delete_data(
+        self,
+        graph_id: PyObjectId,
+        node_id: PyObjectId,
+        source_ids: List[str],
+    ) -> None:
+        """Delete the vectors of the given data nodes from Qdrant"""
+        if not source_ids:
+            return
+        qdrant_db = await get_qdrant()
+        if qdrant_db is None:
+            return
+
+        await qdrant_db.delete(
+            collection_name="user_data",
+            points_selector=models.FilterSelector(
+                filter=self._sources_filter(graph_id, node_id, source_ids)
+            ),
+        )
+        logger.info(
+            f"Deleted vectors of data nodes {source_ids} from Qdrant node {node_id}"
+        )
+
     async def query_db(self, query: str) -> List[Dict]:
         """
         RAG Tool for an Agent
@@ -376,12 +587,9 @@ class QdrantNode(BaseVectorDBNode):
         if qdrant_db is None:
             return []
 
-        openai_client = openai.AsyncClient()
         try:
-            embedding_response = await openai_client.embeddings.create(
-                input=query, model="text-embedding-ada-002"
-            )
-            query_embedding = embedding_response["data"][0]["embedding"]
+            # Must be the model the data was ingested with
+            [query_embedding] = await embed_texts([query])
         except openai.APIError as e:
             logger.warning(f"Error while embedding the query: {e}")
             return []
@@ -394,12 +602,13 @@ class QdrantNode(BaseVectorDBNode):
                     must=[
                         models.FieldCondition(
                             key="node_id",
-                            match=models.MatchValue(value=self.node_id),
+                            match=models.MatchValue(value=str(self.node_id)),
                         )
                     ]
                 ),
                 limit=5,
             )
+            logger.debug(f"Embedding cache: {embedding_cache.stats()}")
             results = [
                 {
                     "id": result.id,
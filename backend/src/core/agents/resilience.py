@@ -0,0 +1,63 @@
+"""
+Timeouts and retries of LLM calls made by agent nodes. Retries wait a
+random delay (full jitter) so that sessions failing together don't retry
+together. Cancellation is never retried nor swallowed.
+"""
+
+import asyncio
+import random
+from typing import Awaitable, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Rate limited, conflict, timeout on the provider side, server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Timeouts, connection errors and retryable HTTP statuses, whatever
+    provider SDK raised them (they expose status_code, or name their
+    connection and timeout errors that way)
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    name = type(error).__name__
+    return name.endswith("ConnectionError") or name.endswith("TimeoutError")
+
+
+def backoff_delays(
+    retries: int,
+    base_delay: float,
+    max_delay: float,
+    rng: Callable[[float, float], float] = random.uniform,
+) -> Iterator[float]:
+    """Delay before each retry, uniform up to an exponential ceiling"""
+    for attempt in range(retries):
+        yield rng(0, min(max_delay, base_delay * 2**attempt))
+
+
+async def call_with_retries(
+    call: Callable[[], Awaitable[T]],
+    timeout: Optional[float],
+    retries: int,
+    base_delay: float,
+    max_delay: float,
+    retryable: Callable[[Exception], bool] = is_retryable,
+) -> T:
+    """
+    Await call(), a fresh awaitable per attempt, giving up after timeout
+    seconds, and retry retryable failures up to retries times
+    """
+    delays = backoff_delays(retries, base_delay, max_delay)
+    while True:
+        try:
+            return await asyncio.wait_for(call(), timeout=timeout)
+        except Exception as e:
+            delay = next(delays, None)
+            if delay is None or not retryable(e):
+                raise
+        await asyncio.sleep(delay)
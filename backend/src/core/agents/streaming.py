@@ -0,0 +1,113 @@
+"""
+Incremental execution of compiled agents: LangGraph events are turned
+into small frames (tokens, tool calls) as they happen, so clients see the
+answer being written instead of waiting for the whole tool loop
+"""
+
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+
+from src.core.settings import settings
+
+
+def _content(output: Any) -> Any:
+    """Content of messages (LLM answers, ToolMessage), other values as is"""
+    return getattr(output, "content", output)
+
+
+async def stream_agent(
+    agent: CompiledStateGraph,
+    input: Dict[str, Any],
+    config: RunnableConfig,
+    token_interval: Optional[float] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run the agent and yield frames:
+    - token: a piece of the answer, coalesced over token_interval seconds
+    - tool_start / tool_end: a tool call and its output
+    - message: the complete answer of one LLM call
+    - retry: an LLM call failed and is retried, its tokens are to drop
+    - end: the run finished
+
+    Every frame but end carries the run_id of its LLM or tool call, token
+    frames never mix the tokens of two calls
+    """
+    if token_interval is None:
+        token_interval = settings.AGENT_TOKEN_INTERVAL
+    tokens: list[str] = []
+    tokens_run_id: Optional[str] = None
+    # Graph task (checkpoint ns) -> its LLM call that has not ended yet
+    open_calls: Dict[str, str] = {}
+    flushed_at = time.perf_counter()
+
+    def flush() -> Optional[Dict[str, Any]]:
+        nonlocal flushed_at
+        flushed_at = time.perf_counter()
+        if not tokens:
+            return None
+        frame = {
+            "type": "token",
+            "run_id": tokens_run_id,
+            "content": "".join(tokens),
+        }
+        tokens.clear()
+        return frame
+
+    async for event in agent.astream_events(input, config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            chunk = event["data"]["chunk"].content
+            if isinstance(chunk, str) and chunk:
+                # The first token of a call goes out at once, the next
+                # ones in batches
+                first = event["run_id"] != tokens_run_id
+                if first:
+                    if frame := flush():
+                        yield frame
+                    tokens_run_id = event["run_id"]
+                tokens.append(chunk)
+                if first or time.perf_counter() - flushed_at >= token_interval:
+                    yield flush()
+            continue
+
+        task = event.get("metadata", {}).get("langgraph_checkpoint_ns", "")
+        if kind == "on_chat_model_start":
+            # A task runs one LLM call at a time, a new one while the
+            # previous never ended means that one failed and is retried
+            if failed := open_calls.get(task):
+                if frame := flush():
+                    yield frame
+                yield {"type": "retry", "run_id": failed}
+            open_calls[task] = event["run_id"]
+        elif kind == "on_chat_model_end":
+            open_calls.pop(task, None)
+            if frame := flush():
+                yield frame
+            yield {
+                "type": "message",
+                "run_id": event["run_id"],
+                "content": _content(event["data"].get("output")),
+            }
+        elif kind == "on_tool_start":
+            if frame := flush():
+                yield frame
+            yield {
+                "type": "tool_start",
+                "run_id": event["run_id"],
+                "name": event["name"],
+                "input": _content(event["data"].get("input")),
+            }
+        elif kind == "on_tool_end":
+            yield {
+                "type": "tool_end",
+                "run_id": event["run_id"],
+                "name": event["name"],
+                "output": _content(event["data"].get("output")),
+            }
+
+    if frame := flush():
+        yield frame
+    yield {"type": "end"}
@@ -3,14 +3,31 @@ Different methods that help in building an Agent
 """
 
 # Define the function that determines whether to continue or not
-import io
+import asyncio
+import itertools
 import json
-from typing import List, Literal, Type, Union
+from typing import Callable, List, Literal, Type, Union
 
+from langchain_core.runnables import RunnableConfig
+from loguru import logger
 from typing_extensions import TypedDict
 
 from src.api.models import Agent, Edge, Graph, Node
+from src.core.agents.extraction import (
+    count_pdf_pages,
+    extract_docx,
+    extract_pdf_pages,
+    extract_txt,
+)
 from src.core.agents.nodes import URLScraperNode, WikipediaLoader
+from src.core.agents.resilience import call_with_retries
+from src.core.pools import (
+    extraction_pool,
+    extraction_progress,
+    run_in_pool,
+    run_in_process,
+)
+from src.core.settings import settings
 
 
 def should_continue(state):
@@ -177,31 +194,111 @@ class GraphValidationError(Exception):
 # File Processing
 
 
-async def process_pdf(data: bytes) -> str:
-    from PyPDF2 import PdfReader
+def log_extraction_progress(pages_done: int, pages_total: int) -> None:
+    logger.info(f"PDF extraction: {pages_done}/{pages_total} pages")
 
-    """Process PDF data and return extracted text."""
 
-    reader = PdfReader(io.BytesIO(data))
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text() or ""
-    return text
+async def process_pdf(
+    path: str,
+    on_progress: Callable[[int, int], None] = log_extraction_progress,
+) -> str:
+    """
+    Process PDF file and return extracted text.
+    Parsing happens in processes of the document's own, big PDFs being
+    split into page ranges parsed in parallel. on_progress(pages_done,
+    pages_total) is called as pages complete. Past EXTRACTION_TIMEOUT the
+    processes are killed, other documents are not affected.
+    """
+    pages_total = pages_done = 0
+
+    def pages_extracted(pages: int) -> None:
+        nonlocal pages_done
+        # Reports can arrive after the results, see the end of extraction
+        if pages_done < pages_total:
+            pages_done = min(pages_done + pages, pages_total)
+            on_progress(pages_done, pages_total)
+
+    futures = []
+    try:
+        with extraction_progress(pages_extracted) as job:
+            async with (
+                extraction_pool() as pool,
+                asyncio.timeout(settings.EXTRACTION_TIMEOUT),
+            ):
+                pages_total = await run_in_pool(pool, count_pdf_pages, path)
+                if pages_total > settings.PDF_MAX_PAGES:
+                    raise ValueError(
+                        f"PDF has {pages_total} pages, more than the "
+                        f"{settings.PDF_MAX_PAGES} pages allowed"
+                    )
+
+                step = settings.PDF_PAGES_PER_TASK
+                futures = [
+                    run_in_pool(
+                        pool,
+                        extract_pdf_pages,
+                        path,
+                        start,
+                        min(start + step, pages_total),
+                        job,
+                    )
+                    for start in range(0, pages_total, step)
+                ]
+                await asyncio.gather(*futures)
+            pages_extracted(pages_total - pages_done)
+    except TimeoutError:
+        raise ValueError(
+            f"PDF extraction timed out after {settings.EXTRACTION_TIMEOUT}s"
+        )
+    finally:
+        # Don't leave queued page ranges behind on failure
+        for future in futures:
+            future.cancel()
+
+    return "".join(itertools.chain.from_iterable(f.result() for f in futures))
+
+
+async def process_docx(path: str) -> str:
+    """Process DOCX file and return extracted text."""
+    try:
+        async with extraction_pool(processes=1) as pool:
+            return await asyncio.wait_for(
+                run_in_pool(pool, extract_docx, path),
+                timeout=settings.EXTRACTION_TIMEOUT,
+            )
+    except asyncio.TimeoutError:
+        raise ValueError(
+            f"DOCX extraction timed out after {settings.EXTRACTION_TIMEOUT}s"
+        )
 
 
-async def process_docx(data: bytes) -> str:
-    from docx import Document
+async def process_txt(path: str) -> str:
+    """Decode a UTF-8 text file."""
+    return await run_in_process(extract_txt, path)
 
-    """Process DOCX data and return extracted text."""
 
-    doc = Document(io.BytesIO(data))
-    text = []
-    for paragraph in doc.paragraphs:
-        text.append(paragraph.text)
-    return "\n".join(text)
+async def invoke_llm(executable, state, config: RunnableConfig):
+    """
+    ainvoke with the agent timeout and retries. Models are built with
+    max_retries=0 so that these are the only retries. A retried call
+    streams its tokens again under a new run_id, after a retry frame
+    naming the failed one (see streaming.stream_agent)
+    """
+    return await call_with_retries(
+        lambda: executable.ainvoke(state, config),
+        timeout=settings.AGENT_LLM_TIMEOUT,
+        retries=settings.AGENT_LLM_RETRIES,
+        base_delay=settings.AGENT_RETRY_BASE_DELAY,
+        max_delay=settings.AGENT_RETRY_MAX_DELAY,
+    )
 
 
-async def llm_agent(state: Type[TypedDict], executable) -> Type[TypedDict]:  # type: ignore
-    prediction = executable.invoke(state)
+async def llm_agent(
+    state: Type[TypedDict],  # type: ignore
+    config: RunnableConfig,
+    executable,
+) -> Type[TypedDict]:  # type: ignore
+    # The config carries the callbacks streaming tokens to astream_events
+    prediction = await invoke_llm(executable, state, config)
 
     return {"messages": [prediction]}
@@ -3,6 +3,8 @@ from typing import Optional
 import aiohttp
 from loguru import logger
 
+from src.core.clients import get_http_session
+
 
 async def trigger_webhook(
     url: str, json: dict, timeout: int = 3, headers: Optional[dict] = None
@@ -27,18 +29,17 @@ async def trigger_webhook(
 
     try:
         logger.info(f"Triggering webhook: {url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url, json=json, timeout=timeout, headers=headers
-            ) as response:
-                response.raise_for_status()
-                logger.info(
-                    f"Webhook triggered successfully: {response.status}"
-                )
-                response_txt = await response.text()
-            await session.close()
+        session = get_http_session()
+        async with session.post(
+            url,
+            json=json,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=headers,
+        ) as response:
+            response.raise_for_status()
+            logger.info(f"Webhook triggered successfully: {response.status}")
+            response_txt = await response.text()
         return response_txt
     except aiohttp.ClientError as e:
         logger.error(f"Error sending webhook to {url}: {e}")
-        await session.close()
         return None
@@ -0,0 +1,66 @@
+"""
+Long-lived, pooled clients shared by the whole app,
+opened and closed in the app's lifespan
+"""
+
+from typing import Optional
+
+import aiohttp
+import httpx
+import openai
+from loguru import logger
+
+from src.core.settings import settings
+
+openai_client: Optional[openai.AsyncClient] = None
+http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_openai() -> openai.AsyncClient:
+    global openai_client
+
+    if openai_client is None:
+        openai_client = openai.AsyncClient(
+            api_key=settings.OPENAI_API_KEY,
+            timeout=settings.OPENAI_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=settings.OPENAI_TIMEOUT,
+            ),
+        )
+    return openai_client
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Shared aiohttp session, must be called from within the event loop"""
+    global http_session
+
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.HTTP_MAX_CONNECTIONS,
+                limit_per_host=settings.HTTP_MAX_CONNECTIONS_PER_HOST,
+            )
+        )
+    return http_session
+
+
+async def init_clients():
+    get_openai()
+    get_http_session()
+    logger.info("Shared clients initialized")
+
+
+async def close_clients():
+    global openai_client, http_session
+
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+    logger.info("Shared clients closed")
@@ -0,0 +1,205 @@
+"""
+Executors used to keep blocking work off the event loop
+"""
+
+import asyncio
+import functools
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from multiprocessing.pool import Pool
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from loguru import logger
+
+from src.core.agents.extraction import init_extraction_worker
+from src.core.settings import settings
+
+T = TypeVar("T")
+
+_loader_pool: Optional[ThreadPoolExecutor] = None
+_hashing_pool: Optional[ProcessPoolExecutor] = None
+
+# Extraction workers report progress on this queue, relayed by a thread
+# to the listener of each job on its event loop
+_extraction_progress: Optional["multiprocessing.Queue"] = None
+progress_listeners: Dict[
+    str, Tuple[asyncio.AbstractEventLoop, Callable[[int], None]]
+] = {}
+
+# Caps the number of data nodes being loaded at once across the app
+loader_semaphore = asyncio.Semaphore(settings.DATA_LOADER_CONCURRENCY)
+
+# Caps the number of documents being parsed at once across the app
+extraction_semaphore = asyncio.Semaphore(settings.EXTRACTION_JOBS)
+
+
+def get_loader_pool() -> ThreadPoolExecutor:
+    """Thread pool for blocking I/O bound loaders (scrapers, wikipedia...)"""
+    global _loader_pool
+
+    if _loader_pool is None:
+        _loader_pool = ThreadPoolExecutor(
+            max_workers=settings.DATA_LOADER_THREADS,
+            thread_name_prefix="data-loader",
+        )
+    return _loader_pool
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking callable in the loader thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_loader_pool(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _relay_progress(queue: "multiprocessing.Queue") -> None:
+    while (message := queue.get()) is not None:
+        job, pages = message
+        listener = progress_listeners.get(job)
+        if listener is not None:
+            loop, callback = listener
+            try:
+                loop.call_soon_threadsafe(callback, pages)
+            except RuntimeError:
+                # Loop closed
+                pass
+
+
+def get_extraction_progress() -> "multiprocessing.Queue":
+    """Queue extraction workers report progress on, started with its relay"""
+    global _extraction_progress
+
+    if _extraction_progress is None:
+        _extraction_progress = multiprocessing.Queue()
+        threading.Thread(
+            target=_relay_progress,
+            args=(_extraction_progress,),
+            name="extraction-progress",
+            daemon=True,
+        ).start()
+    return _extraction_progress
+
+
+@contextmanager
+def extraction_progress(callback: Callable[[int], None]) -> Iterator[str]:
+    """
+    Job id to pass to extraction tasks, callback(pages) is called on the
+    running loop as their workers report extracted pages
+    """
+    job = uuid.uuid4().hex
+    progress_listeners[job] = (asyncio.get_running_loop(), callback)
+    try:
+        yield job
+    finally:
+        del progress_listeners[job]
+
+
+@asynccontextmanager
+async def extraction_pool(
+    processes: Optional[int] = None,
+) -> AsyncIterator[Pool]:
+    """
+    Processes parsing one document, EXTRACTION_PROCESSES by default, for at
+    most EXTRACTION_JOBS documents at once. They are killed when leaving the
+    block, so a document past its timeout stops being parsed without
+    failing the documents parsed by other processes.
+    """
+    async with extraction_semaphore:
+        pool = multiprocessing.Pool(
+            processes or settings.EXTRACTION_PROCESSES,
+            initializer=init_extraction_worker,
+            initargs=(get_extraction_progress(),),
+        )
+        try:
+            yield pool
+        finally:
+            # Joins the pool threads, off the loop
+            await asyncio.to_thread(pool.terminate)
+
+
+def run_in_pool(
+    pool: Pool, func: Callable[..., T], *args: Any
+) -> "asyncio.Future[T]":
+    """
+    Run a picklable, module level function in a process of the pool.
+    A worker dying mid task is replaced but its task never completes,
+    callers wait with a timeout.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result: Any, error: Optional[BaseException]) -> None:
+        # Cancelled on timeout
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def call_back(result: Any, error: Optional[BaseException] = None) -> None:
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            # Loop closed
+            pass
+
+    pool.apply_async(
+        func,
+        args,
+        callback=call_back,
+        error_callback=lambda error: call_back(None, error),
+    )
+    return future
+
+
+async def run_in_process(func: Callable[..., T], *args: Any) -> T:
+    """Run a picklable, module level function in a process of its own"""
+    async with extraction_pool(processes=1) as pool:
+        return await run_in_pool(pool, func, *args)
+
+
+def get_hashing_pool() -> ProcessPoolExecutor:
+    """
+    Process pool dedicated to password hashing, kept apart from the
+    extraction pool so that a big upload doesn't delay logins
+    """
+    global _hashing_pool
+
+    if _hashing_pool is None:
+        _hashing_pool = ProcessPoolExecutor(
+            max_workers=settings.HASHING_PROCESSES
+        )
+    return _hashing_pool
+
+
+def shutdown_pools() -> None:
+    global _loader_pool, _hashing_pool, _extraction_progress
+
+    if _loader_pool is not None:
+        _loader_pool.shutdown(wait=False, cancel_futures=True)
+        _loader_pool = None
+        logger.info("Loader thread pool shut down")
+    if _extraction_progress is not None:
+        # Stops the relay thread, document pools are killed as their
+        # extractions are cancelled
+        _extraction_progress.put(None)
+        _extraction_progress = None
+        logger.info("Extraction progress relay stopped")
+    if _hashing_pool is not None:
+        _hashing_pool.shutdown(wait=False, cancel_futures=True)
+        _hashing_pool = None
+        logger.info("Hashing process pool shut down")
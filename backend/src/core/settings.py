@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -35,6 +37,14 @@ class AppSettings(BaseSettings):
     AWS_SECRET_ACCESS_KEY: str
     AWS_REGION_NAME: str
     S3_BUCKET_NAME: str
+    S3_ENDPOINT_URL: Optional[str] = None  # Local S3 stand-in (MinIO...)
+    S3_MAX_CONNECTIONS: int = 50
+    S3_MULTIPART_THRESHOLD: int = 8 * 1024 * 1024  # Bytes
+    S3_MULTIPART_CHUNKSIZE: int = 8 * 1024 * 1024  # Bytes
+    S3_MAX_CONCURRENCY: int = 4  # Parts uploaded at once per file
+    S3_UPLOAD_PART_SIZE: int = 8 * 1024 * 1024  # Bytes, at least 5 MiB
+    MAX_UPLOAD_SIZE: int = 256 * 1024 * 1024  # Bytes
+    DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024  # Bytes
 
     # Stripe
     STRIPE_SECRET_KEY: str
@@ -46,6 +56,94 @@ class AppSettings(BaseSettings):
     # Resend
     RESEND_API_KEY: str
 
+    # Agents
+    COMPILED_AGENT_CACHE_SIZE: int = 64
+    AGENT_TOKEN_INTERVAL: float = 0.05  # Seconds, tokens streamed per frame
+    AGENT_LLM_TIMEOUT: float = 60  # Seconds, per LLM call of agent nodes
+    AGENT_LLM_RETRIES: int = 2  # On timeouts, rate limits, 5xx
+    AGENT_RETRY_BASE_DELAY: float = 0.5  # Seconds, doubled at each retry
+    AGENT_RETRY_MAX_DELAY: float = 8  # Seconds
+
+    # Users subscription plan and status, see security.entitlements
+    ENTITLEMENT_CACHE_SIZE: int = 10_000
+    # Seconds, also how long other workers may see a changed plan
+    ENTITLEMENT_CACHE_TTL: float = 60
+
+    # Authenticated principals, keyed by token digest
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    PRINCIPAL_CACHE_TTL: float = 300  # Seconds, capped by token expiry
+
+    # Password hashing, see security.hashing
+    BCRYPT_ROUNDS: int = 12  # Hashes with other costs are redone on login
+    HASHING_PROCESSES: int = 2  # Process pool for bcrypt
+    HASHING_QUEUE_LIMIT: int = 32  # Hashes pending at once before 429s
+
+    # Session websockets, see api.websocket
+    WS_SEND_QUEUE_SIZE: int = 64  # Frames queued per client before eviction
+    WS_SEND_TIMEOUT: float = 10  # Seconds, per frame
+    WS_BUS_BACKEND: str = "memory"  # "mongo" when running several workers
+    WS_BUS_COLLECTION: str = "session_bus"
+    WS_BUS_CAPPED_SIZE: int = 64 * 1024 * 1024  # Bytes
+    WS_BUS_RETRY_INTERVAL: float = 1  # Seconds, after losing the cursor
+    WS_BUS_BATCH_INTERVAL: float = 0.1  # Seconds, frames written per insert
+    WS_BUS_SEQUENCE_TTL: int = 24 * 3600  # Seconds, idle session counters
+    WS_PRESENCE_INTERVAL: float = 20  # Seconds, member counts refresh
+    WS_PRESENCE_TTL: float = 60  # Seconds, counts of a silent worker
+    WS_RUN_LEASE: float = 30  # Seconds, agent run lease of a session
+    WS_RUN_HEARTBEAT: float = 5  # Seconds, lease renewal, members check
+
+    # Data nodes loading
+    DATA_LOADER_THREADS: int = 8  # Thread pool for blocking loaders
+    DATA_LOADER_CONCURRENCY: int = 8  # Data nodes loaded at once, app-wide
+    DATA_LOADER_TIMEOUT: float = 60  # Seconds, per data node
+
+    # Documents text extraction
+    EXTRACTION_PROCESSES: int = 2  # Processes parsing one PDF
+    EXTRACTION_JOBS: int = 2  # Documents parsed at once, app-wide
+    EXTRACTION_TIMEOUT: float = 120  # Seconds, per document
+    PDF_MAX_PAGES: int = 2000
+    PDF_PAGES_PER_TASK: int = 25  # Big PDFs are split in page ranges
+    EXTRACTION_CACHE_DIR: str = "/tmp/wakil/extraction_cache"
+    EXTRACTION_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    EXTRACTION_CACHE_GRIDFS: bool = False  # Shared cache tier in MongoDB
+
+    # LangGraph checkpoints, stored in their own database
+    CHECKPOINT_DB: str = "ai_saas"
+    CHECKPOINT_CODEC: str = "zlib"  # raw, zlib, lzma or zstd
+    CHECKPOINT_COMPRESSION_THRESHOLD: int = 1024  # Bytes, smaller stay raw
+    # Checkpoints retention, compaction deletes checkpoints that are
+    # neither among the last ones of their thread, recent, nor branch points
+    CHECKPOINT_KEEP_LAST: int = 20  # Per thread, at least 1
+    CHECKPOINT_KEEP_NEWER_THAN: int = 7 * 24 * 3600  # Seconds, 0 to disable
+    CHECKPOINT_COMPACTION_INTERVAL: int = 3600  # Seconds, 0 to disable
+    CHECKPOINT_COMPACTION_BATCH_SIZE: int = 500  # Checkpoints per delete
+    # Write-behind: checkpoints are buffered and written per thread in bulk
+    CHECKPOINT_WRITE_BEHIND: bool = False
+    CHECKPOINT_FLUSH_INTERVAL: float = 0.05  # Seconds
+    CHECKPOINT_FLUSH_SIZE: int = 100  # Buffered operations per thread
+    CHECKPOINT_FLUSH_MAX_DELAY: float = 5.0  # Seconds between failed flushes
+
+    # Embeddings
+    # /!\ Qdrant collection is sized for this model, see init_qdrant
+    EMBEDDING_MODEL: str = "text-embedding-3-small"
+    EMBEDDING_CHUNK_TOKENS: int = 512
+    EMBEDDING_CHUNK_OVERLAP: int = 64
+    EMBEDDING_BATCH_SIZE: int = 64  # Chunks per embeddings request
+    EMBEDDING_CONCURRENCY: int = 4  # Embeddings requests in flight
+    QDRANT_UPSERT_BATCH_SIZE: int = 256
+    EMBEDDING_CACHE_SIZE: int = 10_000  # In-memory entries per worker
+    EMBEDDING_CACHE_MONGO: bool = False  # Shared cache tier in MongoDB
+    EMBEDDING_CACHE_TTL: int = 7 * 24 * 3600  # Seconds, Mongo tier only
+
+    # Shared clients connection pools
+    OPENAI_MAX_CONNECTIONS: int = 100
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    OPENAI_TIMEOUT: float = 60  # Seconds
+    QDRANT_MAX_CONNECTIONS: int = 100
+    QDRANT_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = 10
+
 
 """    def setup_logging(self):
         Sets up logging based on the environment.
@@ -1,9 +1,10 @@
 import importlib
 from datetime import datetime, timezone
-from typing import Any, Dict, cast
+from typing import Any, AsyncIterator, Dict, List, Optional, cast
 
 from fastapi import FastAPI
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ASCENDING
 from pymongo.results import DeleteResult, InsertOneResult, UpdateResult
 
 from src.api.fields import PyObjectId
@@ -51,14 +52,71 @@ class MongoDBClient:
             return None
         return result | {"id": result.pop("_id")}
 
-    async def list(self, model: MongoDBModel) -> list[dict[str, Any]]:
+    async def iter_many(
+        self,
+        model: MongoDBModel,
+        filter: Dict[str, Any],
+        projection: Optional[list[str]] = None,
+        after: Optional[PyObjectId] = None,
+        limit: Optional[int] = None,
+        order_by: str = "_id",
+    ) -> AsyncIterator[dict[str, Any]]:
+        """
+        Stream documents matching filter, ordered by order_by then _id.
+
+        Keyset pagination: after is the id of the last document of the
+        previous page, the page starts right after it without skipping
+        over everything before. projection restricts the fields loaded.
+        """
         collection = self.get_collection(model)
-        result = collection.find({})
-        sessions = []
-        async for session in result:
-            session = cast(dict[str, Any], session)
-            sessions.append(session | {"id": session.pop("_id")})
-        return sessions
+        query = dict(filter)
+        if after is not None:
+            if order_by == "_id":
+                query["_id"] = {"$gt": after}
+            else:
+                anchor = await collection.find_one(
+                    {"_id": after}, {order_by: 1}
+                )
+                if anchor is None:
+                    return
+                query["$or"] = [
+                    {order_by: {"$gt": anchor.get(order_by)}},
+                    {order_by: anchor.get(order_by), "_id": {"$gt": after}},
+                ]
+
+        sort = [(order_by, ASCENDING)]
+        if order_by != "_id":
+            sort.append(("_id", ASCENDING))
+        cursor = collection.find(query, projection).sort(sort)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        async for document in cursor:
+            document = cast(dict[str, Any], document)
+            yield document | {"id": document.pop("_id")}
+
+    async def get_page(
+        self,
+        model: MongoDBModel,
+        filter: Dict[str, Any],
+        projection: Optional[list[str]] = None,
+        after: Optional[PyObjectId] = None,
+        limit: Optional[int] = None,
+        order_by: str = "_id",
+    ) -> list[dict[str, Any]]:
+        """One page of iter_many, every matching document without limit"""
+        return [
+            document
+            async for document in self.iter_many(
+                model, filter, projection, after, limit, order_by
+            )
+        ]
+
+    # Shadows the builtin list in the rest of the class body, annotations
+    # below use typing.List
+    async def list(
+        self, model: MongoDBModel, **page: Any
+    ) -> List[Dict[str, Any]]:
+        return await self.get_page(model, {}, **page)
 
     async def delete_many(self, model: MongoDBModel) -> DeleteResult:
         collection = self.get_collection(model)
@@ -100,28 +158,16 @@ class MongoDBClient:
         return result | {"id": result.pop("_id")}
 
     async def get_many_by_mail(
-        self, model: MongoDBModel, id: PyObjectId
-    ) -> dict[str, any]:
-        collection = self.get_collection(model)
-        sessions = []
-        async for session in collection.find({"email": id}):
-            session = cast(dict[str, any], session)
-            sessions.append(session | {"id": session.pop("_id")})
-        if sessions is None:
-            return None
-        return sessions
+        self, model: MongoDBModel, id: PyObjectId, **page: Any
+    ) -> List[Dict[str, Any]]:
+        """See get_page for page arguments"""
+        return await self.get_page(model, {"email": id}, **page)
 
     async def get_many_user_id(
-        self, model: MongoDBModel, id: PyObjectId
-    ) -> dict[str, any]:
-        collection = self.get_collection(model)
-        sessions = []
-        async for session in collection.find({"user_id": id}):
-            session = cast(dict[str, any], session)
-            sessions.append(session | {"id": session.pop("_id")})
-        if sessions is None:
-            return None
-        return sessions
+        self, model: MongoDBModel, id: PyObjectId, **page: Any
+    ) -> List[Dict[str, Any]]:
+        """See get_page for page arguments"""
+        return await self.get_page(model, {"user_id": id}, **page)
 
     async def update_image_uri_by_email(
         self, model: MongoDBModel, email: str, image_uri: str
@@ -0,0 +1,96 @@
+"""
+Indexes declared on MongoDB models (Meta.indexes) and by the checkpointer,
+created at startup. Run as a module to report missing or unused indexes:
+
+    python -m src.db.indexes
+"""
+
+import asyncio
+from typing import Any, Dict, List
+
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from src.api.models import Agent, MongoDBModel, Session, User
+from src.core.agents.AsyncMongoDBSaver import CHECKPOINT_INDEXES
+
+MODELS: List[type[MongoDBModel]] = [User, Session, Agent]
+
+
+def declared_indexes() -> Dict[str, List[IndexModel]]:
+    """Collection name -> indexes of the app database"""
+    return {
+        model.get_collection_name(): model.get_indexes() for model in MODELS
+    }
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create declared indexes, existing ones are left untouched"""
+    for collection, indexes in declared_indexes().items():
+        if not indexes:
+            continue
+        try:
+            names = await db[collection].create_indexes(indexes)
+            logger.info(f"Indexes of {collection}: {', '.join(names)}")
+        except OperationFailure as e:
+            # Conflicting options or duplicates against a unique index,
+            # needs a manual fix but shouldn't prevent the app from starting
+            logger.error(f"Cannot create indexes of {collection}: {e}")
+
+
+async def index_report(
+    db: AsyncIOMotorDatabase, indexes: Dict[str, List[IndexModel]]
+) -> List[Dict[str, Any]]:
+    """
+    Declared indexes that don't exist, and existing ones that were never
+    used since the server started ($indexStats counters reset on restart)
+    """
+    report = []
+    for collection, declared in indexes.items():
+        expected = {index.document["name"] for index in declared}
+        usage = {
+            stats["name"]: stats["accesses"]["ops"]
+            async for stats in db[collection].aggregate([{"$indexStats": {}}])
+        }
+        for name in sorted(expected - usage.keys()):
+            report.append(
+                {"collection": collection, "index": name, "status": "missing"}
+            )
+        for name, ops in sorted(usage.items()):
+            if name != "_id_" and ops == 0:
+                report.append(
+                    {
+                        "collection": collection,
+                        "index": name,
+                        "status": "unused"
+                        if name in expected
+                        else "unused, undeclared",
+                    }
+                )
+    return report
+
+
+async def main() -> None:
+    from src.core.settings import settings
+    from src.db.utils import get_mongodb_client
+
+    client = get_mongodb_client()
+    try:
+        report = await index_report(
+            client[settings.MONGO_DB_DB], declared_indexes()
+        ) + await index_report(
+            client[settings.CHECKPOINT_DB], CHECKPOINT_INDEXES
+        )
+    finally:
+        client.close()
+
+    if not report:
+        print("Every declared index exists and is in use")
+    for row in report:
+        print(f"{row['collection']:<20} {row['index']:<50} {row['status']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import httpx
 from loguru import logger
 from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
@@ -19,7 +20,12 @@ async def init_qdrant():
     global qdrant_db
 
     qdrant_db = AsyncQdrantClient(
-        url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY
+        url=settings.QDRANT_URL,
+        api_key=settings.QDRANT_API_KEY,
+        limits=httpx.Limits(
+            max_connections=settings.QDRANT_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.QDRANT_MAX_KEEPALIVE_CONNECTIONS,
+        ),
     )
     try:
         existing_collections = await qdrant_db.get_collections()
@@ -4,10 +4,26 @@ from typing import AsyncGenerator
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from src.api.agent_runs import cancel_runs
+from src.api.session_bus import create_session_bus
 from src.api.stripe.router import router as stripe_router
 from src.api.views import router as api_router
+from src.api.websocket import connection_manager
 from src.cloud.router import router as cloud_router
+from src.cloud.s3 import s3_service
+from src.core.agents.AsyncMongoDBSaver import (
+    AsyncMongoDBSaver,
+    flush_checkpointers,
+)
+from src.core.agents.checkpoint_retention import (
+    start_compaction,
+    stop_compaction,
+)
+from src.core.agents.embeddings import init_embedding_cache
+from src.core.clients import close_clients, init_clients
+from src.core.pools import shutdown_pools
 from src.core.settings import settings
+from src.db.indexes import ensure_indexes
 from src.db.qdrant import close_qdrant, init_qdrant
 from src.db.utils import get_mongodb_client
 from src.security.router import router as auth_router
@@ -18,16 +34,34 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     client = get_mongodb_client()
     db = client.get_database(settings.MONGO_DB_DB)
     app.mongodb = db
+    await ensure_indexes(db)
 
     await init_qdrant()
+    await init_clients()
+    await init_embedding_cache(db)
+    checkpoints_db = client.get_database(settings.CHECKPOINT_DB)
+    await AsyncMongoDBSaver(checkpoints_db).setup()
+    await s3_service.start()
+    start_compaction(checkpoints_db)
+    await connection_manager.start(create_session_bus(db))
 
     try:
         yield
     finally:
+        await cancel_runs()
+        await connection_manager.close()
+        await stop_compaction()
+        # Write buffered checkpoints
+        await flush_checkpointers()
         # Close MongoDB connection
         client.close()
         # Close Qdrant connection
         await close_qdrant()
+        # Close shared OpenAI/HTTP/S3 clients
+        await close_clients()
+        await s3_service.close()
+        # Stop executors
+        shutdown_pools()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -0,0 +1,72 @@
+"""
+Subscription plan and status of users, cached for a short while since
+nearly every endpoint checks them and they only change through Stripe
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from src.core.cache import TTLCache
+from src.core.settings import settings
+
+entitlements_cache = TTLCache(
+    maxsize=settings.ENTITLEMENT_CACHE_SIZE,
+    ttl=settings.ENTITLEMENT_CACHE_TTL,
+)
+
+# Fields of a User document an Entitlement is built from
+ENTITLEMENT_FIELDS = ["subscription_plan", "subscription_status"]
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    plan: Optional[str]
+    status: Optional[str]
+
+    @classmethod
+    def from_user(cls, user: Dict[str, Any]) -> "Entitlement":
+        return cls(
+            plan=user.get("subscription_plan"),
+            status=user.get("subscription_status"),
+        )
+
+    @property
+    def active(self) -> bool:
+        return self.plan is not None and self.status != "canceled"
+
+
+def get_cached_entitlement(user_id: str) -> Optional[Entitlement]:
+    return entitlements_cache.get(str(user_id))
+
+
+def cache_entitlement(user_id: str, entitlement: Entitlement) -> None:
+    entitlements_cache.set(str(user_id), entitlement)
+
+
+async def load_entitlement(user_id: str) -> Optional[Entitlement]:
+    """Cached entitlement, loaded from the user document on miss"""
+    from bson import ObjectId
+
+    from src.api.models import User
+    from src.db.client import MongoDBClient
+
+    entitlement = get_cached_entitlement(user_id)
+    if entitlement is None:
+        user = await (
+            MongoDBClient()
+            .get_collection(User)
+            .find_one({"_id": ObjectId(user_id)}, ENTITLEMENT_FIELDS)
+        )
+        if user is None:
+            return None
+        entitlement = Entitlement.from_user(user)
+        cache_entitlement(user_id, entitlement)
+    return entitlement
+
+
+def invalidate_entitlement(user_id: str) -> None:
+    """
+    To call whenever a user's subscription changes. The cache is per
+    process, other workers keep the old entitlement until it expires
+    """
+    entitlements_cache.pop(str(user_id))
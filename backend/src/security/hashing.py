@@ -1,6 +1,29 @@
+"""
+bcrypt costs hundreds of milliseconds of CPU per call, so hashing runs in
+a dedicated process pool. Callers beyond HASHING_QUEUE_LIMIT are turned
+away with HashingBusyError instead of queueing without bound.
+"""
+
+import asyncio
+from typing import Optional, Tuple
+
 from passlib.context import CryptContext
 
-pwd_cxt = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from src.core.pools import get_hashing_pool
+from src.core.settings import settings
+
+# Hashes made with another cost than BCRYPT_ROUNDS need an update
+pwd_cxt = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+
+class HashingBusyError(Exception):
+    """Too many hashes pending, the caller should retry later"""
 
 
 class Hash:
@@ -9,3 +32,43 @@ class Hash:
 
     def verify(self, hashed, normal):
         return pwd_cxt.verify(normal, hashed)
+
+
+# Module level functions so they can be sent to the process pool
+
+
+def hash_with_cost(password: str) -> str:
+    return pwd_cxt.hash(password)
+
+
+def verify_and_update(hashed: str, normal: str) -> Tuple[bool, Optional[str]]:
+    """Whether the password matches, and its new hash if the cost changed"""
+    return pwd_cxt.verify_and_update(normal, hashed)
+
+
+# Hashes submitted to the pool and not finished yet, only touched from
+# the event loop
+_pending = 0
+
+
+async def _run_hashing(func, *args):
+    global _pending
+
+    if _pending >= settings.HASHING_QUEUE_LIMIT:
+        raise HashingBusyError()
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_hashing_pool(), func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run_hashing(hash_with_cost, password)
+
+
+async def verify_password(
+    hashed: str, normal: str
+) -> Tuple[bool, Optional[str]]:
+    return await _run_hashing(verify_and_update, hashed, normal)
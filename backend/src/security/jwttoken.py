@@ -30,7 +30,8 @@ def create_refresh_token(data: dict):
     return encoded_jwt
 
 
-async def verify_token(token: str):
+def decode_token(token: str) -> dict:
+    """Verified claims of a token, sub is always set"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_403_FORBIDDEN,
         detail="Could not validate credentials",
@@ -45,4 +46,8 @@ async def verify_token(token: str):
     except JWTError:
         raise credentials_exception
 
-    return user_id
+    return payload
+
+
+async def verify_token(token: str):
+    return decode_token(token)["sub"]
@@ -5,20 +5,17 @@ from fastapi import (
     WebSocketDisconnect,
     status,
 )
-from fastapi.security import OAuth2PasswordBearer
 
-from .jwttoken import verify_token
-
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+from .principal import (
+    Principal,
+    get_principal,
+    oauth2_scheme,
+    resolve_principal,
+)
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    return await verify_token(token)
+async def get_current_user(principal: Principal = Depends(get_principal)):
+    return principal.user_id
 
 
 def get_token_user(token: str = Depends(oauth2_scheme)):
@@ -35,7 +32,10 @@ async def get_ws_current_user(websocket: WebSocket):
         )
 
     # Verify the token
-    user = await verify_token(token)
+    try:
+        user = (await resolve_principal(token)).user_id
+    except HTTPException:
+        user = None
     if not user:
         raise WebSocketDisconnect(
             code=status.WS_1008_POLICY_VIOLATION, reason="Unauthorized"
@@ -0,0 +1,109 @@
+"""
+Authenticated principal of a request: the token is verified and the
+user's entitlement looked up once per request, and the decoded identity is
+kept across requests keyed by a digest of the token, never the token itself
+"""
+
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordBearer
+
+from src.core.cache import TTLCache
+from src.core.settings import settings
+
+from .entitlements import Entitlement, entitlements_cache, load_entitlement
+from .jwttoken import decode_token
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+
+principal_cache = TTLCache(
+    maxsize=settings.PRINCIPAL_CACHE_SIZE,
+    ttl=settings.PRINCIPAL_CACHE_TTL,
+)
+
+
+@dataclass(frozen=True)
+class Principal:
+    user_id: str
+    entitlement: Entitlement
+    expires_at: Optional[float] = None
+
+    @property
+    def plan(self) -> Optional[str]:
+        return self.entitlement.plan
+
+    @property
+    def status(self) -> Optional[str]:
+        return self.entitlement.status
+
+    @property
+    def active(self) -> bool:
+        return self.entitlement.active
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _identity(token: str) -> tuple[str, Optional[float]]:
+    """User id and expiry of a token, decoded only on cache miss"""
+    key = token_digest(token)
+    identity = principal_cache.get(key)
+    if identity is not None:
+        user_id, expires_at = identity
+        if expires_at is None or expires_at > time.time():
+            return identity
+        principal_cache.pop(key)
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Could not validate credentials",
+        )
+
+    payload = decode_token(token)
+    identity = (payload["sub"], payload.get("exp"))
+    principal_cache.set(key, identity)
+    return identity
+
+
+async def resolve_principal(token: str) -> Principal:
+    """
+    Plan and status come from the entitlement cache rather than the cached
+    identity. The Stripe webhook invalidates it on the worker handling the
+    event only, other workers can serve the old plan for up to
+    ENTITLEMENT_CACHE_TTL
+    """
+    user_id, expires_at = _identity(token)
+    entitlement = await load_entitlement(user_id)
+    if entitlement is None:
+        # Valid token of a deleted user
+        principal_cache.pop(token_digest(token))
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Could not validate credentials",
+        )
+    return Principal(user_id, entitlement, expires_at)
+
+
+async def get_principal(
+    request: Request, token: str = Depends(oauth2_scheme)
+) -> Principal:
+    """
+    Dependency results are cached for the duration of a request, the
+    principal is also kept on request.state for code outside dependencies
+    """
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
+        principal = await resolve_principal(token)
+        request.state.principal = principal
+    return principal
+
+
+def cache_stats() -> Dict[str, Any]:
+    return {
+        "principals": principal_cache.stats(),
+        "entitlements": entitlements_cache.stats(),
+    }
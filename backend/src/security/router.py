@@ -17,8 +17,10 @@ from src.api.fields import PyObjectId
 from src.api.models import User, UserData
 from src.db.client import MongoDBClient
 
-from .hashing import Hash
+from .hashing import HashingBusyError, hash_password, verify_password
 from .jwttoken import create_access_token, verify_token
+from .oauth import get_current_user
+from .principal import cache_stats
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -36,6 +38,14 @@ async def get_user_by_id(id: PyObjectId) -> User | None:
     return result
 
 
+def too_many_hashes() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many logins at once, please retry",
+        headers={"Retry-After": "1"},
+    )
+
+
 @router.post("/register")
 async def create_user(request: UserData):
     try:
@@ -48,7 +58,7 @@ async def create_user(request: UserData):
         user_data |= {"image_uri": filename}
 
         # Hash password
-        hashed_pass = Hash().bcrypt(password=user_data["password"])
+        hashed_pass = await hash_password(user_data["password"])
         user_data["password"] = hashed_pass
 
         user_data |= {
@@ -76,6 +86,9 @@ async def create_user(request: UserData):
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors()
         )
 
+    except HashingBusyError:
+        raise too_many_hashes()
+
     except Exception as e:
         logger.error(f"Error creating user: {str(e)}")
         raise HTTPException(
@@ -113,12 +126,20 @@ async def login(request: OAuth2PasswordRequestForm = Depends()):
             detail=f"No user found with this {request.username} email",
         )
 
-    hash = Hash()
-    if not hash.verify(hashed=user["password"], normal=request.password):
+    try:
+        valid, new_hash = await verify_password(
+            hashed=user["password"], normal=request.password
+        )
+    except HashingBusyError:
+        raise too_many_hashes()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Wrong Username or password",
         )
+    if new_hash is not None:
+        # BCRYPT_ROUNDS changed since the password was hashed
+        await client.update_one(User, user["id"], {"password": new_hash})
 
     # Create JWT access token after successful authentication
     access_token = create_access_token(data={"sub": str(user["id"])})
@@ -132,6 +153,14 @@ async def verify_user_token(token: str):
     return {"message": "Token is valid"}
 
 
+@router.get(
+    "/cache-stats",
+    description="Hit rates of the principal and entitlement caches",
+)
+async def get_cache_stats(_: str = Depends(get_current_user)):
+    return cache_stats()
+
+
 @router.get(
     "/check-email/{email}",
     description="Check if user's email already exists in db prior to registering",
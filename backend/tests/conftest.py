@@ -0,0 +1,29 @@
+import uuid
+
+import pytest
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture
+async def mongo_db():
+    """Throwaway database on the MongoDB of the settings, dropped after"""
+    # Imported here, tests/test_core.py runs without the app's dependencies
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo.errors import PyMongoError
+
+    from src.core.settings import settings
+
+    client = AsyncIOMotorClient(
+        settings.MONGO_DB_URL, serverSelectionTimeoutMS=2000
+    )
+    try:
+        await client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        pytest.skip("MongoDB is not reachable")
+    db = client[f"test_{uuid.uuid4().hex[:8]}"]
+    try:
+        yield db
+    finally:
+        await client.drop_database(db.name)
+        client.close()
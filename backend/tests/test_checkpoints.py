@@ -0,0 +1,217 @@
+"""testing AsyncMongoDBSaver, against the MongoDB of the settings"""
+
+import asyncio
+import operator
+from datetime import datetime, timedelta, timezone
+from typing import Annotated
+
+import pytest
+from langgraph.graph import END, START, StateGraph
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from typing_extensions import TypedDict
+
+from src.core.agents.AsyncMongoDBSaver import (
+    CHECKPOINTS_COLLECTION,
+    WRITES_COLLECTION,
+    AsyncMongoDBSaver,
+    WriteBuffer,
+    version_number,
+)
+from src.core.agents.checkpoint_retention import (
+    RetentionPolicy,
+    claim_compaction,
+)
+from src.core.settings import settings
+
+
+class CounterState(TypedDict):
+    total: Annotated[int, operator.add]
+
+
+def build_counter(checkpointer):
+    workflow = StateGraph(CounterState)
+    workflow.add_node("add", lambda state: {"total": 0})
+    workflow.add_edge(START, "add")
+    workflow.add_edge("add", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+
+def test_versions_are_unique_and_ordered():
+    saver = AsyncMongoDBSaver.__new__(AsyncMongoDBSaver)
+    first = saver.get_next_version(None, None)
+    fork_a = saver.get_next_version(first, None)
+    fork_b = saver.get_next_version(first, None)
+
+    assert fork_a != fork_b
+    assert first < fork_a and first < fork_b
+    assert version_number(fork_a) == version_number(fork_b) == 2
+    # Versions written before the change were integers
+    assert version_number(saver.get_next_version(7, None)) == 8
+
+
+@pytest.mark.asyncio
+async def test_fork_reads_back_its_own_channel_values(mongo_db):
+    saver = AsyncMongoDBSaver(mongo_db, write_behind=False)
+    await saver.setup()
+    graph = build_counter(saver)
+    config = {"configurable": {"thread_id": "fork"}}
+
+    await graph.ainvoke({"total": 1}, config)
+    await graph.ainvoke({"total": 10}, config)
+    assert (await graph.aget_state(config)).values["total"] == 11
+
+    # Fork from the end of the first run, writing another value with the
+    # channel versions the second run already used
+    history = [state async for state in graph.aget_state_history(config)]
+    first_run = next(
+        state for state in history if state.values.get("total") == 1
+    )
+    await graph.ainvoke({"total": 100}, first_run.config)
+
+    latest = await graph.aget_state(config)
+    assert latest.values["total"] == 101
+    saved = await saver.aget_tuple(config)
+    assert saved.checkpoint["channel_values"]["total"] == 101
+
+
+def test_write_buffer_restores_failed_operations_first():
+    buffer = WriteBuffer()
+    buffer.operations[WRITES_COLLECTION].append(UpdateOne({"_id": 1}, {}))
+    operations, _ = buffer.take_operations()
+    assert buffer.size == 0
+
+    # Buffered while the failed flush ran
+    buffer.operations[WRITES_COLLECTION].append(UpdateOne({"_id": 2}, {}))
+    buffer.restore_operations(operations)
+
+    ids = [op._filter["_id"] for op in buffer.operations[WRITES_COLLECTION]]
+    assert ids == [1, 2]
+
+
+def test_write_buffer_forgets_only_flushed_entries():
+    buffer = WriteBuffer()
+    buffer.checkpoints["a"] = (next(buffer.sequence), {}, {}, None)
+    buffer.writes["a"][("task", 0)] = (next(buffer.sequence), "total", 1)
+    _, flushed = buffer.take_operations()
+    buffer.checkpoints["b"] = (next(buffer.sequence), {}, {}, "a")
+    buffer.writes["b"][("task", 0)] = (next(buffer.sequence), "total", 2)
+
+    buffer.forget(flushed)
+
+    assert list(buffer.checkpoints) == ["b"]
+    assert "a" not in buffer.writes
+    assert buffer.pending_writes("b") == {("task", 0): ("task", "total", 2)}
+    assert not buffer.empty
+
+    buffer.forget(next(buffer.sequence))
+    assert buffer.empty
+
+
+@pytest.mark.asyncio
+async def test_failed_timer_flush_is_retried(monkeypatch):
+    monkeypatch.setattr(settings, "CHECKPOINT_FLUSH_INTERVAL", 0.01)
+    monkeypatch.setattr(settings, "CHECKPOINT_FLUSH_MAX_DELAY", 0.02)
+    saver = AsyncMongoDBSaver.__new__(AsyncMongoDBSaver)
+    saver.buffers = {}
+    written = []
+
+    async def bulk_write(operations):
+        if not written:
+            written.append(None)
+            raise PyMongoError("primary stepped down")
+        written.append(operations)
+
+    saver._bulk_write = bulk_write
+    buffer = saver._buffer("thread", "")
+    buffer.operations[CHECKPOINTS_COLLECTION].append(UpdateOne({"_id": 1}, {}))
+    await saver._schedule_flush("thread", "")
+
+    # No other write comes for the thread, the timer re-arms itself
+    for _ in range(100):
+        if ("thread", "") not in saver.buffers:
+            break
+        await asyncio.sleep(0.01)
+
+    assert len(written) == 2
+    assert written[1][CHECKPOINTS_COLLECTION][0]._filter == {"_id": 1}
+    assert not saver.buffers
+
+
+def make_checkpoints(count, now, parents=None):
+    """count checkpoints a minute apart, newest first"""
+    parents = parents or {}
+    return [
+        {
+            "checkpoint_id": f"{i:03}",
+            "parent_checkpoint_id": parents.get(
+                f"{i:03}", f"{i - 1:03}" if i else None
+            ),
+            "created_at": now - timedelta(minutes=count - i),
+        }
+        for i in reversed(range(count))
+    ]
+
+
+def test_retention_policy_rejects_keep_last_below_one():
+    with pytest.raises(ValueError):
+        RetentionPolicy(keep_last=0)
+
+
+def test_retention_policy_keeps_last_checkpoints():
+    now = datetime.now(timezone.utc)
+    checkpoints = make_checkpoints(5, now)
+
+    expired = RetentionPolicy(keep_last=2).expired(checkpoints, now)
+
+    assert expired == ["002", "001", "000"]
+
+
+def test_retention_policy_keeps_newer_checkpoints():
+    now = datetime.now(timezone.utc)
+    checkpoints = make_checkpoints(5, now)
+    policy = RetentionPolicy(
+        keep_last=1, keep_newer_than=timedelta(minutes=3, seconds=30)
+    )
+
+    # Created 1 to 5 minutes ago, 003 and 002 are kept by age
+    assert policy.expired(checkpoints, now) == ["001", "000"]
+
+
+def test_retention_policy_keeps_branch_points():
+    now = datetime.now(timezone.utc)
+    # 003 forks the thread from 001, which 002 continues as well
+    checkpoints = make_checkpoints(5, now, parents={"003": "001"})
+
+    expired = RetentionPolicy(keep_last=1).expired(checkpoints, now)
+
+    assert expired == ["003", "002", "000"]
+
+
+@pytest.mark.asyncio
+async def test_compaction_lease_elects_one_worker(mongo_db):
+    lease = timedelta(minutes=5)
+    assert await claim_compaction(mongo_db, "worker-a", lease)
+    assert not await claim_compaction(mongo_db, "worker-b", lease)
+    # The holder extends its own lease
+    assert await claim_compaction(mongo_db, "worker-a", lease)
+
+    # Once expired, another worker takes it over
+    assert await claim_compaction(mongo_db, "worker-a", -lease)
+    assert await claim_compaction(mongo_db, "worker-b", lease)
+    assert not await claim_compaction(mongo_db, "worker-a", lease)
+
+
+@pytest.mark.asyncio
+async def test_remove_thread_prefix_keeps_other_threads(mongo_db):
+    saver = AsyncMongoDBSaver(mongo_db, write_behind=False)
+    threads = ["session:v1", "session:v2", "session-2:v1", "graph"]
+    for collection in (CHECKPOINTS_COLLECTION, WRITES_COLLECTION):
+        await mongo_db[collection].insert_many(
+            [{"thread_id": thread_id} for thread_id in threads]
+        )
+
+    assert await saver.aremove_thread_prefix("session:") == 4
+
+    remaining = await mongo_db[CHECKPOINTS_COLLECTION].distinct("thread_id")
+    assert sorted(remaining) == ["graph", "session-2:v1"]
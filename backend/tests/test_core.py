@@ -1 +1,514 @@
 """testing WakilAgentClass"""
+
+import asyncio
+import functools
+import json
+import queue
+import time
+
+import pytest
+from fastapi import status
+from langchain_core.language_models import (
+    FakeListChatModel,
+    FakeMessagesListChatModel,
+)
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import tool
+from langgraph.graph import END, START, MessagesState, StateGraph
+from langgraph.prebuilt import ToolNode, tools_condition
+
+from benchmarks.agent_sessions import ANSWER, build_agent
+from src.api import agent_runs
+from src.api.session_bus import InProcessBus, encode_frame
+from src.api.websocket import ConnectionManager, FanoutStats
+from src.core import pools
+from src.core.agents import extraction
+from src.core.agents.codecs import CODECS, RAW, decode, encode
+from src.core.agents.extraction import extract_pdf_pages, extract_txt
+from src.core.agents.ingestion import batched, chunk_text
+from src.core.agents.resilience import backoff_delays, call_with_retries
+from src.core.agents.streaming import stream_agent
+from src.core.agents.utils import llm_agent
+from src.core.cache import LRUCache, TTLCache
+from src.core.settings import settings
+
+
+class CharEncoding:
+    """One token per character, enough to test chunking"""
+
+    def encode(self, text):
+        return list(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Touch "a" so that "b" becomes the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("c") == 3
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 1, 1)
+
+
+def test_ttl_cache_expires_entries():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set("a", 1)
+
+    now[0] = 9.9
+    assert cache.get("a") == 1
+    now[0] = 10
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert (cache.hits, cache.misses, cache.expirations) == (1, 1, 1)
+
+
+def test_chunk_text_overlaps_and_covers_whole_text():
+    chunks = chunk_text(
+        "abcdefghij", CharEncoding(), chunk_tokens=4, overlap_tokens=1
+    )
+
+    assert [chunk.text for chunk in chunks] == ["abcd", "defg", "ghij"]
+    assert all(chunk.tokens == 4 for chunk in chunks)
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_extract_txt_decodes_across_chunk_boundaries(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("héllo wörld", encoding="utf-8")
+
+    # Tiny chunks split multi-byte characters in half
+    assert extract_txt(str(path), chunk_size=2) == "héllo wörld"
+
+
+def test_extract_pdf_pages_reports_every_page(tmp_path, monkeypatch):
+    pypdf2 = pytest.importorskip("PyPDF2")
+    path = tmp_path / "doc.pdf"
+    writer = pypdf2.PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=100, height=100)
+    with open(path, "wb") as file:
+        writer.write(file)
+    progress = queue.Queue()
+    monkeypatch.setattr(extraction, "progress_queue", progress)
+
+    assert extract_pdf_pages(str(path), 1, 3, "job") == ["", ""]
+    assert [progress.get_nowait() for _ in range(2)] == [("job", 1)] * 2
+    assert progress.empty()
+
+
+def test_extraction_timeout_spares_other_documents():
+    async def stuck():
+        async with pools.extraction_pool(processes=1) as pool:
+            await asyncio.wait_for(
+                pools.run_in_pool(pool, time.sleep, 60), 0.5
+            )
+
+    async def scenario():
+        # Started before the stuck document's processes are killed, done after
+        other = asyncio.create_task(pools.run_in_process(time.sleep, 1))
+        with pytest.raises(asyncio.TimeoutError):
+            await stuck()
+        assert await other is None
+
+    asyncio.run(scenario())
+
+
+def test_codecs_round_trip_and_threshold():
+    payload = b'{"messages": ["hello"]}' * 100
+    for name in CODECS:
+        codec, data = encode(payload, name, threshold=64)
+        assert decode(codec, data) == payload
+        assert codec == name or name == RAW
+
+    # Small payloads stay raw, untagged legacy ones too
+    assert encode(b"tiny", "zlib", threshold=64) == (RAW, b"tiny")
+    assert decode(None, b"legacy") == b"legacy"
+
+
+def test_call_with_retries_retries_transient_errors_only():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("reset")
+        return "ok"
+
+    assert asyncio.run(call_with_retries(flaky, 1, 2, 0, 0)) == "ok"
+    assert len(attempts) == 3
+
+    async def invalid():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        asyncio.run(call_with_retries(invalid, 1, 5, 0, 0))
+    assert len(attempts) == 1
+
+    delays = list(backoff_delays(4, 1, 3, rng=lambda low, high: high))
+    assert delays == [1, 2, 3, 3]
+
+
+PROMPT = ChatPromptTemplate.from_messages([MessagesPlaceholder("messages")])
+
+
+class FlakyFakeChatModel(FakeListChatModel):
+    """Fake model dropping the connection after the first token, once"""
+
+    failures: int = 1
+
+    async def _astream(self, *args, **kwargs):
+        async for chunk in super()._astream(*args, **kwargs):
+            yield chunk
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("connection reset")
+
+
+@tool
+def lookup(query: str) -> str:
+    """Look the query up"""
+    return f"found {query}"
+
+
+def build_llm_agent(*llms, tools=None):
+    """LLM nodes one after the other, looping through tools if given"""
+    workflow = StateGraph(MessagesState)
+    previous = START
+    for i, llm in enumerate(llms):
+        workflow.add_node(
+            f"llm_{i}", functools.partial(llm_agent, executable=PROMPT | llm)
+        )
+        workflow.add_edge(previous, f"llm_{i}")
+        previous = f"llm_{i}"
+    if tools:
+        workflow.add_node("tools", ToolNode(tools))
+        workflow.add_conditional_edges(previous, tools_condition)
+        workflow.add_edge("tools", previous)
+    else:
+        workflow.add_edge(previous, END)
+    return workflow.compile()
+
+
+def run_frames(agent, token_interval):
+    async def collect():
+        return [
+            frame
+            async for frame in stream_agent(
+                agent,
+                {"messages": [("human", "hi")]},
+                {},
+                token_interval=token_interval,
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_stream_agent_streams_tokens_then_the_message():
+    frames = run_frames(build_agent(latency=0), token_interval=0)
+
+    tokens = [frame for frame in frames if frame["type"] == "token"]
+    # One frame per token without coalescing
+    assert len(tokens) == len(ANSWER)
+    assert "".join(frame["content"] for frame in tokens) == ANSWER
+    assert [frame["type"] for frame in frames[-2:]] == ["message", "end"]
+    assert frames[-2]["content"] == ANSWER
+    assert {frame["run_id"] for frame in tokens} == {frames[-2]["run_id"]}
+
+
+def test_stream_agent_coalesces_tokens_per_llm_call():
+    agent = build_llm_agent(
+        FakeListChatModel(responses=["first answer"]),
+        FakeListChatModel(responses=["second answer"]),
+    )
+    frames = run_frames(agent, token_interval=60)
+
+    # The first token of a call goes out at once, the rest until it ends
+    assert [frame["type"] for frame in frames] == [
+        "token",
+        "token",
+        "message",
+    ] * 2 + ["end"]
+    calls = [frames[0:3], frames[3:6]]
+    for (first, rest, message), answer in zip(calls, ["first", "second"]):
+        assert first["content"] + rest["content"] == f"{answer} answer"
+        assert first["run_id"] == rest["run_id"] == message["run_id"]
+    assert calls[0][2]["run_id"] != calls[1][2]["run_id"]
+
+
+def test_stream_agent_reports_tool_calls():
+    llm = FakeMessagesListChatModel(
+        responses=[
+            AIMessage(
+                "",
+                tool_calls=[
+                    {"name": "lookup", "args": {"query": "x"}, "id": "1"}
+                ],
+            ),
+            AIMessage("done"),
+        ]
+    )
+    frames = run_frames(build_llm_agent(llm, tools=[lookup]), 0)
+
+    assert [frame["type"] for frame in frames] == [
+        "message",
+        "tool_start",
+        "tool_end",
+        "message",
+        "end",
+    ]
+    assert frames[1]["name"] == frames[2]["name"] == "lookup"
+    assert frames[1]["input"] == {"query": "x"}
+    assert frames[2]["output"] == "found x"
+    assert frames[1]["run_id"] == frames[2]["run_id"]
+    assert frames[3]["content"] == "done"
+
+
+def test_stream_agent_announces_retried_llm_calls(monkeypatch):
+    monkeypatch.setattr(settings, "AGENT_RETRY_BASE_DELAY", 0)
+    agent = build_llm_agent(FlakyFakeChatModel(responses=["hello"]))
+    frames = run_frames(agent, token_interval=0)
+
+    failed, retry = frames[:2]
+    assert failed == {
+        "type": "token",
+        "run_id": failed["run_id"],
+        "content": "h",
+    }
+    assert retry == {"type": "retry", "run_id": failed["run_id"]}
+    retried = [frame for frame in frames[2:] if frame["type"] == "token"]
+    assert "".join(frame["content"] for frame in retried) == "hello"
+    assert frames[-2]["type"] == "message"
+    assert frames[-2]["run_id"] not in (failed["run_id"], None)
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """Agent runs on a fresh in-process bus, cancelled after the test"""
+    monkeypatch.setattr(agent_runs.connection_manager, "bus", InProcessBus())
+    yield agent_runs
+    for task in agent_runs.runs.values():
+        task.cancel()
+    agent_runs.runs.clear()
+
+
+def test_start_run_refuses_a_second_run(runs):
+    agent = build_agent(latency=60)
+    input = {"messages": [("human", "hi")]}
+
+    async def scenario():
+        run = await runs.start_run("session", "session:v1", agent, input)
+        assert run is not None
+        assert runs.is_running("session")
+        assert (
+            await runs.start_run("session", "session:v1", agent, input) is None
+        )
+
+        runs.cancel_run("session")
+        with pytest.raises(asyncio.CancelledError):
+            await run
+        # The lease is released with the run
+        run = await runs.start_run("session", "session:v1", agent, input)
+        assert run is not None
+        runs.cancel_run("session")
+        await asyncio.gather(run, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_member_left_cancels_the_run_without_members(runs):
+    agent = build_agent(latency=60)
+    bus = runs.connection_manager.bus
+
+    async def scenario():
+        await bus.set_members({"session": 1})
+        run = await runs.start_run(
+            "session", "session:v1", agent, {"messages": [("human", "hi")]}
+        )
+        # The last member of this worker left, none on the others
+        await runs.member_left("session")
+        await asyncio.gather(run, return_exceptions=True)
+        assert run.cancelled()
+        assert not runs.is_running("session")
+        assert await bus.claim_run("session")
+
+    asyncio.run(scenario())
+
+
+class FakeWebSocket:
+    """Records frames, optionally stuck on send or failing"""
+
+    def __init__(self, stuck=False, broken=False):
+        self.sent = []
+        self.closed = None
+        self.stuck = stuck
+        self.broken = broken
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        if self.broken:
+            raise RuntimeError("connection closed")
+        if self.stuck:
+            await asyncio.Event().wait()
+        self.sent.append(text)
+
+    async def close(self, code, reason):
+        self.closed = code
+
+
+async def settle():
+    """Let sender tasks write what is queued, through wait_for"""
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_fans_out_to_every_member():
+    async def scenario():
+        manager = ConnectionManager(InProcessBus())
+        await manager.start()
+        try:
+            first, second = FakeWebSocket(), FakeWebSocket()
+            await manager.connect(first, "session")
+            await manager.connect(second, "session")
+
+            assert manager.broadcast("session", "frame") == 2
+            assert manager.broadcast("other", "frame") == 0
+            await manager.publish("session", {"type": "end"})
+            await settle()
+
+            expected = [
+                "frame",
+                '{"session_id":"session","seq":1,"data":{"type": "end"}}',
+            ]
+            assert first.sent == second.sent == expected
+            stats = manager.get_stats()["session"]
+            assert stats["broadcasts"] == 2
+            assert stats["delivered"] == 4
+            assert stats["connections"] == 2
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_broadcast_evicts_clients_not_keeping_up(monkeypatch):
+    monkeypatch.setattr(settings, "WS_SEND_QUEUE_SIZE", 1)
+
+    async def scenario():
+        manager = ConnectionManager(InProcessBus())
+        fast, slow = FakeWebSocket(), FakeWebSocket(stuck=True)
+        await manager.connect(fast, "session")
+        await manager.connect(slow, "session")
+
+        # The slow client's sender holds the first frame, the second
+        # fills its queue, the third overflows it
+        for frame in ("1", "2"):
+            assert manager.broadcast("session", frame) == 2
+            await settle()
+        assert manager.broadcast("session", "3") == 1
+        await settle()
+
+        assert slow.closed == status.WS_1013_TRY_AGAIN_LATER
+        assert list(manager.sessions["session"]) == [fast]
+        assert fast.sent == ["1", "2", "3"]
+        assert manager.session_stats("session").evicted == 1
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_send_drops_the_client():
+    async def scenario():
+        manager = ConnectionManager(InProcessBus())
+        alive, broken = FakeWebSocket(), FakeWebSocket(broken=True)
+        await manager.connect(alive, "session")
+        await manager.connect(broken, "session")
+
+        manager.broadcast("session", "frame")
+        await settle()
+
+        assert list(manager.sessions["session"]) == [alive]
+        assert manager.session_stats("session").failed == 1
+        # The last member gone, so is the session
+        manager.disconnect(alive, "session")
+        assert "session" not in manager.sessions
+        assert manager.get_stats() == {}
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_fanout_stats_percentiles():
+    stats = FanoutStats(samples=100)
+    assert stats.as_dict()["latency_max_ms"] is None
+
+    stats.record(0.5)
+    assert "latency_p50_ms" not in stats.as_dict()
+
+    for i in range(200):
+        stats.record(i / 1000)
+    summary = stats.as_dict()
+    # Only the last samples are kept
+    assert summary["delivered"] == 201
+    assert summary["latency_max_ms"] == pytest.approx(199)
+    assert summary["latency_p50_ms"] == pytest.approx(149.5)
+    assert summary["latency_p50_ms"] < summary["latency_p95_ms"]
+
+
+def test_encode_frame_embeds_the_payload():
+    frame = encode_frame("session", 3, '{"type": "end"}')
+    assert frame == '{"session_id":"session","seq":3,"data":{"type": "end"}}'
+    assert json.loads(frame)["data"] == {"type": "end"}
+
+
+def test_in_process_bus_numbers_frames_per_session():
+    async def scenario():
+        bus = InProcessBus()
+        delivered = []
+        await bus.start(lambda session_id, frame: delivered.append(frame))
+        for session_id in ("a", "b", "a"):
+            await bus.publish(session_id, "{}")
+        await bus.close()
+        # Nothing is delivered once closed, the sequence still counts
+        await bus.publish("a", "{}")
+        assert [json.loads(frame)["seq"] for frame in delivered] == [1, 1, 2]
+        assert bus.sequences.get("a") == 3
+
+    asyncio.run(scenario())
+
+
+def test_in_process_bus_members_and_run_leases():
+    async def scenario():
+        bus = InProcessBus()
+        await bus.set_members({"a": 2, "b": 1})
+        await bus.set_members({"b": 0})
+        assert await bus.members("a") == 2
+        assert await bus.members("b") == 0
+        assert "b" not in bus.counts
+
+        assert await bus.claim_run("a")
+        assert not await bus.claim_run("a")
+        assert await bus.renew_run("a")
+        assert not await bus.renew_run("b")
+        await bus.release_run("a")
+        assert not await bus.renew_run("a")
+        assert await bus.claim_run("a")
+
+    asyncio.run(scenario())
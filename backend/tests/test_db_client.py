@@ -0,0 +1,91 @@
+"""testing MongoDBClient keyset pagination, against the MongoDB of the settings"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from bson import ObjectId
+
+from src.api.models import Session
+from src.db.client import MongoDBClient
+
+
+@pytest_asyncio.fixture
+async def client(mongo_db):
+    # The singleton reads the database from the app, bypassed here
+    client = object.__new__(MongoDBClient)
+    client.mongodb = mongo_db
+    return client
+
+
+@pytest_asyncio.fixture
+async def sessions(client):
+    """Five sessions of one user, created in the reverse order of their ids,
+    the last two at the same time"""
+    user_id = ObjectId()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    ids = sorted(ObjectId() for _ in range(5))
+    documents = [
+        {
+            "_id": id_,
+            "user_id": user_id,
+            "title": f"session {i}",
+            "created_at": now - timedelta(minutes=min(i, 3)),
+        }
+        for i, id_ in enumerate(ids)
+    ]
+    await client.get_collection(Session).insert_many(documents)
+    return user_id, ids
+
+
+async def pages(client, filter, limit, **kwargs):
+    """Every page of get_page, following after"""
+    result, after = [], None
+    while page := await client.get_page(
+        Session, filter, after=after, limit=limit, **kwargs
+    ):
+        result.append([document["id"] for document in page])
+        after = page[-1]["id"]
+    return result
+
+
+@pytest.mark.asyncio
+async def test_get_page_follows_ids(client, sessions):
+    user_id, ids = sessions
+
+    assert await pages(client, {"user_id": user_id}, limit=2) == [
+        ids[0:2],
+        ids[2:4],
+        ids[4:],
+    ]
+    # Past the last page
+    assert not await client.get_page(Session, {}, after=ids[-1], limit=2)
+
+
+@pytest.mark.asyncio
+async def test_get_page_orders_by_field_then_id(client, sessions):
+    user_id, ids = sessions
+
+    # Oldest first, the two created at the same time by id
+    assert await pages(
+        client, {"user_id": user_id}, limit=2, order_by="created_at"
+    ) == [[ids[3], ids[4]], [ids[2], ids[1]], [ids[0]]]
+    # The anchor is gone, so is its position
+    assert not await client.get_page(
+        Session, {}, after=ObjectId(), order_by="created_at"
+    )
+
+
+@pytest.mark.asyncio
+async def test_iter_many_projects_and_filters(client, sessions):
+    user_id, ids = sessions
+
+    documents = [
+        document
+        async for document in client.iter_many(
+            Session, {"user_id": user_id}, projection=["title"], limit=1
+        )
+    ]
+    assert documents == [{"id": ids[0], "title": "session 0"}]
+    assert await client.get_many_user_id(Session, ObjectId()) == []
+    assert len(await client.list(Session)) == len(ids)